@@ -1,2 +1,5 @@
-from amqpqueue import Producer, Consumer, Subscriber, Error
+from amqpqueue import Producer, Consumer, Subscriber, MultiConsumer, Lane, RetryPolicy, Error, ConnectionLost, DeliveryLost
 from queuefactory import QueueFactory
+from asyncqueue import AsyncProducer, AsyncConsumer, AsyncSubscriber, EventLoop, Future
+from rpc import RpcClient, RemoteError
+from memory import MemoryBroker, MemoryProducer, MemoryConsumer, MemorySubscriber, MemoryMultiConsumer, MemoryRpcClient
@@ -5,12 +5,21 @@ except ImportError:
     pass
 
 import amqplib.client_0_8 as amqp
+from amqplib.client_0_8.method_framing import MethodWriter
+from amqplib.client_0_8.serialization import AMQPWriter
 import logging
+import threading
+import socket
+import select
+import random
+import time
+from Queue import Empty
+from collections import deque
+from struct import pack
+import zlib
+import bz2
 
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
+import serializers
 
 
 logging.getLogger('amqplib').setLevel(logging.INFO) # silence amqplib
@@ -18,10 +27,238 @@ log = logging.getLogger('amqpqueue')
 
 
 
+# content_encoding -> (compress(data, level), decompress(data))
+COMPRESSIONS = {'deflate':(zlib.compress, zlib.decompress),
+                'bzip2':(bz2.compress, bz2.decompress),
+                }
+
 class Error(Exception):
     "Exception raised by AmqpQueue.get()"
     pass
 
+class ConnectionLost(Error):
+    "The broker connection dropped and could not be re-established."
+    pass
+
+class DeliveryLost(Error):
+    """The connection dropped after the message was got, so it can no longer be
+    acked or rejected. The broker will redeliver it."""
+    pass
+
+class _WaitTimeout(Exception):
+    "Nothing arrived for the channel before the waiting thread's deadline."
+    pass
+
+# What amqplib and the socket layer raise when the broker goes away
+CONNECTION_ERRORS = (socket.error, IOError, amqp.AMQPConnectionException)
+
+class ConnectionPool(object):
+    '''
+    A small set of amqp connections shared by many queues, each queue getting
+    its own channel. checkout() hands out a fresh channel on the least used
+    connection, opening a new connection while there are fewer than
+    max_connections; release() gives it back.
+
+    amqplib connections are not thread-safe, so pooled connections serialise
+    frame writes and let one thread at a time read from the socket, queueing
+    methods for the other channels.
+    '''
+    def __init__(self, addr='localhost:5672', userid='guest', password='guest', ssl=False,
+                 max_connections=1):
+        self.addr = addr
+        self.userid = userid
+        self.password = password
+        self.ssl = ssl
+        self.max_connections = max_connections
+        self.lock = threading.Lock()
+        # connection -> number of channels checked out on it
+        self.users = {}
+
+    def _connect(self):
+        conn = amqp.Connection(self.addr,
+                               userid = self.userid,
+                               password = self.password,
+                               ssl = self.ssl)
+        _share_connection(conn)
+        # amqplib picks a free channel id and registers the channel in two
+        # steps, so channels are opened one at a time on each connection
+        conn._channel_lock = threading.Lock()
+        return conn
+
+    def checkout(self):
+        ''' Open and return a new channel on one of the pooled connections '''
+        self.lock.acquire()
+        try:
+            conn = None
+            if self.users:
+                conn = min(self.users, key=self.users.get)
+            if conn is None or (self.users[conn] and len(self.users) < self.max_connections):
+                conn = self._connect()
+                self.users[conn] = 0
+            self.users[conn] += 1
+        finally:
+            self.lock.release()
+        conn._channel_lock.acquire()
+        try:
+            try:
+                return conn.channel()
+            except:
+                self.release(None, conn)
+                raise
+        finally:
+            conn._channel_lock.release()
+
+    def discard(self, conn):
+        ''' Forget a broken connection, so checkout() opens a new one '''
+        self.lock.acquire()
+        try:
+            self.users.pop(conn, None)
+        finally:
+            self.lock.release()
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def release(self, ch, conn=None):
+        ''' Close a channel handed out by checkout(). The connection stays open. '''
+        if conn is None:
+            conn = ch.connection
+        if ch is not None:
+            try:
+                ch.close()
+            except Exception:
+                pass
+        self.lock.acquire()
+        try:
+            if conn in self.users:
+                self.users[conn] -= 1
+        finally:
+            self.lock.release()
+
+    def close(self):
+        ''' Drop every pooled connection '''
+        self.lock.acquire()
+        try:
+            conns, self.users = self.users.keys(), {}
+        finally:
+            self.lock.release()
+        for conn in conns:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def __len__(self):
+        return len(self.users)
+
+
+def _share_connection(conn):
+    ''' Make an amqplib connection safe to use from several threads, one channel
+    per thread. Writes take a lock; reads go through a single reader at a time,
+    which queues methods meant for other channels and wakes their threads. '''
+    if getattr(conn, '_shared', False):
+        return
+    conn._shared = True
+    transport = conn.transport
+    write = transport._write
+    write_lock = threading.Lock()
+    def locked_write(data):
+        write_lock.acquire()
+        try:
+            write(data)
+        finally:
+            write_lock.release()
+    transport._write = locked_write
+
+    # reentrant, as a close from the broker (channel 0) is handled inside a read
+    read_lock = threading.RLock()
+    arrived = threading.Condition(threading.Lock())
+    # a thread may set conn._deadlines.deadline to give up waiting (with
+    # _WaitTimeout) at that time, rather than block until its channel has
+    # something; traffic for other channels no longer holds it up
+    conn._deadlines = threading.local()
+
+    def remaining():
+        deadline = getattr(conn._deadlines, 'deadline', None)
+        if deadline is None:
+            return None
+        return max(0, deadline - time.time())
+
+    def queued_method(channel_id, allowed_methods):
+        method_queue = conn.channels[channel_id].method_queue
+        for queued in method_queue:
+            method_sig = queued[0]
+            if (allowed_methods is None) or (method_sig in allowed_methods) \
+                    or (method_sig == (20, 40)):
+                method_queue.remove(queued)
+                return queued
+
+    def wait_method(channel_id, allowed_methods):
+        while True:
+            arrived.acquire()
+            try:
+                queued = queued_method(channel_id, allowed_methods)
+                if queued is not None:
+                    return queued
+                if not read_lock.acquire(False):
+                    # another thread is reading; it will wake us for anything new
+                    left = remaining()
+                    if left == 0:
+                        raise _WaitTimeout
+                    if left is None or left > 1.0:
+                        left = 1.0
+                    arrived.wait(left)
+                    continue
+            finally:
+                arrived.release()
+            try:
+                left = remaining()
+                if left is not None and not _buffered(conn):
+                    readable, _, _ = select.select([conn.transport.sock], [], [], left)
+                    if not readable:
+                        raise _WaitTimeout
+                channel, method_sig, args, content = conn.method_reader.read_method()
+                if (channel == channel_id) and ((allowed_methods is None) \
+                        or (method_sig in allowed_methods) or (method_sig == (20, 40))):
+                    return method_sig, args, content
+                if (channel != 0) and (method_sig in amqp.Channel._IMMEDIATE_METHODS):
+                    conn.channels[channel].dispatch_method(method_sig, args, content)
+                    continue
+                arrived.acquire()
+                try:
+                    conn.channels[channel].method_queue.append((method_sig, args, content))
+                    arrived.notifyAll()
+                finally:
+                    arrived.release()
+                if channel == 0:
+                    conn.wait()
+            finally:
+                read_lock.release()
+                arrived.acquire()
+                arrived.notifyAll()
+                arrived.release()
+
+    conn._wait_method = wait_method
+
+
+def _pending(ch):
+    ''' True if amqplib already holds data for this channel which a select() on
+    the socket would not report '''
+    return bool(ch.method_queue) or _buffered(ch.connection)
+
+def _buffered(conn):
+    ''' True if amqplib has read data off the connection's socket which it
+    has not handed out yet '''
+    if not conn.method_reader.queue.empty():
+        return True
+    transport = conn.transport
+    if getattr(transport, '_read_buffer', None):
+        return True
+    sslobj = getattr(transport, 'sslobj', None)
+    return bool(sslobj is not None and hasattr(sslobj, 'pending') and sslobj.pending())
+
+
 class _AmqpQueue:
     '''From http://www.lshift.net/blog/2009/06/11/python-queue-interface-for-amqp
 
@@ -66,13 +303,11 @@ class _AmqpQueue:
     >>> qc = Consumer('test_qas')
     >>> qc.delete(); qc.close()
     '''
-    # pickle load/dump
-    dumps = lambda _,s:pickle.dumps(s, -1)
-    loads = pickle.loads
-    content_type = "text/x-python"
-
     def __init__(self, queue_name, addr='localhost:5672', \
-                        userid='guest', password='guest', ssl=False, exchange_name='sqs_exchange', binding=None):
+                        userid='guest', password='guest', ssl=False, exchange_name='sqs_exchange', binding=None,
+                        serializer='pickle', pool=None, reconnect=False, reconnect_attempts=None,
+                        reconnect_delay=0.1, reconnect_max_delay=30.0, metrics=None,
+                        exchange_type='direct', binding_arguments=None):
         self.addr = addr
         self.queue_name = queue_name
         if binding:
@@ -80,21 +315,122 @@ class _AmqpQueue:
         else:
             self.binding = queue_name
         self.exchange_name = exchange_name
+        # 'direct', 'topic', 'fanout' or 'headers'
+        self.exchange_type = exchange_type
+        # the header values a Subscriber on a headers exchange matches on
+        self.binding_arguments = binding_arguments
         self.addr = addr
         self.userid = userid
         self.password = password
         self.ssl = ssl
+        # default codec for put(); get() decodes by the message's content_type
+        self.serializer = serializers.get(serializer)
+
+        self.pool = pool
+        # reconnect with jittered exponential backoff when the connection drops
+        self.reconnect = reconnect
+        self.reconnect_attempts = reconnect_attempts
+        self.reconnect_delay = reconnect_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        self._shared = False
+        # an amqpqueue.metrics.Metrics to record timings in, if any
+        self.metrics = metrics
 
-        ''' Create amqp connection, channels and bindings '''
+        self._connect()
+
+    def _connect(self):
+        ''' Create amqp connection and channel '''
+        if self.pool is not None:
+            self.ch = self.pool.checkout()
+            self.conn = self.ch.connection
+            return
         self.conn = amqp.Connection(self.addr,
                                     userid = self.userid,
                                     password = self.password,
                                     ssl = self.ssl)
+        if self._shared:
+            _share_connection(self.conn)
         self.ch = self.conn.channel()
 
+    def share_connection(self):
+        ''' Allow other threads to write (eg ack) on this queue's connection
+        while one thread is blocked reading from it. Pooled connections are
+        always shared. '''
+        self._shared = True
+        _share_connection(self.conn)
+
+    def _setup(self):
+        ''' Declare exchanges, queues and bindings on a fresh channel '''
+        pass
+
+    def _call(self, method, *args, **kw):
+        ''' Call method, reconnecting and trying again if the connection drops
+        (when reconnect is set). method must look up self.ch afresh each time. '''
+        while True:
+            try:
+                return method(*args, **kw)
+            except CONNECTION_ERRORS, e:
+                if not self.reconnect:
+                    raise
+                log.warning("Lost connection to %s (%s)" % (self.addr, e))
+                self._connection_lost()
+
+    def _connection_lost(self):
+        ''' Throw away the broken connection and reconnect, redeclaring topology '''
+        self._drop_connection()
+        attempt = 0
+        while True:
+            time.sleep(self._backoff(attempt))
+            attempt += 1
+            if self._reconnect_attempt(attempt):
+                return
+
+    def _backoff(self, attempt):
+        ''' Seconds to wait before the reconnect attempt after attempt '''
+        delay = min(self.reconnect_max_delay, self.reconnect_delay * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+    def _reconnect_attempt(self, attempt):
+        ''' Try to reconnect once. Returns True if that worked, False if it is
+        worth trying again, and raises ConnectionLost when out of attempts. '''
+        try:
+            self._connect()
+            self._setup()
+            log.info("Reconnected to %s after %d attempt(s)" % (self.addr, attempt))
+            return True
+        except CONNECTION_ERRORS, e:
+            self._drop_connection()
+            if self.reconnect_attempts is not None and attempt >= self.reconnect_attempts:
+                raise ConnectionLost("Could not reconnect to %s: %s" % (self.addr, e))
+            log.warning("Reconnect attempt %d to %s failed (%s)" % (attempt, self.addr, e))
+            return False
+
+    def _drop_connection(self):
+        if self.pool is not None and self.conn is not None:
+            self.pool.discard(self.conn)
+            self.ch, self.conn = None, None
+        elif self.conn is not None:
+            self._close_connection()
+
+    def _observe(self, name, started, nbytes=None):
+        if self.metrics is not None:
+            self.metrics.observe(name, time.time() - started, self.queue_name, nbytes)
+
+    def dumps(self, obj):
+        return self.serializer.dumps(obj)
+
+    def loads(self, body):
+        return self.serializer.loads(body)
+
     def _close_connection(self):
         ''' Drop tcp/ip connection and amqp abstractions '''
-        for obj in [self.ch, self.conn, self.conn.transport.sock]:
+        if self.pool is not None:
+            # the connection belongs to the pool, only give back the channel
+            if self.ch is not None:
+                self.pool.release(self.ch, self.conn)
+            self.ch, self.conn = None, None
+            return
+        for obj in [self.ch, self.conn, getattr(self.conn.transport, 'sock', None)]:
             try:
                 obj.close()
             except Exception:
@@ -109,12 +445,12 @@ class _AmqpQueue:
 
     def qsize(self):
         ''' Return number of messages waiting in this queue '''
-        _, n_msgs, _ = self._declare()
+        _, n_msgs, _ = self._call(self._declare)
         return n_msgs
 
     def consumers(self):
         ''' How many clients are currently listening to this queue. '''
-        _, _, n_consumers = self._declare()
+        _, _, n_consumers = self._call(self._declare)
         return n_consumers
 
     def __len__(self):
@@ -136,72 +472,731 @@ class _AmqpQueue:
 class Producer(_AmqpQueue):
     '''
     Creates/sends/produces messages into the queue.
+
+    Pass transactional=True to put the channel into tx mode; every put (or
+    every batch, see Producer.batch) is then committed on the broker before
+    it returns.
+
+    Bodies of compress_threshold bytes or more are compressed with the given
+    compression ('deflate' or 'bzip2') and compress_level; Consumers
+    decompress them automatically. Compression is off by default.
+
+    With exchange_type 'topic' or 'headers', each put can be given its own
+    routing_key or headers, and Subscribers bind with wildcards ('*.txt',
+    'create.#') or header values, so they only receive what they want.
+    Such a Producer does not declare or bind a queue of its own, which would
+    pile up every message with nobody reading it; pass own_queue=True if
+    something does consume it (it then receives everything):
+
+    >>> qp = Producer('inotify', exchange_name='inotify_events', exchange_type='topic')
+    >>> qp.put({'type':'create', 'path':'/a.txt'}, routing_key='create.txt')
+    >>> qs = Subscriber('indexer', binding='*.txt', exchange_name='inotify_events',
+    ...                 exchange_type='topic')
     '''
     def __init__(self, *args, **kwargs):
+        self.transactional = kwargs.pop('transactional', False)
+        self.compress_threshold = kwargs.pop('compress_threshold', None)
+        self.compression = kwargs.pop('compression', 'deflate')
+        self.compress_level = kwargs.pop('compress_level', 6)
+        self.own_queue = kwargs.pop('own_queue', None)
+        if self.compression not in COMPRESSIONS:
+            raise Error("Unknown compression '%s'" % self.compression)
+        self._batch = None
         _AmqpQueue.__init__(self, *args, **kwargs)
+        if self.own_queue is None:
+            self.own_queue = self.exchange_type not in ('topic', 'headers')
+        self._setup()
+
+    def _setup(self):
         self.ch.access_request('/data', active=True, read=False, write=True)
-        self.ch.exchange_declare(self.exchange_name, 'direct', \
+        self.ch.exchange_declare(self.exchange_name, self.exchange_type, \
                                                 durable=True, auto_delete=False)
-        self._declare()
-        self.ch.queue_bind(self.queue_name, self.exchange_name, self.queue_name)
+        if self.own_queue:
+            self._declare()
+            # the Producer's own queue gets every message, whatever its routing key
+            binding = self.queue_name
+            if self.exchange_type == 'topic':
+                binding = '#'
+            self.ch.queue_bind(self.queue_name, self.exchange_name, binding)
+        if self.transactional:
+            self.ch.tx_select()
+
+    def _message(self, message, serializer=None, headers=None):
+        if serializer is None:
+            serializer = self.serializer
+        else:
+            serializer = serializers.get(serializer)
+        body = serializer.dumps(message)
+        if self.compress_threshold is not None and len(body) >= self.compress_threshold:
+            if isinstance(body, unicode):
+                body = body.encode('utf-8')
+            compress, _ = COMPRESSIONS[self.compression]
+            msg = amqp.Message(compress(body, self.compress_level),
+                               content_type=serializer.content_type,
+                               content_encoding=self.compression)
+        else:
+            msg = amqp.Message(body, content_type=serializer.content_type)
+        if headers:
+            msg.properties['application_headers'] = headers
+        return msg
+
+    def put(self, message, serializer=None, routing_key=None, headers=None):
+        ''' Add message to queue. serializer overrides the queue's codec for
+        this message ('raw', 'json', 'pickle' or any registered codec).
+        routing_key (default: the queue name) and headers are what topic and
+        headers exchanges route on. '''
+        started = time.time()
+        self._put(self._message(message, serializer, headers), routing_key, started)
+
+    def _put(self, msg, routing_key, started):
+        if routing_key is None:
+            routing_key = self.queue_name
+        if self._batch is not None:
+            self.ch.basic_publish(msg, self.exchange_name, routing_key)
+            self._batch.published()
+        else:
+            self._call(self._publish, msg, routing_key)
+        self._observe('publish', started, len(msg.body))
+
+    def _publish(self, msg, routing_key):
+        self.ch.basic_publish(msg, self.exchange_name, routing_key)
+        if self.transactional:
+            self.ch.tx_commit()
+
+    def put_many(self, messages, serializer=None, routing_key=None):
+        ''' Add every message in an iterable to the queue, using a single batch.
+        routing_key may be a function giving each message's routing key.
+        Returns the number of messages sent. '''
+        batch = self.batch()
+        batch.begin()
+        try:
+            for message in messages:
+                if callable(routing_key):
+                    self.put(message, serializer, routing_key(message))
+                else:
+                    self.put(message, serializer, routing_key)
+        except:
+            batch.abort()
+            raise
+        batch.commit()
+        return batch.count
+
+    def batch(self, transactional=None, max_bytes=1048576):
+        ''' Group the puts that follow into one buffered socket write.
+
+        >>> batch = qp.batch()
+        >>> batch.begin()
+        >>> qp.put('a'); qp.put('b')
+        >>> batch.commit()
+
+        or, with python 2.6+, "with qp.batch(): ..." does the same.
+        transactional defaults to the Producer's own setting; a batch on a
+        transactional Producer is always transactional, as nothing published
+        on its channel shows up until a tx.commit.
+        '''
+        if transactional is None:
+            transactional = self.transactional
+        return PublishBatch(self, transactional, max_bytes)
+
+
+class PublishBatch(object):
+    '''
+    Buffers the frames a Producer writes on its channel and sends them with one
+    write when the batch is committed (or whenever max_bytes has been buffered).
+    If the batch is transactional, the whole batch is committed with a single
+    tx.commit. Other channels sharing the connection are not affected.
+    '''
+    def __init__(self, producer, transactional=False, max_bytes=1048576):
+        self.producer = producer
+        self.transactional = transactional
+        self.max_bytes = max_bytes
+        self.count = 0
+        self._buffer = []
+        self._buffered = 0
+        self._writer = None
+
+    def begin(self):
+        if self.producer._batch is not None:
+            raise Error('A batch is already in progress on this Producer.')
+        if self.producer.transactional:
+            # the channel is in tx mode, so the batch must end in a tx.commit
+            self.transactional = True
+        elif self.transactional:
+            # AMQP has no way to leave tx mode, so the Producer stays transactional
+            self.producer.ch.tx_select()
+            self.producer.transactional = True
+        self._writer = MethodWriter(self, self.producer.conn.frame_max)
+        self.producer.ch._send_method = self._send_method
+        self.producer._batch = self
+
+    def _send_method(self, method_sig, args='', content=None):
+        if isinstance(args, AMQPWriter):
+            args = args.getvalue()
+        self._writer.write_method(self.producer.ch.channel_id, method_sig, args, content)
+
+    def write_frame(self, frame_type, channel, payload):
+        ''' Called by the MethodWriter in place of the transport '''
+        size = len(payload)
+        self._buffer.append(pack('>BHI%dsB' % size, frame_type, channel, size, payload, 0xce))
+        self._buffered += size + 8
+        if self._buffered >= self.max_bytes:
+            self.flush()
 
-    def put(self, message):
-        ''' Add message to queue '''
-        msg = amqp.Message(self.dumps(message), content_type=self.content_type)
-        self.ch.basic_publish(msg, self.exchange_name, self.queue_name)
+    def published(self):
+        self.count += 1
+
+    def flush(self):
+        ''' Send everything buffered so far in one write '''
+        if self._buffer:
+            data = "".join(self._buffer)
+            self._buffer, self._buffered = [], 0
+            self.producer.conn.transport._write(data)
+
+    def _end(self):
+        # drop the instance override, uncovering Channel._send_method again
+        del self.producer.ch._send_method
+        self.producer._batch = None
+
+    def commit(self):
+        try:
+            try:
+                self.flush()
+            finally:
+                self._end()
+            if self.transactional:
+                self.producer.ch.tx_commit()
+        except CONNECTION_ERRORS, e:
+            self._lost(e)
+
+    def abort(self):
+        ''' Drop anything not yet written. Only a transactional batch can take
+        back messages which have already been flushed. '''
+        self._buffer, self._buffered = [], 0
+        self._end()
+        if self.transactional:
+            try:
+                self.producer.ch.tx_rollback()
+            except CONNECTION_ERRORS, e:
+                self._lost(e)
+
+    def _lost(self, e):
+        if not self.producer.reconnect:
+            raise
+        self.producer._connection_lost()
+        raise Error('Connection lost during a batch of %d messages, which may'
+                    ' not have been delivered: %s' % (self.count, e))
+
+    def __enter__(self):
+        self.begin()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+        return False
+
+
+class ReceiveBuffer(object):
+    '''
+    FIFO of messages delivered by the broker but not yet handed out by get().
+
+    max_messages/max_bytes (0 = unlimited) set the high water mark. Once it is
+    passed, full() is True until the buffer drains back to half of it.
+    Messages already in flight will still arrive, so the caps are soft.
+    '''
+    def __init__(self, max_messages=0, max_bytes=0):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.messages = deque()
+        self.bytes = 0
+        self.peak_messages = 0
+        self.peak_bytes = 0
+        self.paused = False
+        self.pauses = 0
+
+    def __len__(self):
+        return len(self.messages)
+
+    def append(self, msg):
+        self.messages.append(msg)
+        self.bytes += len(msg.body)
+        self.peak_messages = max(self.peak_messages, len(self.messages))
+        self.peak_bytes = max(self.peak_bytes, self.bytes)
+
+    def popleft(self):
+        msg = self.messages.popleft()
+        self.bytes -= len(msg.body)
+        return msg
+
+    def clear(self):
+        self.messages.clear()
+        self.bytes = 0
+
+    def over(self, fraction=1.0):
+        return bool((self.max_messages and len(self.messages) >= self.max_messages * fraction) or \
+                    (self.max_bytes and self.bytes >= self.max_bytes * fraction))
+
+    def stats(self):
+        return {'messages':len(self.messages),
+                'bytes':self.bytes,
+                'max_messages':self.max_messages,
+                'max_bytes':self.max_bytes,
+                'peak_messages':self.peak_messages,
+                'peak_bytes':self.peak_bytes,
+                'paused':self.paused,
+                'pauses':self.pauses,
+                }
+
+
+class RetryPolicy(object):
+    '''
+    What Consumer.task_failed does with a message, instead of requeueing it
+    straight away: the message is held back for 'delay' seconds, growing by
+    'backoff' times each attempt up to 'max_delay', then delivered again.
+    Once it has failed 'max_attempts' times it is moved to the dead letter
+    queue (by default '<queue_name>.dead') instead.
+
+    Delays are rounded to the millisecond; each distinct delay gets its own
+    holding queue, '<queue_name>.retry.<ms>', whose message TTL returns the
+    messages to the queue (this relies on RabbitMQ's x-message-ttl and
+    x-dead-letter-exchange queue arguments). The number of failed attempts so
+    far is kept in the message's 'attempts' header.
+
+    >>> qc = Consumer('test_q', retry=RetryPolicy(max_attempts=5, delay=1.0))
+    '''
+    def __init__(self, max_attempts=5, delay=1.0, backoff=2.0, max_delay=300.0,
+                 dead_letter_queue=None):
+        self.max_attempts = max_attempts
+        self.delay = delay
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.dead_letter_queue = dead_letter_queue
+
+    def delay_for(self, attempts):
+        ''' Seconds to hold a message back after its attempts'th failure '''
+        return min(self.max_delay, self.delay * self.backoff ** (attempts - 1))
+
+    def dead_letter_queue_for(self, queue_name):
+        return self.dead_letter_queue or '%s.dead' % queue_name
+
+
+def attempts(msg):
+    ''' How many times an amqp message has already failed '''
+    return msg.properties.get('application_headers', {}).get('attempts', 0)
 
 
 class Consumer(_AmqpQueue):
     '''
     Receives/consumes messages from the queue.
+
+    prefetch_count/prefetch_size set the broker's qos window for this consumer.
+    With a prefetch_count of N, up to N messages may be got before any of them
+    are acknowledged; by default only one message may be outstanding.
+
+    buffer_messages/buffer_bytes cap the local receive buffer; when it fills up
+    the broker is held back, by capping the channel's qos window at what is
+    already outstanding, until the buffer has half drained. (channel.flow
+    from the client is refused by RabbitMQ 3.3 and later, whose per-channel
+    'global' qos this relies on.) With buffer_messages and no
+    prefetch_count, the consumer's window is sized to fit the buffer.
+
+    retry, a RetryPolicy, makes task_failed hold failing messages back for a
+    while, and eventually dead-letter them, rather than requeue them at once.
+
+    reply() answers messages put with RpcClient.call (see amqpqueue.rpc).
     '''
     def __init__(self, *args, **kwargs):
+        self.retry = kwargs.pop('retry', None)
+        self.prefetch_count = kwargs.pop('prefetch_count', 0)
+        self.prefetch_size = kwargs.pop('prefetch_size', 0)
+        self._amqp_messages = ReceiveBuffer(kwargs.pop('buffer_messages', 0),
+                                            kwargs.pop('buffer_bytes', 0))
+        self.max_unacked = max(self.prefetch_count, 1)
+        self.delivery_tag = None
+        # delivery tags handed out by get() and not yet acked/rejected, oldest first
+        self.unacked = []
+        # tags got before a reconnect; the broker will redeliver these messages
+        self.lost = []
+        # broker tags restart at 1 on a new channel, so the tags handed out by get()
+        # are offset to stay unique across reconnects
+        self._tag_offset = 0
+        self._max_tag = 0
+        # delivery tag -> amqp message, while unacked
+        self._delivered = {}
+        # retry holding queues and dead letter queues declared on this channel
+        self._declared = set()
+        self.cancelled = False
         _AmqpQueue.__init__(self, *args, **kwargs)
+        self._setup()
+
+    def _setup(self):
         self.ch.access_request('/data', active=True, read=True, write=False)
+        self._declared = set()
         self._declare()
-        self.ch.queue_bind(self.queue_name, self.exchange_name, self.queue_name)
-        self.delivery_tag = None
+        self._bind()
+        window = self.prefetch_count
+        if self._amqp_messages.max_messages and not window:
+            # the broker never delivers more than the buffer can hold
+            window = self._amqp_messages.max_messages + self.max_unacked
+        if window or self.prefetch_size:
+            self.ch.basic_qos(self.prefetch_size, window, False)
 
-        self.consumer_tag = self.ch.basic_consume(self.queue_name,
+        self.consumer_tag = None
+        if not self.cancelled:
+            self.consumer_tag = self.ch.basic_consume(self.queue_name,
                                             callback=self._amqp_callback)
-        self._amqp_messages = []
 
-    def get(self):
+    def _connection_lost(self):
+        self._forget_deliveries()
+        _AmqpQueue._connection_lost(self)
+
+    def _forget_deliveries(self):
+        ''' The connection dropped: everything got but not settled will be
+        redelivered, and tags start again from 1 on the new channel '''
+        self._tag_offset += self._max_tag
+        self._max_tag = 0
+        self.lost.extend(self.unacked)
+        self.unacked = []
+        self._delivered = {}
+        self.delivery_tag = None
+        self._amqp_messages.clear()
+        self._amqp_messages.paused = False
+
+    def _bind(self):
+        self.ch.queue_bind(self.queue_name, self.exchange_name, self.queue_name)
+
+    def _subscribe(self):
+        ''' Bind to the exchange with self.binding, which may be a list of
+        routing keys (or patterns), and self.binding_arguments '''
+        self.ch.exchange_declare(self.exchange_name, self.exchange_type, \
+                                                durable=True, auto_delete=False)
+        bindings = self.binding
+        if not isinstance(bindings, (list, tuple)):
+            bindings = [bindings]
+        for binding in bindings:
+            self.ch.queue_bind(self.queue_name, self.exchange_name, binding,
+                               arguments=self.binding_arguments)
+
+    def get(self, block=True, timeout=None):
         """
-        Timeout and non-blocking is not implemented.
+        Remove and return a message from the queue, as Queue.get does: if block
+        is false, or no message arrives within timeout seconds, Queue.Empty is
+        raised. This holds on pooled and shared connections too, give or take
+        the rest of a frame already being read.
+
+        The delivery tag of the returned message is left in self.delivery_tag.
+        If the connection drops after a message was got, acking it raises
+        DeliveryLost; the broker will deliver it again. A message whose body
+        can't be decoded raises the codec's error, and is rejected without
+        requeueing, or dead-lettered if there is a retry policy.
         """
-        if self.delivery_tag is not None:
+        return self._get(block, timeout)[0]
+
+    def _get(self, block=True, timeout=None):
+        ''' As get(), but returns (message, delivery tag), for callers that
+        settle from other threads and so can't rely on self.delivery_tag '''
+        if len(self.unacked) >= self.max_unacked:
             raise Error('You must call queue.task_done'
                                  ' before you are allowed to get new item.')
 
 
-        msg = self._get_blocking()
+        started = time.time()
+        if block and timeout is None:
+            msg = self._get_blocking()
+        else:
+            msg = self._get_waiting(block and timeout or 0)
+        self._observe('receive_wait', started)
 
-        data = self.loads(msg.body)
-        self.delivery_tag = msg.delivery_tag
+        try:
+            data = self.decode(msg)
+        except Exception, e:
+            self._undecodable(msg, e)
+            raise
+        delivery_tag = msg.delivery_tag + self._tag_offset
+        self.delivery_tag = delivery_tag
+        self.unacked.append(delivery_tag)
+        self._delivered[delivery_tag] = msg
+        return data, delivery_tag
+
+    def _undecodable(self, msg, e):
+        ''' Settle a message whose body can't be decoded, as nobody else can:
+        the caller gets the error, not a delivery tag. It is dead-lettered
+        with a retry policy, or else rejected without requeueing, which drops
+        it unless its queue has an x-dead-letter-exchange. '''
+        log.error("Could not decode message %s on %s: %s"
+                  % (msg.delivery_tag + self._tag_offset, self.queue_name, e))
+        try:
+            if self.retry is None:
+                self._settle_call(lambda: self.ch.basic_reject(msg.delivery_tag, requeue=False))
+            else:
+                self._settle_call(lambda: self._retry(msg.delivery_tag, msg, dead=True))
+        except DeliveryLost:
+            # it will be redelivered, and fail again
+            pass
+
+    def decode(self, msg):
+        ''' Decompress a message body if need be, then decode it with the codec
+        named by its content_type '''
+        started = time.time()
+        body = msg.body
+        encoding = msg.properties.get('content_encoding')
+        if encoding in COMPRESSIONS:
+            _, decompress = COMPRESSIONS[encoding]
+            body = decompress(body)
+        serializer = serializers.for_content_type(msg.properties.get('content_type'),
+                                                  self.serializer)
+        data = serializer.loads(body)
+        self._observe('deserialize', started, len(msg.body))
         return data
 
     def _amqp_callback(self, msg):
+        self._max_tag = max(self._max_tag, msg.delivery_tag)
         self._amqp_messages.append(msg)
 
+    def _wait(self):
+        self.ch.wait()
+
     def _get_blocking(self):
         while not self._amqp_messages:
+            self._call(self._wait)
+            self._flow_control()
+
+        msg = self._amqp_messages.popleft()
+        self._flow_control()
+        return msg
+
+    def _wait_until(self, deadline):
+        ''' Wait for a method on a shared connection, giving up at deadline.
+        Returns False if nothing came for this channel in time. '''
+        self.conn._deadlines.deadline = deadline
+        try:
             self.ch.wait()
+        except _WaitTimeout:
+            return False
+        finally:
+            self.conn._deadlines.deadline = None
+        return True
 
-        return self._amqp_messages.pop(0)
+    def _get_waiting(self, timeout):
+        deadline = time.time() + timeout
+        while not self._amqp_messages:
+            if _pending(self.ch):
+                self._call(self._wait)
+            elif getattr(self.conn, '_shared', False):
+                # the socket may be readable for another channel's traffic, or
+                # another thread may be reading ours, so select() can't be used
+                if not self._call(self._wait_until, deadline):
+                    raise Empty
+            elif self._call(self._select, max(0, deadline - time.time())):
+                self._call(self._wait)
+            else:
+                raise Empty
+            self._flow_control()
 
-    def task_done(self):
-        ''' Indicate that a formerly enqueued task is complete. '''
-        assert self.delivery_tag is not None
-        self.ch.basic_ack(self.delivery_tag)
-        self.delivery_tag = None
+        msg = self._amqp_messages.popleft()
+        self._flow_control()
+        return msg
+
+    def _select(self, timeout):
+        readable, _, _ = select.select([self.conn.transport.sock], [], [], timeout)
+        return bool(readable)
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def cancel(self):
+        ''' Stop the broker delivering any more messages to this consumer.
+        Messages already delivered can still be got, without blocking. '''
+        self.cancelled = True
+        if self.consumer_tag is not None:
+            self._call(self._cancel, self.consumer_tag)
+            self.consumer_tag = None
+
+    def _cancel(self, consumer_tag):
+        # amqplib forgets the consumer's callback on cancel-ok, and silently
+        # drops deliveries it has no callback for: take in what has already
+        # arrived, and keep the callback for any deliveries that arrive
+        # before the cancel-ok, so they can still be got
+        self._poll()
+        callback = self.ch.callbacks.get(consumer_tag)
+        self.ch.basic_cancel(consumer_tag)
+        if callback is not None:
+            self.ch.callbacks[consumer_tag] = callback
+
+    def _poll(self):
+        ''' Take in every delivery already on its way, without blocking '''
+        while True:
+            if _pending(self.ch):
+                self._wait()
+            elif getattr(self.conn, '_shared', False):
+                if not self._wait_until(time.time()):
+                    return
+            elif self._select(0):
+                self._wait()
+            else:
+                return
 
-    def task_failed(self):
+    def _flow_control(self):
+        ''' Hold the broker back when the receive buffer is full, resume at
+        half. A channel-wide qos limit of the messages now outstanding lets
+        no more through until some are acked; lifting it leaves the
+        consumer's own window in place. '''
+        buf = self._amqp_messages
+        if not buf.paused and buf.over():
+            outstanding = len(buf) + len(self.unacked)
+            self.ch.basic_qos(0, max(1, outstanding), True)
+            buf.paused = True
+            buf.pauses += 1
+        elif buf.paused and not buf.over(0.5):
+            self.ch.basic_qos(0, 0, True)
+            buf.paused = False
+
+    def buffer_stats(self):
+        ''' Occupancy of the local receive buffer, as a dict '''
+        return self._amqp_messages.stats()
+
+    def _settle(self, delivery_tag):
+        ''' Forget an outstanding delivery tag, defaulting to the oldest one, and
+        return the broker's tag for it and the message delivered with it. '''
+        if delivery_tag is None:
+            assert self.lost or self.unacked
+            delivery_tag = (self.lost or self.unacked)[0]
+        if delivery_tag in self.lost:
+            self.lost.remove(delivery_tag)
+            raise DeliveryLost('Message %s was got before the connection dropped'
+                               ' and will be redelivered.' % delivery_tag)
+        self.unacked.remove(delivery_tag)
+        msg = self._delivered.pop(delivery_tag)
+        if delivery_tag == self.delivery_tag:
+            self.delivery_tag = None
+        return delivery_tag - self._tag_offset, msg
+
+    def _settle_call(self, method, *args, **kw):
+        try:
+            method(*args, **kw)
+        except CONNECTION_ERRORS, e:
+            if not self.reconnect:
+                raise
+            log.warning("Lost connection to %s (%s)" % (self.addr, e))
+            self._connection_lost()
+            raise DeliveryLost('Connection dropped before the message was settled;'
+                               ' it will be redelivered.')
+
+    def task_done(self, delivery_tag=None, upto=None):
+        ''' Indicate that a formerly enqueued task is complete.
+
+        delivery_tag - ack that particular message (default: the oldest unacked one)
+        upto - ack every outstanding message up to and including this delivery
+               tag, with a single cumulative ack where that can't take in
+               messages which have not been got yet.
+        '''
+        started = time.time()
+        if upto is not None:
+            lost = [tag for tag in self.lost if tag <= upto]
+            acked = [tag for tag in self.unacked if tag <= upto]
+            self.lost = [tag for tag in self.lost if tag > upto]
+            self.unacked = [tag for tag in self.unacked if tag > upto]
+            for tag in acked:
+                del self._delivered[tag]
+            if self.delivery_tag is not None and self.delivery_tag <= upto:
+                self.delivery_tag = None
+            if acked:
+                tags = [tag - self._tag_offset for tag in acked]
+                if self._can_ack_upto(max(tags)):
+                    self._settle_call(lambda: self.ch.basic_ack(max(tags), multiple=True))
+                else:
+                    for tag in tags:
+                        self._settle_call(lambda: self.ch.basic_ack(tag))
+                self._observe('ack', started)
+            if lost:
+                raise DeliveryLost('%d message(s) were got before the connection dropped'
+                                   ' and will be redelivered.' % len(lost))
+            return
+        tag, _ = self._settle(delivery_tag)
+        self._settle_call(lambda: self.ch.basic_ack(tag))
+        self._observe('ack', started)
+
+    def _can_ack_upto(self, broker_tag):
+        ''' Whether a cumulative ack up to broker_tag only acks messages that
+        have been got. Deliveries are got in order, so anything still in
+        the receive buffer has a higher tag. '''
+        return True
+
+    def task_failed(self, delivery_tag=None):
         ''' Indicate that a formerly enqueued task has failed. This will return the
-        msg to the queue.'''
-        assert self.delivery_tag is not None
-        self.ch.basic_reject(self.delivery_tag, requeue=True)
-        self.delivery_tag = None
+        msg to the queue, or with a retry policy, to a holding queue or the dead
+        letter queue.'''
+        started = time.time()
+        tag, msg = self._settle(delivery_tag)
+        if self.retry is None:
+            self._settle_call(lambda: self.ch.basic_reject(tag, requeue=True))
+        else:
+            self._settle_call(lambda: self._retry(tag, msg))
+        self._observe('reject', started)
+
+    def reply(self, data, delivery_tag=None, serializer=None, error=None):
+        ''' Send data back to the RpcClient that put the message with this
+        delivery tag (default: the oldest unacked one), before acking it.
+        The reply is encoded like the request unless serializer is given;
+        error, if given, makes the caller's future fail with RemoteError.
+        Returns False, sending nothing, if the message asked for no reply. '''
+        if delivery_tag is None:
+            assert self.lost or self.unacked
+            delivery_tag = (self.lost or self.unacked)[0]
+        if delivery_tag in self.lost:
+            raise DeliveryLost('Message %s was got before the connection dropped'
+                               ' and will be redelivered.' % delivery_tag)
+        msg = self._delivered[delivery_tag]
+        reply_to = msg.properties.get('reply_to')
+        if not reply_to:
+            return False
+        if serializer is None:
+            serializer = serializers.for_content_type(msg.properties.get('content_type'),
+                                                      self.serializer)
+        else:
+            serializer = serializers.get(serializer)
+        reply = amqp.Message(serializer.dumps(data), content_type=serializer.content_type,
+                             correlation_id=msg.properties.get('correlation_id'))
+        if error is not None:
+            reply.properties['application_headers'] = {'error':error}
+        # straight to the caller's queue, through the default exchange
+        self._settle_call(lambda: self.ch.basic_publish(reply, '', reply_to))
+        return True
+
+    def _retry(self, tag, msg, dead=False):
+        ''' Republish a failed message to wait in a holding queue, or to the
+        dead letter queue (straight away if dead), then ack the original
+        delivery '''
+        failures = attempts(msg) + 1
+        headers = dict(msg.properties.get('application_headers', {}))
+        headers['attempts'] = failures
+        properties = dict(msg.properties)
+        properties['application_headers'] = headers
+        properties['delivery_mode'] = 2
+        queue_name = self._source_queue(msg)
+        if dead or failures >= self.retry.max_attempts:
+            queue = self.retry.dead_letter_queue_for(queue_name)
+            arguments = None
+            log.warning("Message failed %d times, moving it to %s" % (failures, queue))
+        else:
+            delay = int(self.retry.delay_for(failures) * 1000)
+            queue = '%s.retry.%d' % (queue_name, delay)
+            # expired messages go back to their queue through the default exchange
+            arguments = {'x-message-ttl':delay,
+                         'x-dead-letter-exchange':'',
+                         'x-dead-letter-routing-key':queue_name}
+        if queue not in self._declared:
+            self.ch.queue_declare(queue, passive=False, durable=True, exclusive=False,
+                                  auto_delete=False, arguments=arguments)
+            self._declared.add(queue)
+        self.ch.basic_publish(amqp.Message(msg.body, **properties), '', queue)
+        self.ch.basic_ack(tag)
+
+    def _source_queue(self, msg):
+        ''' The queue a message was delivered from '''
+        return self.queue_name
 
 
 class Subscriber(Consumer):
@@ -209,17 +1204,182 @@ class Subscriber(Consumer):
     Receives/consumes messages from a subscription queue. If 3 Subscribers connect to
     a given Producer, each will have it's own persistent queue, and each queue would
     recieve a copy of any message the Producer puts out (Fan-out.)
+
+    On a topic exchange, binding can be a pattern ('*.txt'), or a list of
+    them; on a headers exchange, binding_arguments gives the header values to
+    match (with 'x-match' 'all' or 'any').
     '''
-    def __init__(self, *args, **kwargs):
-        _AmqpQueue.__init__(self, *args, **kwargs)
+    def _bind(self):
+        self._subscribe()
+
+
+
+class Lane(object):
+    '''
+    One of the queues a MultiConsumer takes messages from. weight is its share
+    in 'weighted' mode; prefetch_count caps how many of its messages may be
+    delivered and not yet acked. binding defaults to the queue name.
+    '''
+    def __init__(self, queue_name, weight=1, prefetch_count=1, binding=None):
+        self.queue_name = queue_name
+        self.weight = weight
+        self.prefetch_count = prefetch_count
+        self.binding = binding or queue_name
+        # the state below belongs to the consumer using the lane; consumers
+        # work on copies (see _own_lanes), so a list of Lanes can be shared
+        self.buffer = ReceiveBuffer()
+        self.consumer_tag = None
+        # smooth weighted round robin state
+        self.current = 0
+
+def _own_lanes(lanes):
+    ''' Copies of the given Lanes (or queue names) for one consumer to keep
+    its buffers, consumer tags and round robin state on '''
+    own = []
+    for lane in lanes:
+        if isinstance(lane, Lane):
+            own.append(Lane(lane.queue_name, lane.weight, lane.prefetch_count, lane.binding))
+        else:
+            own.append(Lane(lane))
+    return own
+
+def pick_lane(lanes, weighted=False):
+    ''' Choose which of the given lanes (all with a message ready) to take the
+    next message from: the first one, or in weighted mode, each in proportion
+    to its weight, interleaved as evenly as possible. '''
+    if not weighted:
+        return lanes[0]
+    total = 0
+    best = None
+    for lane in lanes:
+        lane.current += lane.weight
+        total += lane.weight
+        if best is None or lane.current > best.current:
+            best = lane
+    best.current -= total
+    return best
+
+class _LaneBuffers(object):
+    ''' Stands in for a Consumer's ReceiveBuffer: popleft() takes from the
+    lane chosen by pick_lane '''
+    def __init__(self, lanes, weighted):
+        self.lanes = lanes
+        self.weighted = weighted
+        self.paused = False
+        self.pauses = 0
+
+    def __len__(self):
+        return sum([len(lane.buffer) for lane in self.lanes])
+
+    def popleft(self):
+        lane = pick_lane([lane for lane in self.lanes if lane.buffer], self.weighted)
+        return lane.buffer.popleft()
+
+    def clear(self):
+        for lane in self.lanes:
+            lane.buffer.clear()
+
+    def over(self, fraction=1.0):
+        return False
+
+    def stats(self):
+        stats = {'paused':False, 'pauses':0, 'lanes':{}}
+        for lane in self.lanes:
+            stats['lanes'][lane.queue_name] = lane.buffer.stats()
+        stats['messages'] = len(self)
+        stats['bytes'] = sum([lane.buffer.bytes for lane in self.lanes])
+        return stats
+
+class MultiConsumer(Consumer):
+    '''
+    Consumes from several queues ("lanes") on one channel. mode='priority'
+    takes from the first lane with a message waiting, then the second, and so
+    on; mode='weighted' shares the messages out by the lanes' weights.
+
+    >>> qc = MultiConsumer([Lane('urgent', prefetch_count=1),
+    ...                     Lane('bulk', prefetch_count=10)])
+    >>> qc = MultiConsumer([Lane('a', weight=3), Lane('b', weight=1)], mode='weighted')
+
+    Everything already received is read off the socket before a message is
+    picked, so a message on a higher lane is never passed over for one that
+    merely arrived earlier. Each lane's prefetch_count is set with a
+    non-global basic.qos before its basic.consume, which RabbitMQ 3.3 and
+    later apply per consumer; older brokers apply the last one to the whole
+    channel. The base Consumer's prefetch and buffer settings are not used.
+    '''
+    def __init__(self, lanes, mode='priority', **kwargs):
+        if mode not in ('priority', 'weighted'):
+            raise Error("Unknown mode '%s'" % mode)
+        self.lanes = _own_lanes(lanes)
+        self._lanes_by_tag = {}
+        for key in ('prefetch_count', 'prefetch_size', 'buffer_messages', 'buffer_bytes', 'binding'):
+            kwargs.pop(key, None)
+        Consumer.__init__(self, self.lanes[0].queue_name, **kwargs)
+        self._amqp_messages = _LaneBuffers(self.lanes, mode == 'weighted')
+        self.max_unacked = sum([lane.prefetch_count for lane in self.lanes])
+
+    def _setup(self):
         self.ch.access_request('/data', active=True, read=True, write=False)
-        self._declare()
-        self.ch.queue_bind(self.queue_name, self.exchange_name, self.binding)
-        self.delivery_tag = None
+        self._declared = set()
+        self.consumer_tag = None
+        self._lanes_by_tag = {}
+        for lane in self.lanes:
+            self.ch.queue_declare(lane.queue_name, passive=False, durable=True,
+                                  exclusive=False, auto_delete=False)
+            self.ch.queue_bind(lane.queue_name, self.exchange_name, lane.binding)
+            lane.consumer_tag = None
+            if not self.cancelled:
+                self.ch.basic_qos(0, lane.prefetch_count, False)
+                lane.consumer_tag = self.ch.basic_consume(lane.queue_name,
+                                        callback=self._lane_callback(lane))
+                self._lanes_by_tag[lane.consumer_tag] = lane
 
-        self.consumer_tag = self.ch.basic_consume(self.queue_name,
-                                            callback=self._amqp_callback)
-        self._amqp_messages = []
+    def _lane_callback(self, lane):
+        def callback(msg):
+            self._max_tag = max(self._max_tag, msg.delivery_tag)
+            lane.buffer.append(msg)
+        return callback
+
+    def _get_blocking(self):
+        self._call(self._poll)
+        return Consumer._get_blocking(self)
+
+    def _get_waiting(self, timeout):
+        self._call(self._poll)
+        return Consumer._get_waiting(self, timeout)
+
+    def _can_ack_upto(self, broker_tag):
+        # lanes are got from out of delivery order; a cumulative ack must not
+        # take in messages still buffered in another lane
+        for lane in self.lanes:
+            for msg in lane.buffer.messages:
+                if msg.delivery_tag < broker_tag:
+                    return False
+        return True
+
+    def cancel(self):
+        ''' Stop the broker delivering any more messages from any lane '''
+        self.cancelled = True
+        for lane in self.lanes:
+            if lane.consumer_tag is not None:
+                self._call(self._cancel, lane.consumer_tag)
+                lane.consumer_tag = None
+
+    def _source_queue(self, msg):
+        return self._lanes_by_tag[msg.consumer_tag].queue_name
+
+    def qsizes(self):
+        ''' Number of messages waiting in each lane's queue, by queue name '''
+        sizes = {}
+        for lane in self.lanes:
+            _, sizes[lane.queue_name], _ = self._call(lambda: self.ch.queue_declare(
+                lane.queue_name, passive=False, durable=True, exclusive=False,
+                auto_delete=False))
+        return sizes
+
+    def qsize(self):
+        ''' Return number of messages waiting in all the lanes '''
+        return sum(self.qsizes().values())
 
 
 
@@ -247,4 +1407,3 @@ if __name__ == '__main__':
         coverage.stop()
         coverage.report(modules, ignore_errors=1, show_missing=1)
         coverage.erase()
-
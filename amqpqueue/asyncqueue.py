@@ -0,0 +1,315 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Non-blocking counterparts of Producer, Consumer and Subscriber.
+
+The blocking queues tie up a thread each while they wait for the broker. The
+queues here are instead driven by an EventLoop, which select()s over all of
+their sockets, so one thread can service any number of queues. get() returns a
+Future instead of blocking, and consume() calls back for every delivery.
+
+Messages, exchanges and bindings are exactly the same as the blocking queues,
+so async and blocking producers and consumers can be mixed freely.
+
+>>> loop = EventLoop()
+>>> qp = AsyncProducer('test_q', loop=loop)
+>>> qc = AsyncConsumer('test_q', loop=loop, prefetch_count=10)
+>>> sent = qp.put('test')
+>>> future = qc.get()
+>>> loop.run_until_complete(future)
+'test'
+>>> qc.task_done(future.delivery_tag)
+>>> def echo(data, delivery_tag):
+...     print data
+...     qc.task_done(delivery_tag)
+>>> qc.consume(echo)
+>>> loop.call_later(5.0, loop.stop)
+>>> loop.run()
+"""
+
+import heapq
+import select
+import threading
+import time
+
+from amqpqueue import Producer, Consumer, Error, ConnectionLost, CONNECTION_ERRORS, \
+     _pending, log
+
+class Future(object):
+    """The result of an asynchronous call. Callbacks added with
+    add_done_callback are called with the future once it completes; result()
+    blocks the calling thread until then."""
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._event.isSet()
+
+    def result(self, timeout=None):
+        self._event.wait(timeout)
+        if not self._event.isSet():
+            raise Error('Timed out waiting for a result')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        return self._exception
+
+    def add_done_callback(self, fn):
+        if self.done():
+            fn(self)
+        else:
+            self._callbacks.append(fn)
+
+    def _complete(self):
+        self._event.set()
+        callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception, e:
+                log.exception("Future callback %r failed: %s" % (fn, e))
+
+    def set_result(self, result):
+        self._result = result
+        self._complete()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._complete()
+
+
+class EventLoop(object):
+    """select() loop over the sockets of the async queues registered with it,
+    plus simple timers."""
+    def __init__(self):
+        self.queues = []
+        self.timers = []
+        self.running = False
+
+    def add(self, queue):
+        if queue not in self.queues:
+            self.queues.append(queue)
+
+    def remove(self, queue):
+        if queue in self.queues:
+            self.queues.remove(queue)
+
+    def call_later(self, delay, fn, *args):
+        heapq.heappush(self.timers, (time.time() + delay, fn, args))
+
+    def _run_timers(self):
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            _, fn, args = heapq.heappop(self.timers)
+            fn(*args)
+
+    def run_once(self, timeout=None):
+        """Handle everything that is ready, waiting up to timeout seconds
+        (forever if None) for something to happen."""
+        ready = [q for q in self.queues if q._pending()]
+        if not ready and self.queues:
+            if self.timers:
+                until_timer = max(0, self.timers[0][0] - time.time())
+                if timeout is None or until_timer < timeout:
+                    timeout = until_timer
+            socks = dict((q.fileno(), q) for q in self.queues)
+            readable, _, _ = select.select(socks.keys(), [], [], timeout)
+            ready = [socks[fd] for fd in readable]
+        elif not ready and self.timers:
+            time.sleep(max(0, self.timers[0][0] - time.time()))
+        for queue in ready:
+            queue._readable()
+        self._run_timers()
+
+    def run(self):
+        """Run until stop() is called, or nothing is left to wait for"""
+        self.running = True
+        while self.running and (self.queues or self.timers):
+            self.run_once()
+        self.running = False
+
+    def run_until_complete(self, future):
+        """Run the loop until future is done and return its result"""
+        while not future.done():
+            self.run_once()
+        return future.result()
+
+    def stop(self):
+        self.running = False
+
+_default_loop = None
+
+def get_event_loop():
+    """The loop used by async queues which are not given one"""
+    global _default_loop
+    if _default_loop is None:
+        _default_loop = EventLoop()
+    return _default_loop
+
+
+class AsyncProducer(Producer):
+    """Producer whose put() does not wait on the broker (unless transactional)
+    and returns a completed Future, for symmetry with AsyncConsumer.get()."""
+    def __init__(self, *args, **kwargs):
+        self.loop = kwargs.pop('loop', None) or get_event_loop()
+        Producer.__init__(self, *args, **kwargs)
+
+    def put(self, message, serializer=None, routing_key=None, headers=None):
+        future = Future()
+        try:
+            Producer.put(self, message, serializer, routing_key, headers)
+        except Exception, e:
+            future.set_exception(e)
+        else:
+            future.set_result(None)
+        return future
+
+
+class AsyncConsumer(Consumer):
+    """Consumer driven by an EventLoop.
+
+    get() returns a Future for the next message; consume(callback) instead calls
+    callback(data, delivery_tag) for every message as it arrives. Acks and rejects
+    are written straight away and work as for Consumer, by delivery tag.
+
+    With reconnect set, a dropped connection is reopened from the loop's
+    timers, with the usual backoff, so the loop keeps serving other queues
+    meanwhile; pending futures fail with ConnectionLost if it can't be.
+    Without it, they fail with the connection error and the queue leaves
+    the loop. Messages that can't be decoded are settled as Consumer.get
+    does, and fail the future waiting for them.
+    """
+    def __init__(self, *args, **kwargs):
+        self.loop = kwargs.pop('loop', None) or get_event_loop()
+        if kwargs.get('pool') is not None:
+            raise Error('Async queues need a connection of their own to select() on')
+        self._waiters = []
+        self._callback = None
+        self._closed = False
+        Consumer.__init__(self, *args, **kwargs)
+        self.loop.add(self)
+
+    def fileno(self):
+        return self.conn.transport.sock.fileno()
+
+    def _pending(self):
+        return _pending(self.ch)
+
+    def _readable(self):
+        # The socket has data, so this only blocks for the rest of a frame.
+        # Not through _call(), whose reconnect would sleep in the loop
+        try:
+            self._wait()
+        except CONNECTION_ERRORS, e:
+            if not self.reconnect:
+                # the loop carries on serving the other queues
+                log.error("Lost connection to %s (%s)" % (self.addr, e))
+                self.loop.remove(self)
+                self._forget_deliveries()
+                self._drop_connection()
+                self._fail_waiters(e)
+                return
+            log.warning("Lost connection to %s (%s)" % (self.addr, e))
+            self._connection_lost()
+            return
+        self._dispatch()
+
+    def _connection_lost(self):
+        ''' As Consumer._connection_lost, but retrying from the loop's timers
+        instead of sleeping between attempts '''
+        self.loop.remove(self)
+        self._forget_deliveries()
+        self._drop_connection()
+        self._schedule_reconnect(0)
+
+    def _schedule_reconnect(self, attempt):
+        self.loop.call_later(self._backoff(attempt), self._try_reconnect, attempt + 1)
+
+    def _try_reconnect(self, attempt):
+        if self._closed:
+            return
+        try:
+            if not self._reconnect_attempt(attempt):
+                self._schedule_reconnect(attempt)
+                return
+        except ConnectionLost, e:
+            log.error(str(e))
+            self._fail_waiters(e)
+            return
+        self.loop.add(self)
+        self._dispatch()
+
+    def _fail_waiters(self, exception):
+        waiters, self._waiters = self._waiters, []
+        for future in waiters:
+            future.set_exception(exception)
+
+    def _take(self):
+        msg = self._amqp_messages.popleft()
+        try:
+            data = self.decode(msg)
+        except Exception, e:
+            self._undecodable(msg, e)
+            raise
+        self.delivery_tag = msg.delivery_tag + self._tag_offset
+        self.unacked.append(self.delivery_tag)
+        self._delivered[self.delivery_tag] = msg
+        return data, self.delivery_tag
+
+    def _dispatch(self):
+        while self._amqp_messages and (self._waiters or self._callback):
+            try:
+                data, delivery_tag = self._take()
+            except Exception, e:
+                # undecodable, and already settled; hand the error to
+                # whoever was waiting
+                if self._waiters:
+                    self._waiters.pop(0).set_exception(e)
+                else:
+                    log.exception("Could not decode message on %s: %s" % (self.queue_name, e))
+                continue
+            if self._waiters:
+                future = self._waiters.pop(0)
+                future.delivery_tag = delivery_tag
+                future.set_result(data)
+            else:
+                self._callback(data, delivery_tag)
+        self._flow_control()
+
+    def get(self):
+        """Return a Future for the next message. Its delivery tag is in the
+        future's delivery_tag once it completes (self.delivery_tag is only the
+        latest one, which may belong to another get() by then)."""
+        if len(self.unacked) + len(self._waiters) >= self.max_unacked:
+            raise Error('You must call queue.task_done'
+                                 ' before you are allowed to get new item.')
+        future = Future()
+        future.delivery_tag = None
+        self._waiters.append(future)
+        self._dispatch()
+        return future
+
+    def consume(self, callback):
+        """Call callback(data, delivery_tag) for every message from now on;
+        consume(None) stops."""
+        self._callback = callback
+        if callback is not None:
+            self._dispatch()
+
+    def close(self):
+        self._closed = True
+        self.loop.remove(self)
+        if self.conn is not None:
+            # None while waiting to reconnect
+            Consumer.close(self)
+
+
+class AsyncSubscriber(AsyncConsumer):
+    """AsyncConsumer on a subscription queue, see Subscriber"""
+    def _bind(self):
+        self._subscribe()
@@ -0,0 +1,195 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Coalescing stage to put in front of a Producer.
+
+File system watchers produce bursts of near identical events (every write to a
+file is an IN_MODIFY). A Coalescer holds events back for a short window,
+merging the ones about the same path, and publishes what is left in batches:
+
+    - repeats of the same event are dropped
+    - create followed by updates is just a create
+    - update followed by delete is just a delete
+    - create followed by delete cancels out altogether
+    - delete followed by create is an update
+
+>>> qp = qf.Producer('inotify', serializer='json')
+>>> events = Coalescer(qp, window=0.5)
+>>> events.put({'type':'create', 'path':'/dropbox/a.txt'})
+>>> events.put({'type':'update', 'path':'/dropbox/a.txt'})
+>>> events.flush()
+1
+
+Events become due once nothing new has been seen for their key for 'window'
+seconds, or 'max_delay' seconds after they were first seen, whichever is
+sooner. Call poll() regularly from the thread that puts events (eg from the
+watcher's loop), or start() a background thread to do it.
+"""
+
+import threading
+import time
+import os.path
+
+_MERGES = {('create', 'update'):'create',
+           ('create', 'delete'):None,
+           ('update', 'delete'):'delete',
+           ('delete', 'create'):'update',
+           }
+
+def event_key(event):
+    """Events about the same path are merged; reads are kept apart from
+    changes."""
+    if event.get('type') == 'read':
+        return (event.get('path'), 'read')
+    return event.get('path')
+
+def event_routing_key(event):
+    """'<type>.<file extension>', eg 'create.txt', or 'create.none' for files
+    without one, for Subscribers on a topic exchange to bind to"""
+    extension = os.path.splitext(event.get('path') or '')[1][1:].lower()
+    return '%s.%s' % (event.get('type'), extension or 'none')
+
+def merge_events(old, new):
+    """Merge two events with the same key. Returns the merged event, None if
+    they cancel out, or False if they can't be merged."""
+    old_type, new_type = old.get('type'), new.get('type')
+    if old_type == new_type:
+        return old
+    if (old_type, new_type) in _MERGES:
+        merged_type = _MERGES[(old_type, new_type)]
+        if merged_type is None:
+            return None
+        merged = dict(new)
+        merged['type'] = merged_type
+        return merged
+    return False
+
+class _Pending(object):
+    def __init__(self, event, now):
+        self.events = [event]
+        self.first_seen = now
+        self.last_seen = now
+
+class Coalescer(object):
+    def __init__(self, producer, window=1.0, max_delay=None, batch_size=500,
+                 key=event_key, merge=merge_events, routing_key=None):
+        """producer - anything with a .put(), and ideally a .put_many()
+        window - seconds to hold an event back, waiting for more about the same key
+        max_delay - publish events seen that long ago regardless (default 10 * window)
+        batch_size - most events published in one put_many
+        key, merge - how events are grouped and merged, see event_key/merge_events
+        routing_key - function giving each event's routing key, for a Producer
+                      on a topic exchange (see event_routing_key)"""
+        self.producer = producer
+        self.window = window
+        if max_delay is None:
+            max_delay = 10 * window
+        self.max_delay = max_delay
+        self.batch_size = batch_size
+        self.key = key
+        self.merge = merge
+        self.routing_key = routing_key
+        self.lock = threading.Lock()
+        # key -> _Pending, and keys in order of first sighting
+        self.pending = {}
+        self.order = []
+        self.received = 0
+        self.published = 0
+        self._thread = None
+        self._stop = False
+
+    def put(self, event):
+        """Add an event, merging it with any pending one for the same key"""
+        now = time.time()
+        k = self.key(event)
+        self.lock.acquire()
+        try:
+            self.received += 1
+            entry = self.pending.get(k)
+            if entry is None:
+                self.pending[k] = _Pending(event, now)
+                self.order.append(k)
+                return
+            entry.last_seen = now
+            if not entry.events:
+                # an earlier pair cancelled out
+                entry.events.append(event)
+                return
+            merged = self.merge(entry.events[-1], event)
+            if merged is None:
+                entry.events.pop()
+            elif merged is False:
+                entry.events.append(event)
+            else:
+                entry.events[-1] = merged
+        finally:
+            self.lock.release()
+
+    def _take(self, everything=False):
+        """Remove and return the events which are due"""
+        now = time.time()
+        due = []
+        self.lock.acquire()
+        try:
+            remaining = []
+            for k in self.order:
+                entry = self.pending[k]
+                if everything or now - entry.last_seen >= self.window \
+                        or now - entry.first_seen >= self.max_delay:
+                    due.extend(entry.events)
+                    del self.pending[k]
+                else:
+                    remaining.append(k)
+            self.order = remaining
+        finally:
+            self.lock.release()
+        return due
+
+    def _publish(self, events):
+        for start in xrange(0, len(events), self.batch_size):
+            batch = events[start:start + self.batch_size]
+            if self.routing_key is None:
+                if hasattr(self.producer, 'put_many'):
+                    self.producer.put_many(batch)
+                else:
+                    for event in batch:
+                        self.producer.put(event)
+            elif hasattr(self.producer, 'put_many'):
+                self.producer.put_many(batch, routing_key=self.routing_key)
+            else:
+                for event in batch:
+                    self.producer.put(event, routing_key=self.routing_key(event))
+            self.published += len(batch)
+        return len(events)
+
+    def poll(self):
+        """Publish the events that are due; returns how many were published"""
+        return self._publish(self._take())
+
+    def flush(self):
+        """Publish every pending event now"""
+        return self._publish(self._take(everything=True))
+
+    def __len__(self):
+        return sum([len(entry.events) for entry in self.pending.values()])
+
+    def _run(self):
+        while not self._stop:
+            time.sleep(min(self.window, self.max_delay) / 4.0)
+            self.poll()
+        self.flush()
+
+    def start(self):
+        """Poll from a background thread. The producer is then only used from
+        that thread, until stop()."""
+        self._stop = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread, publishing whatever is still pending"""
+        self._stop = True
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,659 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""In-process stand-ins for Producer, Consumer and Subscriber, for pipelines
+whose ends all live in one process, and for testing workers without a broker.
+
+Queues, exchanges and bindings are held by a MemoryBroker. They behave as the
+amqp ones do: a Producer's messages go to its own queue (except on topic and
+headers exchanges) and to every Subscriber queue bound to it, each message is got by one Consumer of a queue,
+messages stay queued until a Consumer acks them (task_done) and go back to the
+front of the queue on task_failed or when the Consumer is closed. A
+RetryPolicy (retry=...) holds failed messages back with a timer instead, and
+dead-letters them to another memory queue in the end. MemoryRpcClient makes
+calls which consumers answer with reply(), as RpcClient does, except that
+requests are never expired. Nothing is kept once the process exits.
+
+Messages are still passed through the serializer, so consumers get a copy of
+what was put, not the object itself.
+
+>>> qf = QueueFactory(backend='memory')
+>>> qp = qf.Producer('test_q')
+>>> qp.put('test')
+>>> qc = qf.Consumer('test_q')
+>>> qc.get()
+'test'
+>>> qc.task_done()
+"""
+
+import threading
+import time
+import uuid
+from Queue import Empty
+from collections import deque
+
+from amqpqueue import Error, COMPRESSIONS, pick_lane, _own_lanes, log
+from rpc import RemoteError, _Calls
+import serializers
+
+class _Queue(object):
+    def __init__(self, name):
+        self.name = name
+        # (body, content_type, redelivered, failed attempts, properties)
+        self.messages = deque()
+        self.consumers = 0
+
+def topic_matches(pattern, routing_key):
+    """Whether a topic binding pattern matches a routing key: words are
+    separated by dots, '*' stands for one word and '#' for any number"""
+    return _topic_matches(pattern.split('.'), routing_key.split('.'))
+
+def _topic_matches(pattern, words):
+    if not pattern:
+        return not words
+    if pattern[0] == '#':
+        return _topic_matches(pattern[1:], words) or \
+               bool(words) and _topic_matches(pattern, words[1:])
+    if not words:
+        return False
+    return pattern[0] in ('*', words[0]) and _topic_matches(pattern[1:], words[1:])
+
+def headers_match(arguments, headers):
+    """Whether a headers exchange binding matches a message's headers"""
+    arguments = dict(arguments or {})
+    match = arguments.pop('x-match', 'all')
+    headers = headers or {}
+    matches = [headers.get(key) == value for key, value in arguments.items()]
+    if match == 'any':
+        return True in matches
+    return False not in matches
+
+class MemoryBroker(object):
+    """Holds the queues and bindings of the memory backend. Queues made with
+    the same broker (by default, the module's shared one) see each other."""
+    def __init__(self):
+        self.cond = threading.Condition()
+        # exchange -> type
+        self.exchanges = {}
+        # exchange -> [(routing key, arguments, queue name), ...]
+        self.bindings = {}
+        self.queues = {}
+
+    def declare_exchange(self, exchange_name, exchange_type='direct'):
+        self.cond.acquire()
+        try:
+            self.exchanges.setdefault(exchange_name, exchange_type)
+        finally:
+            self.cond.release()
+
+    def declare(self, queue_name):
+        self.cond.acquire()
+        try:
+            queue = self.queues.get(queue_name)
+            if queue is None:
+                queue = self.queues[queue_name] = _Queue(queue_name)
+            return queue
+        finally:
+            self.cond.release()
+
+    def bind(self, queue_name, exchange_name, routing_key, arguments=None):
+        self.cond.acquire()
+        try:
+            bindings = self.bindings.setdefault(exchange_name, [])
+            if (routing_key, arguments, queue_name) not in bindings:
+                bindings.append((routing_key, arguments, queue_name))
+        finally:
+            self.cond.release()
+
+    def delete(self, queue_name):
+        self.cond.acquire()
+        try:
+            self.queues.pop(queue_name, None)
+            for exchange_name, bindings in self.bindings.items():
+                self.bindings[exchange_name] = [binding for binding in bindings
+                                                if binding[2] != queue_name]
+        finally:
+            self.cond.release()
+
+    def _routes(self, exchange_name, routing_key, headers):
+        exchange_type = self.exchanges.get(exchange_name, 'direct')
+        names = []
+        for key, arguments, name in self.bindings.get(exchange_name, []):
+            if exchange_type == 'fanout':
+                matched = True
+            elif exchange_type == 'topic':
+                matched = topic_matches(key, routing_key)
+            elif exchange_type == 'headers':
+                matched = headers_match(arguments, headers)
+            else:
+                matched = key == routing_key
+            if matched and name not in names:
+                names.append(name)
+        return names
+
+    def publish(self, exchange_name, messages):
+        """Route (routing key, properties, body, content_type) messages to
+        every queue bound to match them. properties is a dict of amqp message
+        properties: application_headers (which headers exchanges route on),
+        reply_to and correlation_id."""
+        self.cond.acquire()
+        try:
+            for routing_key, properties, body, content_type in messages:
+                headers = properties.get('application_headers')
+                for name in self._routes(exchange_name, routing_key, headers):
+                    queue = self.queues.get(name)
+                    if queue is not None:
+                        queue.messages.append((body, content_type, False, 0, properties))
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def put(self, queue_name, message):
+        """Append a (body, content_type, redelivered, attempts, properties)
+        message to a queue, declaring it if need be"""
+        queue = self.declare(queue_name)
+        self.cond.acquire()
+        try:
+            queue.messages.append(message)
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+default_broker = MemoryBroker()
+
+
+class _MemoryQueue(object):
+    def __init__(self, queue_name, exchange_name='sqs_exchange', binding=None,
+                 serializer='pickle', broker=None, metrics=None, exchange_type='direct',
+                 binding_arguments=None, **kw):
+        ''' Takes the same parameters as the amqp queues; those about the
+        connection (addr, pool, reconnect...) are ignored. '''
+        self.queue_name = queue_name
+        self.exchange_name = exchange_name
+        self.exchange_type = exchange_type
+        self.binding = binding or queue_name
+        self.binding_arguments = binding_arguments
+        self.serializer = serializers.get(serializer)
+        if broker is None:
+            broker = default_broker
+        self.broker = broker
+        self.metrics = metrics
+        self.queue = broker.declare(queue_name)
+
+    def _observe(self, name, started, nbytes=None):
+        if self.metrics is not None:
+            self.metrics.observe(name, time.time() - started, self.queue_name, nbytes)
+
+    def share_connection(self):
+        ''' Memory queues can always be used from several threads '''
+        pass
+
+    def dumps(self, obj):
+        return self.serializer.dumps(obj)
+
+    def loads(self, body):
+        return self.serializer.loads(body)
+
+    def qsize(self):
+        ''' Return number of messages waiting in this queue '''
+        return len(self.queue.messages)
+
+    def consumers(self):
+        ''' How many clients are currently listening to this queue. '''
+        return self.queue.consumers
+
+    def __len__(self):
+        return self.qsize()
+
+    def delete(self):
+        ''' Delete a queue and the messages in it. '''
+        self.broker.delete(self.queue_name)
+
+    def close(self):
+        pass
+
+
+class MemoryProducer(_MemoryQueue):
+    '''
+    Puts messages into a memory queue, as Producer does, including leaving
+    its own queue unbound on topic and headers exchanges unless own_queue=True.
+    Compression is not applied; transactional puts are the same as any other.
+    '''
+    def __init__(self, *args, **kwargs):
+        self.compression = kwargs.pop('compression', 'deflate')
+        self.own_queue = kwargs.pop('own_queue', None)
+        if self.compression not in COMPRESSIONS:
+            raise Error("Unknown compression '%s'" % self.compression)
+        for key in ('transactional', 'compress_threshold', 'compress_level'):
+            kwargs.pop(key, None)
+        self._batch = None
+        _MemoryQueue.__init__(self, *args, **kwargs)
+        self.broker.declare_exchange(self.exchange_name, self.exchange_type)
+        if self.own_queue is None:
+            self.own_queue = self.exchange_type not in ('topic', 'headers')
+        if self.own_queue:
+            # the Producer's own queue gets every message, whatever its routing key
+            binding = self.queue_name
+            if self.exchange_type == 'topic':
+                binding = '#'
+            self.broker.bind(self.queue_name, self.exchange_name, binding)
+
+    def put(self, message, serializer=None, routing_key=None, headers=None):
+        ''' Add message to queue. serializer overrides the queue's codec for
+        this message; routing_key and headers are routed on as Producer.put
+        does '''
+        started = time.time()
+        properties = {}
+        if headers:
+            properties['application_headers'] = headers
+        self._put(message, serializer, routing_key, properties, started)
+
+    def _put(self, message, serializer, routing_key, properties, started):
+        if serializer is None:
+            serializer = self.serializer
+        else:
+            serializer = serializers.get(serializer)
+        body = serializer.dumps(message)
+        if routing_key is None:
+            routing_key = self.queue_name
+        message = (routing_key, properties, body, serializer.content_type)
+        if self._batch is not None:
+            self._batch.append(message)
+        else:
+            self.broker.publish(self.exchange_name, [message])
+        self._observe('publish', started, len(body))
+
+    def put_many(self, messages, serializer=None, routing_key=None):
+        ''' Add every message in an iterable to the queue at once. routing_key
+        may be a function giving each message's routing key. Returns the
+        number of messages sent. '''
+        batch = self.batch()
+        batch.begin()
+        try:
+            for message in messages:
+                if callable(routing_key):
+                    self.put(message, serializer, routing_key(message))
+                else:
+                    self.put(message, serializer, routing_key)
+        except:
+            batch.abort()
+            raise
+        batch.commit()
+        return batch.count
+
+    def batch(self, transactional=None, max_bytes=None):
+        ''' Hold back the puts that follow until the batch is committed '''
+        return MemoryBatch(self)
+
+class MemoryBatch(object):
+    def __init__(self, producer):
+        self.producer = producer
+        self.count = 0
+        self._messages = []
+
+    def begin(self):
+        if self.producer._batch is not None:
+            raise Error('A batch is already in progress on this Producer.')
+        self.producer._batch = self
+
+    def append(self, message):
+        self._messages.append(message)
+        self.count += 1
+
+    def commit(self):
+        self.producer._batch = None
+        messages, self._messages = self._messages, []
+        self.producer.broker.publish(self.producer.exchange_name, messages)
+
+    def abort(self):
+        self.producer._batch = None
+        self._messages = []
+
+    def __enter__(self):
+        self.begin()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+        return False
+
+
+class MemoryConsumer(_MemoryQueue):
+    '''
+    Gets messages from a memory queue, as Consumer does. prefetch_count caps
+    how many messages may be got before acking them; buffering options are
+    ignored.
+    '''
+    def __init__(self, *args, **kwargs):
+        self.retry = kwargs.pop('retry', None)
+        prefetch_count = kwargs.pop('prefetch_count', 0)
+        for key in ('prefetch_size', 'buffer_messages', 'buffer_bytes'):
+            kwargs.pop(key, None)
+        self.max_unacked = max(prefetch_count, 1)
+        self.delivery_tag = None
+        self.unacked = []
+        # never anything here; kept for the Consumer interface
+        self.lost = []
+        # delivery tag -> (body, content_type, failed attempts, _Queue, properties)
+        self._messages = {}
+        self._next_tag = 1
+        self.cancelled = False
+        self.closed = False
+        _MemoryQueue.__init__(self, *args, **kwargs)
+        self._bind()
+        self._add_consumer(1)
+
+    def _bind(self):
+        self.broker.bind(self.queue_name, self.exchange_name, self.queue_name)
+
+    def _add_consumer(self, n):
+        self.broker.cond.acquire()
+        try:
+            self.queue.consumers += n
+        finally:
+            self.broker.cond.release()
+
+    def get(self, block=True, timeout=None):
+        """
+        Remove and return a message from the queue, as Queue.get does: if block
+        is false, or no message arrives within timeout seconds, Queue.Empty is
+        raised. The delivery tag of the returned message is left in
+        self.delivery_tag.
+        """
+        return self._get(block, timeout)[0]
+
+    def _get(self, block=True, timeout=None):
+        ''' As get(), but returns (message, delivery tag), as Consumer._get '''
+        if len(self.unacked) >= self.max_unacked:
+            raise Error('You must call queue.task_done'
+                                 ' before you are allowed to get new item.')
+        started = time.time()
+        cond = self.broker.cond
+        cond.acquire()
+        try:
+            if block and timeout is not None:
+                deadline = started + timeout
+            if self.cancelled:
+                raise Empty
+            while True:
+                taken = self._take()
+                if taken is not None:
+                    break
+                if not block:
+                    raise Empty
+                if timeout is None:
+                    cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise Empty
+                    cond.wait(remaining)
+            queue, (body, content_type, redelivered, attempts, properties) = taken
+        finally:
+            cond.release()
+        self._observe('receive_wait', started)
+        started = time.time()
+        try:
+            data = serializers.for_content_type(content_type, self.serializer).loads(body)
+        except Exception, e:
+            # settled here, as Consumer does: dead-lettered with a retry
+            # policy, otherwise dropped
+            log.error("Could not decode message on %s: %s" % (self.queue_name, e))
+            if self.retry is not None:
+                self._retry((body, content_type, attempts, queue, properties), dead=True)
+            raise
+        self._observe('deserialize', started, len(body))
+        delivery_tag = self._next_tag
+        self._next_tag += 1
+        self.delivery_tag = delivery_tag
+        self.unacked.append(delivery_tag)
+        self._messages[delivery_tag] = (body, content_type, attempts, queue, properties)
+        return data, delivery_tag
+
+    def _take(self):
+        ''' The next (queue, message) to hand out, if any. Called with the
+        broker's cond held. '''
+        if self.queue.messages:
+            return self.queue, self.queue.messages.popleft()
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def cancel(self):
+        ''' Stop taking messages from the queue '''
+        if not self.cancelled:
+            self.cancelled = True
+            self._add_consumer(-1)
+
+    def buffer_stats(self):
+        ''' Memory queues have no receive buffer; kept for the Consumer interface '''
+        return {'messages':0, 'bytes':0, 'max_messages':0, 'max_bytes':0,
+                'peak_messages':0, 'peak_bytes':0, 'paused':False, 'pauses':0}
+
+    def _settle(self, delivery_tag):
+        if delivery_tag is None:
+            assert self.unacked
+            delivery_tag = self.unacked[0]
+        self.unacked.remove(delivery_tag)
+        if delivery_tag == self.delivery_tag:
+            self.delivery_tag = None
+        return self._messages.pop(delivery_tag)
+
+    def task_done(self, delivery_tag=None, upto=None):
+        ''' Indicate that a formerly got message is complete, as Consumer.task_done '''
+        started = time.time()
+        if upto is not None:
+            for tag in [tag for tag in self.unacked if tag <= upto]:
+                self._settle(tag)
+        else:
+            self._settle(delivery_tag)
+        self._observe('ack', started)
+
+    def task_failed(self, delivery_tag=None):
+        ''' Return a formerly got message to the front of the queue, or with a
+        retry policy, to the back of it after a delay, or to the dead letter
+        queue '''
+        started = time.time()
+        message = self._settle(delivery_tag)
+        if self.retry is None:
+            self._requeue([message])
+        else:
+            self._retry(message)
+        self._observe('reject', started)
+
+    def reply(self, data, delivery_tag=None, serializer=None, error=None):
+        ''' Send data back to the MemoryRpcClient that put a formerly got
+        message, as Consumer.reply does '''
+        if delivery_tag is None:
+            assert self.unacked
+            delivery_tag = self.unacked[0]
+        body, content_type, attempts, queue, properties = self._messages[delivery_tag]
+        reply_to = properties.get('reply_to')
+        if not reply_to:
+            return False
+        if serializer is None:
+            serializer = serializers.for_content_type(content_type, self.serializer)
+        else:
+            serializer = serializers.get(serializer)
+        reply = {'correlation_id':properties.get('correlation_id')}
+        if error is not None:
+            reply['application_headers'] = {'error':error}
+        cond = self.broker.cond
+        cond.acquire()
+        try:
+            # nobody is waiting if the client's queue has gone
+            replies = self.broker.queues.get(reply_to)
+            if replies is not None:
+                replies.messages.append((serializer.dumps(data), serializer.content_type,
+                                         False, 0, reply))
+                cond.notifyAll()
+        finally:
+            cond.release()
+        return True
+
+    def _retry(self, message, dead=False):
+        body, content_type, attempts, queue, properties = message
+        failures = attempts + 1
+        if dead or failures >= self.retry.max_attempts:
+            self.broker.put(self.retry.dead_letter_queue_for(queue.name),
+                            (body, content_type, False, failures, properties))
+            return
+        timer = threading.Timer(self.retry.delay_for(failures), self.broker.put,
+                                (queue.name, (body, content_type, True, failures, properties)))
+        timer.setDaemon(True)
+        timer.start()
+
+    def _requeue(self, messages):
+        cond = self.broker.cond
+        cond.acquire()
+        try:
+            for body, content_type, attempts, queue, properties in reversed(messages):
+                queue.messages.appendleft((body, content_type, True, attempts, properties))
+            cond.notifyAll()
+        finally:
+            cond.release()
+
+    def close(self):
+        ''' Return any unacked messages to the queue '''
+        if self.closed:
+            return
+        self.closed = True
+        self._requeue([self._messages[tag] for tag in self.unacked])
+        self.unacked, self._messages, self.delivery_tag = [], {}, None
+        self.cancel()
+
+
+class MemorySubscriber(MemoryConsumer):
+    '''
+    Gets messages from its own memory queue, which receives a copy of
+    everything put to the queue named by binding (Fan-out), or on topic and
+    headers exchanges, of whatever its binding(s) and binding_arguments match.
+    '''
+    def _bind(self):
+        self.broker.declare_exchange(self.exchange_name, self.exchange_type)
+        bindings = self.binding
+        if not isinstance(bindings, (list, tuple)):
+            bindings = [bindings]
+        for binding in bindings:
+            self.broker.bind(self.queue_name, self.exchange_name, binding,
+                             self.binding_arguments)
+
+
+class MemoryMultiConsumer(MemoryConsumer):
+    '''
+    Takes messages from several memory queues, as MultiConsumer does: lanes
+    are amqpqueue.Lane instances (or queue names), mode is 'priority' or
+    'weighted', and each lane's prefetch_count caps its unacked messages.
+    '''
+    def __init__(self, lanes, mode='priority', **kwargs):
+        if mode not in ('priority', 'weighted'):
+            raise Error("Unknown mode '%s'" % mode)
+        self.lanes = _own_lanes(lanes)
+        self.weighted = mode == 'weighted'
+        for key in ('prefetch_count', 'binding'):
+            kwargs.pop(key, None)
+        broker = kwargs.get('broker', None) or default_broker
+        for lane in self.lanes:
+            lane.queue = broker.declare(lane.queue_name)
+        MemoryConsumer.__init__(self, self.lanes[0].queue_name, **kwargs)
+        self.max_unacked = sum([lane.prefetch_count for lane in self.lanes])
+
+    def _bind(self):
+        for lane in self.lanes:
+            self.broker.bind(lane.queue_name, self.exchange_name, lane.binding)
+
+    def _add_consumer(self, n):
+        self.broker.cond.acquire()
+        try:
+            for lane in self.lanes:
+                lane.queue.consumers += n
+        finally:
+            self.broker.cond.release()
+
+    def _take(self):
+        unacked = {}
+        for body, content_type, attempts, queue, properties in self._messages.values():
+            unacked[queue.name] = unacked.get(queue.name, 0) + 1
+        ready = [lane for lane in self.lanes if lane.queue.messages and \
+                 unacked.get(lane.queue_name, 0) < lane.prefetch_count]
+        if ready:
+            lane = pick_lane(ready, self.weighted)
+            return lane.queue, lane.queue.messages.popleft()
+
+    def qsizes(self):
+        ''' Number of messages waiting in each lane's queue, by queue name '''
+        return dict([(lane.queue_name, len(lane.queue.messages)) for lane in self.lanes])
+
+    def qsize(self):
+        return sum(self.qsizes().values())
+
+
+class MemoryRpcClient(MemoryProducer):
+    '''
+    MemoryProducer whose call() puts a request and returns a Future for the
+    reply, as RpcClient does. Replies are collected by a background thread
+    from a memory queue of the client's own.
+    '''
+    def __init__(self, *args, **kwargs):
+        self.poll_interval = kwargs.pop('poll_interval', 0.5)
+        MemoryProducer.__init__(self, *args, **kwargs)
+        self.closed = False
+        self.reply_queue_name = '%s.reply.%s' % (self.queue_name, uuid.uuid4().hex)
+        self.replies = self.broker.declare(self.reply_queue_name)
+        self.calls = _Calls(self.reply_queue_name, self._observe)
+        self._thread = threading.Thread(target=self._read)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def call(self, message, timeout=None, serializer=None, routing_key=None, headers=None):
+        ''' Put message as a request and return a Future for the reply '''
+        started = time.time()
+        correlation_id, future = self.calls.add(timeout)
+        properties = {'reply_to':self.reply_queue_name, 'correlation_id':correlation_id}
+        if headers:
+            properties['application_headers'] = headers
+        try:
+            self._put(message, serializer, routing_key, properties, started)
+        except:
+            self.calls.discard(correlation_id)
+            raise
+        return future
+
+    def _read(self):
+        cond = self.broker.cond
+        while not self.closed:
+            cond.acquire()
+            try:
+                if not self.replies.messages:
+                    cond.wait(self.poll_interval)
+                replies = list(self.replies.messages)
+                self.replies.messages.clear()
+            finally:
+                cond.release()
+            for body, content_type, redelivered, attempts, properties in replies:
+                correlation_id = properties.get('correlation_id')
+                error = properties.get('application_headers', {}).get('error')
+                if error is not None:
+                    self.calls.complete(correlation_id, exception=RemoteError(error))
+                    continue
+                try:
+                    data = serializers.for_content_type(content_type, self.serializer).loads(body)
+                except Exception, e:
+                    self.calls.complete(correlation_id, exception=e)
+                else:
+                    self.calls.complete(correlation_id, data)
+            self.calls.expire()
+
+    def outstanding(self):
+        ''' How many calls are still waiting for a reply '''
+        return len(self.calls)
+
+    def close(self):
+        ''' Stop collecting replies, failing any outstanding calls '''
+        self.closed = True
+        self._thread.join()
+        self.calls.fail_all(Error('The RpcClient was closed'))
+        self.broker.delete(self.reply_queue_name)
@@ -0,0 +1,203 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Counts, bytes and latency histograms for the queue and worker hot paths.
+
+Pass a Metrics instance to queues (metrics=...) and workers (as the 'metrics'
+context parameter) to have them record:
+
+    publish       Producer.put, serialising included; bytes sent
+    receive_wait  time Consumer.get spent waiting for the broker
+    deserialize   Consumer.get decoding a message; bytes received
+    ack, reject   Consumer.task_done/task_failed
+    task          Worker .starttask()
+    endtask       Worker .endtask()
+
+each labelled with the queue name (or the worker's class name). The numbers can
+be read with snapshot(), logged every so often with a LogReporter, or scraped
+in the Prometheus text format from a PrometheusExporter:
+
+>>> metrics = Metrics()
+>>> qp = Producer('test_q', metrics=metrics)
+>>> qp.put('test')
+>>> metrics.snapshot()[('publish', 'test_q')]['count']
+1
+>>> LogReporter(metrics, interval=60).start()
+>>> PrometheusExporter(metrics, port=9101).start()
+"""
+
+import threading
+import logging
+from bisect import bisect_left
+import BaseHTTPServer
+
+log = logging.getLogger('amqpqueue.metrics')
+
+# upper bounds (seconds) of the latency histogram buckets; the last is +Inf
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.bytes = 0
+        self.max = 0.0
+
+    def observe(self, seconds, nbytes=None):
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+        if nbytes:
+            self.bytes += nbytes
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of observations"""
+        if not self.count:
+            return 0.0
+        wanted = fraction * self.count
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if seen >= wanted:
+                if index < len(self.buckets):
+                    return min(self.buckets[index], self.max)
+                return self.max
+        return self.max
+
+    def snapshot(self):
+        return {'count':self.count,
+                'sum':self.sum,
+                'bytes':self.bytes,
+                'max':self.max,
+                'mean':self.count and self.sum / self.count or 0.0,
+                'p50':self.percentile(0.5),
+                'p90':self.percentile(0.9),
+                'p99':self.percentile(0.99),
+                'buckets':zip(self.buckets + (float('inf'),), self.counts),
+                }
+
+def _escape(label):
+    return (label or '').replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Metrics(object):
+    """Thread-safe set of histograms, one per (operation, queue)"""
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def observe(self, name, seconds, label=None, nbytes=None):
+        key = (name, label)
+        self.lock.acquire()
+        try:
+            histogram = self.series.get(key)
+            if histogram is None:
+                histogram = self.series[key] = Histogram(self.buckets)
+            histogram.observe(seconds, nbytes)
+        finally:
+            self.lock.release()
+
+    def snapshot(self):
+        """{(operation, queue): {'count', 'sum', 'bytes', 'max', 'mean', 'p50',
+        'p90', 'p99', 'buckets'}}"""
+        self.lock.acquire()
+        try:
+            return dict([(key, histogram.snapshot()) for key, histogram in self.series.items()])
+        finally:
+            self.lock.release()
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.series = {}
+        finally:
+            self.lock.release()
+
+    def prometheus(self):
+        """The current numbers in the Prometheus text exposition format"""
+        lines = []
+        snapshot = self.snapshot()
+        for name in sorted(set([key[0] for key in snapshot])):
+            series = [(_escape(label), values) for (series_name, label), values
+                      in sorted(snapshot.items()) if series_name == name]
+            metric = 'amqpqueue_%s_seconds' % name
+            lines.append('# TYPE %s histogram' % metric)
+            for label, values in series:
+                cumulative = 0
+                for bound, n in values['buckets']:
+                    cumulative += n
+                    if bound == float('inf'):
+                        bound = '+Inf'
+                    lines.append('%s_bucket{queue="%s",le="%s"} %d' % (metric, label, bound, cumulative))
+                lines.append('%s_sum{queue="%s"} %f' % (metric, label, values['sum']))
+                lines.append('%s_count{queue="%s"} %d' % (metric, label, values['count']))
+            series = [(label, values) for label, values in series if values['bytes']]
+            if series:
+                metric = 'amqpqueue_%s_bytes_total' % name
+                lines.append('# TYPE %s counter' % metric)
+                for label, values in series:
+                    lines.append('%s{queue="%s"} %d' % (metric, label, values['bytes']))
+        return '\n'.join(lines) + '\n'
+
+class LogReporter(object):
+    """Logs a one line summary of every series each 'interval' seconds"""
+    def __init__(self, metrics, interval=60.0, logger=log, level=logging.INFO):
+        self.metrics = metrics
+        self.interval = interval
+        self.logger = logger
+        self.level = level
+        self.stopped = threading.Event()
+
+    def report(self):
+        for (name, label), values in sorted(self.metrics.snapshot().items()):
+            self.logger.log(self.level, "%s %s: n=%d mean=%.6fs p50=%.6fs p99=%.6fs max=%.6fs bytes=%d" % \
+                            (name, label, values['count'], values['mean'], values['p50'],
+                             values['p99'], values['max'], values['bytes']))
+
+    def _run(self):
+        while True:
+            self.stopped.wait(self.interval)
+            if self.stopped.isSet():
+                break
+            self.report()
+
+    def start(self):
+        thread = threading.Thread(target=self._run)
+        thread.setDaemon(True)
+        thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+class _PrometheusHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.metrics.prometheus()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class PrometheusExporter(object):
+    """Serves the metrics for Prometheus to scrape, from a background thread,
+    on http://host:port/ (any path)"""
+    def __init__(self, metrics, port=9101, host='127.0.0.1'):
+        self.server = BaseHTTPServer.HTTPServer((host, port), _PrometheusHandler)
+        self.server.metrics = metrics
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,188 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Runs a chain of Worker stages, handing msgs straight from one stage to the
+next when both run in the same process.
+
+>>> pipe = Pipeline(qf)
+>>> pipe.stage(InotifyFilter, 'inotify')
+>>> pipe.stage(TextExtractor, 'extract')
+>>> pipe.stage(SolrIndexer, 'index', process='indexer', size=4)
+>>> pipe.run()                  # in one process: InotifyFilter -> TextExtractor
+>>> pipe.run('indexer')         # in another: SolrIndexer
+
+Each stage names the queue it would read from. Only the first stage of each
+run of stages sharing a process actually consumes from its queue; its
+.endtask() .put()s to the next stage, which runs there and then, in the same
+thread, without serialising, publishing or acking the msg. The delivery from
+the real queue is only acked once every fused stage has finished with the msg;
+if any of them fails it (task_failed, or an exception) the delivery is
+rejected and comes back to the head of the chain. The last stage of a process
+puts to the next stage's queue (or to 'output', if any) through a Producer.
+
+Stages whose .endtask() doesn't .put() simply end the chain for that msg, so
+filters work as they do between queues. BatchWorkers can't be run in a
+Pipeline.
+"""
+
+import threading
+import logging
+from Queue import Empty
+
+from amqpqueue import Error
+from queuefactory import QueueFactory
+from worker import WorkerPool, BatchWorker, JSONWorker, TaskTimeout
+
+log = logging.getLogger('amqpqueue.pipeline')
+
+class StageFailed(Exception):
+    pass
+
+class Stage(object):
+    def __init__(self, worker_class, queue, process=None, size=1, context=None):
+        self.worker_class = worker_class
+        self.queue = queue
+        self.process = process
+        self.size = size
+        self.context = context or {}
+
+class _FusedInput(object):
+    """The queue_stdin a fused stage sees: acks and rejects just record the
+    outcome for the msg in hand."""
+    max_unacked = 1
+
+    def __init__(self):
+        self.delivery_tag = None
+        self.failed = False
+
+    def get(self, block=True, timeout=None):
+        raise Empty
+
+    def task_done(self, delivery_tag=None, upto=None):
+        self.delivery_tag = None
+
+    def task_failed(self, delivery_tag=None):
+        self.failed = True
+        self.delivery_tag = None
+
+    def __len__(self):
+        return 0
+
+class _FusedOutput(object):
+    """The queue_stdout of a stage fused to the next: put(msg) runs the next
+    stage on msg in the calling thread. Each thread gets its own chain of
+    downstream workers."""
+    def __init__(self, stage, queue_stdout):
+        self.stage = stage
+        self.queue_stdout = queue_stdout
+        self.local = threading.local()
+
+    def _worker(self):
+        worker = getattr(self.local, 'worker', None)
+        if worker is None:
+            worker = self.local.worker = self.stage.worker_class(_FusedInput(),
+                                            self.queue_stdout, **self.stage.context)
+        return worker
+
+    def put(self, msg, serializer=None):
+        worker = self._worker()
+        fused = worker.queue_stdin
+        fused.delivery_tag, fused.failed = 1, False
+        if isinstance(worker, JSONWorker):
+            msg = worker.parse_json_msg(msg)
+        try:
+            response = worker.run_starttask(msg)
+        except TaskTimeout:
+            worker.task_timed_out(msg)
+        else:
+            worker.run_endtask(msg, response)
+        if fused.failed:
+            raise StageFailed("%s failed a msg from '%s'" % (self.stage.worker_class.__name__,
+                                                              self.stage.queue))
+
+class _ThreadProducer(object):
+    """Puts through a Producer of its own in each thread"""
+    def __init__(self, queue_factory, queue):
+        self.queue_factory = queue_factory
+        self.queue = queue
+        self.local = threading.local()
+
+    def put(self, msg, serializer=None):
+        producer = getattr(self.local, 'producer', None)
+        if producer is None:
+            producer = self.local.producer = self.queue_factory.Producer(self.queue)
+        producer.put(msg, serializer)
+
+class Pipeline(object):
+    def __init__(self, queue_factory=None, output=None):
+        """queue_factory - makes the queues between processes (default: a
+        QueueFactory with its defaults)
+        output - the queue the last stage puts to, if any"""
+        if queue_factory is None:
+            queue_factory = QueueFactory()
+        self.queue_factory = queue_factory
+        self.output = output
+        self.stages = []
+        self.pools = []
+
+    def stage(self, worker_class, queue, process=None, size=1, **kw):
+        """Add a stage running worker_class on msgs from 'queue'. Stages with
+        the same 'process' are fused. 'size' workers run the first stage of
+        each fused run, each with its own chain of the stages after it. Other
+        keyword parameters become the worker's context."""
+        if issubclass(worker_class, BatchWorker):
+            raise Error('BatchWorker stages are not supported in a Pipeline.')
+        stage = Stage(worker_class, queue, process, size, kw)
+        self.stages.append(stage)
+        return stage
+
+    def segments(self, process=None):
+        """The runs of adjacent stages that run in the given process"""
+        segments = []
+        previous = None
+        for stage in self.stages:
+            if stage.process == process:
+                if previous is not None and previous.process == process:
+                    segments[-1].append(stage)
+                else:
+                    segments.append([stage])
+            previous = stage
+        return segments
+
+    def _output(self, stage):
+        index = self.stages.index(stage)
+        if index + 1 < len(self.stages):
+            return _ThreadProducer(self.queue_factory, self.stages[index + 1].queue)
+        if self.output is not None:
+            return _ThreadProducer(self.queue_factory, self.output)
+        return None
+
+    def start(self, process=None):
+        """Start the workers for the stages in 'process', in threads"""
+        for segment in self.segments(process):
+            queue_stdout = self._output(segment[-1])
+            for stage in reversed(segment[1:]):
+                queue_stdout = _FusedOutput(stage, queue_stdout)
+            head = segment[0]
+            log.info("Running %s" % " -> ".join([stage.worker_class.__name__ for stage in segment]))
+            queue_stdin = self.queue_factory.Consumer(head.queue, prefetch_count=head.size)
+            pool = WorkerPool(head.worker_class, queue_stdin, queue_stdout,
+                              size=head.size, **head.context)
+            pool.start()
+            self.pools.append(pool)
+
+    def drain(self, deadline=30.0):
+        for pool in self.pools:
+            pool.drain(deadline)
+
+    def shutdown(self):
+        for pool in self.pools:
+            pool.shutdown()
+
+    def join(self):
+        for pool in self.pools:
+            pool.join()
+
+    def run(self, process=None):
+        self.start(process)
+        self.join()
@@ -1,7 +1,9 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-from amqpqueue import Producer, Consumer, Subscriber
+from amqpqueue import Producer, Consumer, Subscriber, MultiConsumer, ConnectionPool, Error
+from rpc import RpcClient
+import memory
 
 class QueueFactory(object):
     """Allows you to set defaults for your producer and consumer queues
@@ -17,8 +19,35 @@ class QueueFactory(object):
 
        The set 'defaults' can be overridden:
        >>> qp = qf.Consumer("notices", exchange_name="other_sqs_exchange")
+
+       With pool_size set, the queues share up to that many connections, each
+       queue using its own channel, instead of opening one connection apiece:
+       >>> qf = QueueFactory(pool_size=2)
+       >>> workers = [qf.Consumer("stdin") for i in xrange(5)]
+       >>> len(qf.pool)
+       2
+
+       With backend='memory', the queues are in-process ones with the same
+       interface (see amqpqueue.memory), held by 'broker' (a MemoryBroker,
+       by default one shared by the whole process):
+       >>> qf = QueueFactory(backend='memory')
+
+       Messages can be routed on a topic (or headers) exchange, Subscribers
+       binding with wildcards:
+       >>> qf = QueueFactory(exchange_name="inotify_events", exchange_type="topic")
+       >>> qf.Producer("inotify").put(event, routing_key="create.txt")
+       >>> qs = qf.Subscriber("indexer", "*.txt")
+
+       An RpcClient puts requests and returns futures for the workers' replies:
+       >>> rpc = qf.RpcClient("lookup")
+       >>> rpc.call({"isbn":"0140449132"}, timeout=5.0).result()
+
+       Queues made with metrics=amqpqueue.metrics.Metrics() record their
+       publish/receive/ack timings in it (see amqpqueue.metrics).
        """
-    def __init__(self, addr='localhost:5672', userid='guest', password='guest', ssl=False, exchange_name='sqs_exchange'):
+    def __init__(self, addr='localhost:5672', userid='guest', password='guest', ssl=False, exchange_name='sqs_exchange',
+                 exchange_type='direct', serializer='pickle', pool_size=0, reconnect=False, metrics=None,
+                 backend='amqp', broker=None):
         """ Sets up a context dict, so that when either a Producer or Consumer is required,
         the context can be easily overridden by supplied parameters"""
         self.context = {}
@@ -27,35 +56,143 @@ class QueueFactory(object):
         self.context['password']= password
         self.context['ssl'] = ssl
         self.context['exchange_name'] = exchange_name
+        self.context['exchange_type'] = exchange_type
+        self.context['serializer'] = serializer
+        self.context['reconnect'] = reconnect
+        self.context['metrics'] = metrics
+        if backend not in ('amqp', 'memory'):
+            raise Error("Unknown backend '%s'" % backend)
+        self.backend = backend
+        self.broker = broker
+        self.pool = None
+        if pool_size and backend == 'amqp':
+            self.pool = ConnectionPool(addr, userid, password, ssl, max_connections=pool_size)
+
+    def _pool(self, kw):
+        """The shared pool, unless the connection details have been overridden"""
+        for key in ('addr', 'userid', 'password', 'ssl'):
+            if key in kw:
+                return None
+        return self.pool
+
+    def _memory(self, queue_class, queue, context, **kw):
+        for key in ('addr', 'userid', 'password', 'ssl', 'reconnect'):
+            context.pop(key, None)
+        context.update(kw)
+        return queue_class(queue, broker=self.broker, **context)
+
+    def close(self):
+        """Close the pooled connections, if any"""
+        if self.pool is not None:
+            self.pool.close()
 
     def Producer(self, queue, **kw):
         this_context = self.context.copy()
         for key in kw:
             this_context[key] = kw[key]
+        if self.backend == 'memory':
+            return self._memory(memory.MemoryProducer, queue, this_context)
         return Producer(queue, addr=this_context['addr'],
                         userid=this_context['userid'],
                         password=this_context['password'],
                         ssl=this_context['ssl'],
-                        exchange_name=this_context['exchange_name'])
+                        exchange_name=this_context['exchange_name'],
+                        exchange_type=this_context['exchange_type'],
+                        serializer=this_context['serializer'],
+                        pool=self._pool(kw),
+                        reconnect=this_context['reconnect'],
+                        metrics=this_context['metrics'],
+                        transactional=this_context.get('transactional', False),
+                        compress_threshold=this_context.get('compress_threshold', None),
+                        compression=this_context.get('compression', 'deflate'),
+                        compress_level=this_context.get('compress_level', 6),
+                        own_queue=this_context.get('own_queue', None))
 
     def Consumer(self, queue, **kw):
         this_context = self.context.copy()
         for key in kw:
             this_context[key] = kw[key]
+        if self.backend == 'memory':
+            return self._memory(memory.MemoryConsumer, queue, this_context)
         return Consumer(queue, addr=this_context['addr'],
                         userid=this_context['userid'],
                         password=this_context['password'],
                         ssl=this_context['ssl'],
-                        exchange_name=this_context['exchange_name'])
+                        exchange_name=this_context['exchange_name'],
+                        exchange_type=this_context['exchange_type'],
+                        serializer=this_context['serializer'],
+                        pool=self._pool(kw),
+                        reconnect=this_context['reconnect'],
+                        metrics=this_context['metrics'],
+                        retry=this_context.get('retry', None),
+                        prefetch_count=this_context.get('prefetch_count', 0),
+                        prefetch_size=this_context.get('prefetch_size', 0),
+                        buffer_messages=this_context.get('buffer_messages', 0),
+                        buffer_bytes=this_context.get('buffer_bytes', 0))
 
     def Subscriber(self, queue, binding, **kw):
         this_context = self.context.copy()
         for key in kw:
             this_context[key] = kw[key]
+        if self.backend == 'memory':
+            return self._memory(memory.MemorySubscriber, queue, this_context, binding=binding)
         return Subscriber(queue, addr=this_context['addr'],
                         userid=this_context['userid'],
                         password=this_context['password'],
                         ssl=this_context['ssl'],
                         exchange_name=this_context['exchange_name'],
-                        binding=binding)
+                        exchange_type=this_context['exchange_type'],
+                        serializer=this_context['serializer'],
+                        pool=self._pool(kw),
+                        reconnect=this_context['reconnect'],
+                        metrics=this_context['metrics'],
+                        retry=this_context.get('retry', None),
+                        binding=binding,
+                        binding_arguments=this_context.get('binding_arguments', None),
+                        prefetch_count=this_context.get('prefetch_count', 0),
+                        prefetch_size=this_context.get('prefetch_size', 0),
+                        buffer_messages=this_context.get('buffer_messages', 0),
+                        buffer_bytes=this_context.get('buffer_bytes', 0))
 
+    def MultiConsumer(self, lanes, mode='priority', **kw):
+        """A consumer of several queues at once; see amqpqueue.MultiConsumer"""
+        this_context = self.context.copy()
+        for key in kw:
+            this_context[key] = kw[key]
+        if self.backend == 'memory':
+            return self._memory(memory.MemoryMultiConsumer, lanes, this_context, mode=mode)
+        return MultiConsumer(lanes, mode=mode, addr=this_context['addr'],
+                        userid=this_context['userid'],
+                        password=this_context['password'],
+                        ssl=this_context['ssl'],
+                        exchange_name=this_context['exchange_name'],
+                        exchange_type=this_context['exchange_type'],
+                        serializer=this_context['serializer'],
+                        pool=self._pool(kw),
+                        reconnect=this_context['reconnect'],
+                        metrics=this_context['metrics'],
+                        retry=this_context.get('retry', None))
+
+    def RpcClient(self, queue, **kw):
+        """A Producer whose call()s return futures for replies; see amqpqueue.rpc"""
+        this_context = self.context.copy()
+        for key in kw:
+            this_context[key] = kw[key]
+        if self.backend == 'memory':
+            return self._memory(memory.MemoryRpcClient, queue, this_context)
+        return RpcClient(queue, addr=this_context['addr'],
+                        userid=this_context['userid'],
+                        password=this_context['password'],
+                        ssl=this_context['ssl'],
+                        exchange_name=this_context['exchange_name'],
+                        exchange_type=this_context['exchange_type'],
+                        serializer=this_context['serializer'],
+                        pool=self._pool(kw),
+                        reconnect=this_context['reconnect'],
+                        metrics=this_context['metrics'],
+                        transactional=this_context.get('transactional', False),
+                        compress_threshold=this_context.get('compress_threshold', None),
+                        compression=this_context.get('compression', 'deflate'),
+                        compress_level=this_context.get('compress_level', 6),
+                        own_queue=this_context.get('own_queue', None),
+                        poll_interval=this_context.get('poll_interval', 0.5))
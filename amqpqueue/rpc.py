@@ -0,0 +1,226 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Request/reply on top of Producer, for using workers as a lookup service.
+
+>>> rpc = RpcClient('isbn_lookup')
+>>> future = rpc.call({'isbn':'0140449132'}, timeout=5.0)
+>>> future.result()
+{'title':'Crime and Punishment', ...}
+
+call() puts the request to the queue like any other msg, with reply_to naming
+the client's reply queue and a correlation_id unique to the call, and returns
+an amqpqueue.Future straight away, so any number of calls can be outstanding.
+Every reply comes back on the one exclusive queue the client declares when it
+is made; a background thread reads them and completes the matching futures.
+
+Workers answer from .endtask(), before acking the msg:
+
+    def endtask(self, msg, response):
+        self.reply(response.context['record'])
+        self.queue_stdin.task_done()
+
+A call made with a timeout fails with Error if no reply arrives in time, and
+the broker drops the request if no worker has taken it by then.
+"""
+
+import itertools
+import threading
+import time
+import uuid
+
+from amqpqueue import Producer, Consumer, Error, ConnectionLost, _pending, log
+from asyncqueue import Future
+
+class RemoteError(Error):
+    "The worker answering a call replied with an error"
+    pass
+
+class _Calls(object):
+    """The futures of a client's outstanding calls, by correlation id"""
+    def __init__(self, prefix, observe=None):
+        self.prefix = prefix
+        self.observe = observe
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        # correlation id -> (future, deadline, started)
+        self.futures = {}
+
+    def add(self, timeout=None):
+        started = time.time()
+        deadline = None
+        if timeout is not None:
+            deadline = started + timeout
+        future = Future()
+        self.lock.acquire()
+        try:
+            correlation_id = '%s.%d' % (self.prefix, self.ids.next())
+            self.futures[correlation_id] = (future, deadline, started)
+        finally:
+            self.lock.release()
+        return correlation_id, future
+
+    def _pop(self, correlation_id):
+        self.lock.acquire()
+        try:
+            return self.futures.pop(correlation_id, None)
+        finally:
+            self.lock.release()
+
+    def discard(self, correlation_id):
+        self._pop(correlation_id)
+
+    def complete(self, correlation_id, result=None, exception=None):
+        call = self._pop(correlation_id)
+        if call is None:
+            log.debug("Dropping reply to unknown or expired call %s" % correlation_id)
+            return
+        future, _, started = call
+        if self.observe is not None:
+            self.observe('call', started)
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def expire(self):
+        ''' Fail the calls whose timeout has passed '''
+        now = time.time()
+        self.lock.acquire()
+        try:
+            expired = [(correlation_id, call) for correlation_id, call in self.futures.items()
+                       if call[1] is not None and call[1] <= now]
+            for correlation_id, _ in expired:
+                del self.futures[correlation_id]
+        finally:
+            self.lock.release()
+        for correlation_id, (future, deadline, started) in expired:
+            future.set_exception(Error('No reply to %s within %.1fs' % (correlation_id,
+                                                                         deadline - started)))
+
+    def fail_all(self, exception):
+        self.lock.acquire()
+        try:
+            calls, self.futures = self.futures.values(), {}
+        finally:
+            self.lock.release()
+        for future, _, _ in calls:
+            future.set_exception(exception)
+
+    def __len__(self):
+        return len(self.futures)
+
+
+class _ReplyQueue(Consumer):
+    ''' The exclusive, auto-deleted queue an RpcClient's replies arrive on.
+    Replies need no ack; each one goes straight to the client. '''
+    def __init__(self, client, *args, **kwargs):
+        self.client = client
+        Consumer.__init__(self, *args, **kwargs)
+
+    def _setup(self):
+        self.ch.access_request('/data', active=True, read=True, write=False)
+        self._declare()
+        self.consumer_tag = self.ch.basic_consume(self.queue_name, no_ack=True,
+                                                  callback=self._amqp_callback)
+
+    def _declare(self):
+        # replies are sent through the default exchange, so no binding is needed
+        return self.ch.queue_declare(self.queue_name, passive=False, \
+                            durable=False, exclusive=True, auto_delete=True)
+
+    def _amqp_callback(self, msg):
+        self.client._reply(msg)
+
+
+class RpcClient(Producer):
+    '''
+    Producer whose call() puts a request and returns a Future for the reply.
+
+    Takes the same parameters as Producer, plus poll_interval, the longest
+    the reply thread waits before checking for expired calls (default 0.5s).
+    call() may be used from several threads at once. Replies are read on a
+    connection of the client's own, so pooled clients still open one.
+    '''
+    def __init__(self, *args, **kwargs):
+        self.poll_interval = kwargs.pop('poll_interval', 0.5)
+        Producer.__init__(self, *args, **kwargs)
+        self.lock = threading.Lock()
+        self.closed = False
+        self.failed = None
+        self.reply_queue_name = '%s.reply.%s' % (self.queue_name, uuid.uuid4().hex)
+        # round trips are timed as 'call', under the request queue's name
+        self.calls = _Calls(self.reply_queue_name, self._observe)
+        self.replies = _ReplyQueue(self, self.reply_queue_name, addr=self.addr,
+                                   userid=self.userid, password=self.password, ssl=self.ssl,
+                                   serializer=self.serializer, reconnect=self.reconnect,
+                                   reconnect_attempts=self.reconnect_attempts,
+                                   reconnect_delay=self.reconnect_delay,
+                                   reconnect_max_delay=self.reconnect_max_delay)
+        self._thread = threading.Thread(target=self._read)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def call(self, message, timeout=None, serializer=None, routing_key=None, headers=None):
+        ''' Put message as a request and return a Future for the reply. The
+        other parameters are as for put(), plus timeout (seconds). '''
+        if self.failed is not None:
+            raise ConnectionLost('Replies can no longer be received: %s' % self.failed)
+        started = time.time()
+        msg = self._message(message, serializer, headers)
+        correlation_id, future = self.calls.add(timeout)
+        msg.properties['reply_to'] = self.reply_queue_name
+        msg.properties['correlation_id'] = correlation_id
+        if timeout is not None:
+            # per-message TTL, so requests nobody took in time are dropped
+            msg.properties['expiration'] = str(int(timeout * 1000))
+        self.lock.acquire()
+        try:
+            try:
+                self._put(msg, routing_key, started)
+            except:
+                self.calls.discard(correlation_id)
+                raise
+        finally:
+            self.lock.release()
+        return future
+
+    def _reply(self, msg):
+        correlation_id = msg.properties.get('correlation_id')
+        try:
+            data = self.replies.decode(msg)
+        except Exception, e:
+            self.calls.complete(correlation_id, exception=e)
+            return
+        error = msg.properties.get('application_headers', {}).get('error')
+        if error is not None:
+            self.calls.complete(correlation_id, exception=RemoteError(error))
+        else:
+            self.calls.complete(correlation_id, data)
+
+    def _read(self):
+        replies = self.replies
+        while not self.closed:
+            try:
+                if _pending(replies.ch) or replies._call(replies._select, self.poll_interval):
+                    replies._call(replies._wait)
+            except Exception, e:
+                if not self.closed:
+                    log.exception("Lost the reply queue %s: %s" % (self.reply_queue_name, e))
+                    self.failed = e
+                    self.calls.fail_all(ConnectionLost('Lost the reply queue: %s' % e))
+                return
+            self.calls.expire()
+
+    def outstanding(self):
+        ''' How many calls are still waiting for a reply '''
+        return len(self.calls)
+
+    def close(self):
+        ''' Stop reading replies, failing any outstanding calls, and close
+        both connections '''
+        self.closed = True
+        self._thread.join()
+        self.calls.fail_all(Error('The RpcClient was closed'))
+        self.replies.close()
+        Producer.close(self)
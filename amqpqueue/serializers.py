@@ -0,0 +1,71 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Registry of the codecs used to turn queue items into message bodies.
+
+Each codec is recorded in the message's content_type, so a Consumer decodes
+whatever it receives with the right codec regardless of its own default.
+
+>>> register('upper', 'text/x-upper', lambda s: s.upper(), lambda s: s.lower())
+>>> get('upper').dumps('abc')
+'ABC'
+>>> for_content_type('text/x-upper').name
+'upper'
+"""
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+class Serializer(object):
+    def __init__(self, name, content_type, dumps, loads):
+        self.name = name
+        self.content_type = content_type
+        self.dumps = dumps
+        self.loads = loads
+
+    def __repr__(self):
+        return "<Serializer %s (%s)>" % (self.name, self.content_type)
+
+_by_name = {}
+_by_content_type = {}
+
+def register(name, content_type, dumps, loads):
+    """Add a codec (or replace one with the same name/content_type)"""
+    serializer = Serializer(name, content_type, dumps, loads)
+    _by_name[name] = serializer
+    _by_content_type[content_type] = serializer
+
+def get(serializer):
+    """Look up a codec by name or content_type. Serializer instances are
+    passed straight through."""
+    if isinstance(serializer, Serializer):
+        return serializer
+    if serializer in _by_name:
+        return _by_name[serializer]
+    if serializer in _by_content_type:
+        return _by_content_type[serializer]
+    raise KeyError("No serializer registered for '%s'" % serializer)
+
+def for_content_type(content_type, default=None):
+    """The codec for a received message, or default if the content_type is
+    missing or unknown."""
+    return _by_content_type.get(content_type, default)
+
+def _raw_dumps(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return str(s)
+
+def _raw_loads(s):
+    return s
+
+register('raw', 'application/octet-stream', _raw_dumps, _raw_loads)
+register('json', 'application/json', json.dumps, json.loads)
+register('pickle', 'text/x-python', lambda s: pickle.dumps(s, -1), pickle.loads)
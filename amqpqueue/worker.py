@@ -6,13 +6,26 @@ import simplejson
 
 # For the HTTPWorker
 from urllib import urlencode
-import httplib2
+from urlparse import urlsplit, urljoin
+import httplib
+import socket
 
 # For tempfile/ramfile handling:
-# Unicode is highly likely, therefore StringIO > cStringIO
-from StringIO import StringIO
-from tempfile import mkstemp
-from os import remove
+from tempfile import mkstemp, SpooledTemporaryFile
+from os import remove, fdopen, rename, makedirs
+import os.path
+from hashlib import sha1
+from time import sleep, time
+
+# For the WorkerPool/ProcessWorkerPool
+import threading
+from Queue import Queue, Empty
+import multiprocessing
+import signal
+import logging
+import sys
+
+log = logging.getLogger('amqpqueue.worker')
 
 STATUSES = {'FAIL':0,
             'COMPLETE':1,
@@ -31,14 +44,25 @@ class JsonMsgParseError(Exception):
     """JSON passed as a message over the queue couldn't be decoded."""
     pass
 
+def _set_retry(queue, context):
+    if context.get('retry', None) is not None and hasattr(queue, 'retry'):
+        queue.retry = context['retry']
+
+class TaskTimeout(Exception):
+    """.starttask() ran for longer than the worker's 'task_timeout'."""
+    pass
+
 class WorkerException(Exception):
     def __init__(self, response=None):
         self.response = response
     def __str__(self):
         if self.response:
-            resp_string = "Worker failed with a status: %s" % (STATUSES[self.response.status])
+            names = dict([(status, name) for name, status in STATUSES.items()])
+            resp_string = "Worker failed with a status: %s" % names.get(self.response.status,
+                                                                        self.response.status)
             if self.response.context:
                 resp_string += "\n Context: %s" % self.response.context
+            return resp_string
         else:
             return "Worker failed"
 
@@ -46,7 +70,7 @@ class Worker(object):
     def __init__(self, queue_stdin, queue_stdout=None, **kw):
         """Base class for all the workers.
         queue_stdin - the instance passed through queue_stdin should implement a 
-        blocking .get(), .task_done() and __len__().
+        Queue-like .get(block=True, timeout=None), .task_done() and __len__().
         queue_stdout - the instance passed should implement a blocking .put() and
         non-blocking __len__()
         Other keyword parameters can be passed to the workers as necessary.
@@ -58,30 +82,166 @@ class Worker(object):
         .task_done() on the queue "stdin".
         
         self.context is a dictionary of all other parameters passed to the worker.
+
+        If 'task_timeout' (seconds) is given, .starttask() is run under a watchdog;
+        when it overruns, the worker gives up on it and calls .task_timed_out(msg),
+        which returns the msg to queue_stdin, or passes it to 'timeout_queue' if
+        one was given. The hung call is abandoned in a daemon thread, where it
+        keeps running on the same worker instance while the next task starts,
+        so .starttask() must then be reentrant; .task_abandoned() is called to
+        let the worker drop state the hung call may still be using. At most
+        'max_abandoned' (default 8) hung calls are left running; beyond that
+        the worker waits for the oldest to finish before starting another.
+
+        .run() waits at most 'poll_interval' seconds (default 1) at a time for a
+        msg, so setting self.stop, or calling .drain(), takes effect promptly.
+
+        If 'metrics' (an amqpqueue.metrics.Metrics) is given, the time taken by
+        each .starttask() and .endtask() is recorded in it, as 'task' and
+        'endtask', under the worker's class name.
+
+        'retry', an amqpqueue.RetryPolicy, is set on queue_stdin, so msgs the
+        worker fails are retried after a delay and finally dead-lettered,
+        rather than redelivered straight away.
+
+        Msgs sent with an RpcClient's .call() are answered with .reply(data),
+        from .endtask(), before the msg is acked.
         """
         self.queue_stdin = queue_stdin
         self.queue_stdout = queue_stdout
         self.context = kw
         self.stop = False
+        # time by which a drain must be finished, once .drain() has been called
+        self.drain_deadline = None
+        self._cancelled = False
+        # threads still running a .starttask() that timed out
+        self._abandoned = []
+        _set_retry(queue_stdin, kw)
         if 'start' in kw:
             self.run()
     
     def parse_json_msg(self, msg, encoding="UTF-8"):
+        # Queues using the 'json' serializer hand over already decoded msgs
+        if not isinstance(msg, basestring):
+            return msg
         try:
             return simplejson.loads(msg,encoding=encoding)
         except:
             raise JsonMsgParseError
     
+    def drain(self, deadline=30.0):
+        """Stop consuming new msgs, finish the ones already delivered to this
+        worker within deadline seconds, then stop. Any left over are returned
+        to the queue by the broker once the queue is closed. May be called from
+        another thread (eg a signal handler) while .run() is going."""
+        self.drain_deadline = time() + deadline
+
+    def next_msg(self):
+        """The next msg from queue_stdin, or Empty if there is none yet (or any
+        more, when draining)."""
+        if self.drain_deadline is None:
+            return self.queue_stdin.get(timeout=self.context.get('poll_interval', 1.0))
+        if not self._cancelled:
+            # the queue is cancelled here, in the thread that reads from it
+            if hasattr(self.queue_stdin, 'cancel'):
+                self.queue_stdin.cancel()
+            self._cancelled = True
+        if time() > self.drain_deadline:
+            self.stop = True
+            raise Empty
+        try:
+            return self.queue_stdin.get(False)
+        except Empty:
+            self.stop = True
+            raise
+
+    def _observe(self, name, started):
+        metrics = self.context.get('metrics', None)
+        if metrics is not None:
+            metrics.observe(name, time() - started, self.__class__.__name__)
+
     def run(self):
         while (True):
-            # Blocking call:
             if self.stop:
                 break
-            msg = self.queue_stdin.get()
-            # TODO implement variable timeout on .starttask() method
-            resp = self.starttask(msg)
-            self.endtask(msg, resp)
-            
+            try:
+                msg = self.next_msg()
+            except Empty:
+                continue
+            try:
+                resp = self.run_starttask(msg)
+            except TaskTimeout:
+                self.task_timed_out(msg)
+                continue
+            self.run_endtask(msg, resp)
+
+    def run_endtask(self, msg, response):
+        started = time()
+        try:
+            self.endtask(msg, response)
+        finally:
+            self._observe('endtask', started)
+
+    def run_starttask(self, msg):
+        """Runs .starttask(msg), raising TaskTimeout if it takes longer than
+        the 'task_timeout' context parameter."""
+        started = time()
+        try:
+            return self._starttask(msg)
+        finally:
+            self._observe('task', started)
+
+    def _starttask(self, msg):
+        timeout = self.context.get('task_timeout', None)
+        if not timeout:
+            return self.starttask(msg)
+        self._abandoned = [task for task in self._abandoned if task.isAlive()]
+        if len(self._abandoned) >= self.context.get('max_abandoned', 8):
+            log.warning("%d timed out tasks still running; waiting for the oldest"
+                        % len(self._abandoned))
+            self._abandoned.pop(0).join()
+        result = {}
+        def watched():
+            try:
+                result['response'] = self.starttask(msg)
+            except:
+                result['error'] = sys.exc_info()
+        task = threading.Thread(target=watched)
+        task.setDaemon(True)
+        task.start()
+        task.join(timeout)
+        if task.isAlive():
+            self._abandoned.append(task)
+            self.task_abandoned()
+            raise TaskTimeout("starttask took more than %ss" % timeout)
+        if 'error' in result:
+            raise result['error'][0], result['error'][1], result['error'][2]
+        return result['response']
+
+    def reply(self, data, delivery_tag=None, serializer=None, error=None):
+        """Send data back to the caller of the msg in hand (see
+        amqpqueue.rpc). Returns False if the msg asked for no reply, or
+        queue_stdin can't send one."""
+        if not hasattr(self.queue_stdin, 'reply'):
+            return False
+        return self.queue_stdin.reply(data, delivery_tag, serializer, error)
+
+    def task_abandoned(self):
+        """Called when a timed out .starttask() is left running. Override to
+        drop anything the hung call may still be using (connections, say)."""
+        pass
+
+    def task_timed_out(self, msg):
+        """Called when .starttask() overran. Dead-letters the msg to the
+        'timeout_queue', if given, otherwise returns it to queue_stdin."""
+        log.warning("Task timed out after %ss" % self.context.get('task_timeout'))
+        timeout_queue = self.context.get('timeout_queue', None)
+        if timeout_queue is not None:
+            timeout_queue.put(msg)
+            self.queue_stdin.task_done()
+        else:
+            self.queue_stdin.task_failed()
+
     def starttask(self, msg):
         """Implements a basic 'echo' worker - pointless, but illustrative.
         This method should be overridden by a specific worker class."""
@@ -90,9 +250,9 @@ class Worker(object):
     def endtask(self, msg, response):
         """Simple task end, ack'ing the message consuming it on a COMPLETE response."""
         if response.status == FAIL:
-            raise WorkerException(resp)
+            raise WorkerException(response)
         elif response.status == COMPLETE:
-            if self.queue_stdout:
+            if self.queue_stdout is not None:
                 self.queue_stdout.put(msg)
             else:
                 # print msg
@@ -108,24 +268,689 @@ class JSONWorker(Worker):
             # Blocking call:
             if self.stop:
                 break
-            msg = self.queue_stdin.get()
-            # TODO implement variable timeout on .starttask() method
             try:
-                jmsg = simplejson.loads(msg)
-                resp = self.starttask(jmsg)
-                self.endtask(jmsg, resp)
+                msg = self.next_msg()
+            except Empty:
+                continue
+            try:
+                jmsg = self.parse_json_msg(msg)
+                resp = self.run_starttask(jmsg)
+                self.run_endtask(jmsg, resp)
+            except TaskTimeout:
+                self.task_timed_out(msg)
             except Exception, e:
                 print "Failed to parse\n%s" % msg
                 print e
-                if self.queue_stdout:
+                if self.queue_stdout is not None:
                     self.queue_stdout.put(msg)
                 # Actively consume bad messages
                 self.queue_stdin.task_done()
 
+class BatchWorker(Worker):
+    """Collects up to 'batch_size' msgs (default 100), or as many as arrive within
+    'batch_time' seconds of the first (default 1.0), and hands them to
+    .starttask_batch(msgs) in one go. .endtask_batch(msgs, response) then acks
+    the whole batch with a single cumulative ack, or rejects it on FAIL.
+
+    queue_stdin must be a Consumer whose prefetch_count is at least batch_size;
+    batches are capped at its prefetch window.
+
+    class SolrUploader(BatchWorker):
+        def starttask_batch(self, msgs):
+            self.context['solr'].add_many([...])
+            self.context['solr'].commit()
+            return WorkerResponse(COMPLETE)
+    """
+    def collect(self):
+        """Gets the next batch of msgs, leaving their delivery tags in self.batch_tags"""
+        size = min(self.context.get('batch_size', 100),
+                   getattr(self.queue_stdin, 'max_unacked', self.context.get('batch_size', 100)))
+        batch_time = self.context.get('batch_time', 1.0)
+        batch, self.batch_tags = [], []
+        deadline = None
+        while len(batch) < size and not self.stop:
+            try:
+                if deadline is None or self.drain_deadline is not None:
+                    msg = self.next_msg()
+                else:
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        break
+                    msg = self.queue_stdin.get(timeout=remaining)
+            except Empty:
+                continue
+            batch.append(msg)
+            self.batch_tags.append(self.queue_stdin.delivery_tag)
+            if deadline is None:
+                deadline = time() + batch_time
+        return batch
+
+    def run(self):
+        while (True):
+            if self.stop:
+                break
+            batch = self.collect()
+            if batch:
+                started = time()
+                try:
+                    resp = self.starttask_batch(batch)
+                finally:
+                    self._observe('task', started)
+                started = time()
+                try:
+                    self.endtask_batch(batch, resp)
+                finally:
+                    self._observe('endtask', started)
+
+    def starttask_batch(self, msgs):
+        """Should be overridden to process a whole batch of msgs at once."""
+        return WorkerResponse(COMPLETE)
+
+    def endtask_batch(self, msgs, response):
+        """Passes the msgs on to queue_stdout, if any, and acks the batch on a
+        COMPLETE response; rejects every msg in it otherwise."""
+        if response.status == COMPLETE:
+            if self.queue_stdout is not None:
+                for msg in msgs:
+                    self.queue_stdout.put(msg)
+            self.task_done_batch()
+        else:
+            self.task_failed_batch()
+
+    def task_done_batch(self):
+        """Acks the current batch with one cumulative ack"""
+        # tags from a MultiConsumer need not be in order
+        self.queue_stdin.task_done(upto=max(self.batch_tags))
+        self.batch_tags = []
+
+    def task_failed_batch(self):
+        """Returns every msg of the current batch to the queue"""
+        for delivery_tag in self.batch_tags:
+            self.queue_stdin.task_failed(delivery_tag)
+        self.batch_tags = []
+
+class _PoolStopped(Exception):
+    pass
+
+class _PooledQueue(object):
+    """The queue_stdin each worker in a WorkerPool sees. get() takes the next
+    message the pool has fetched; task_done/task_failed settle it on the pool's
+    real queue."""
+    def __init__(self, pool):
+        self.pool = pool
+        self.delivery_tag = None
+
+    def get(self, block=True, timeout=None):
+        if self.pool.drain_deadline is not None and time() > self.pool.drain_deadline:
+            raise _PoolStopped
+        item = self.pool.tasks.get(block, timeout)
+        if item is None:
+            raise _PoolStopped
+        msg, self.delivery_tag = item
+        return msg
+
+    def task_done(self):
+        # the msg is out of this worker's hands even if settling it fails
+        # (DeliveryLost), so it is never settled twice
+        delivery_tag, self.delivery_tag = self.delivery_tag, None
+        self.pool.settle(delivery_tag)
+
+    def task_failed(self):
+        delivery_tag, self.delivery_tag = self.delivery_tag, None
+        self.pool.settle(delivery_tag, failed=True)
+
+    def reply(self, data, delivery_tag=None, serializer=None, error=None):
+        if delivery_tag is None:
+            delivery_tag = self.delivery_tag
+        return self.pool.reply(data, delivery_tag, serializer, error)
+
+    def __len__(self):
+        # messages fetched and waiting for a free worker
+        return self.pool.tasks.qsize()
+
+class WorkerPool(object):
+    """Runs 'size' workers of the given class in threads, all fed from one
+    queue_stdin (and so one consumer and one connection).
+
+    A single feeder thread gets a message whenever a worker is idle and hands
+    it over; workers ack through the pool, which settles each message on the
+    real queue by its delivery tag. Give the consumer a prefetch_count of at
+    least 'size' to keep every worker busy:
+
+    >>> inbox = qf.Consumer("stdin", prefetch_count=5)
+    >>> pool = WorkerPool(echoWorker, inbox, size=5)
+    >>> pool.run()
+
+    Other keyword parameters are passed on to every worker, along with its
+    index as 'worker_id'.
+    """
+    def __init__(self, worker_class, queue_stdin, queue_stdout=None, size=4, **kw):
+        self._init_pool(queue_stdin, size, kw)
+        self.workers = []
+        for index in xrange(size):
+            context = kw.copy()
+            context['worker_id'] = index
+            self.workers.append(worker_class(_PooledQueue(self), queue_stdout, **context))
+        self.threads = []
+
+    def _init_pool(self, queue_stdin, size, kw):
+        """The feeding and settling state every kind of pool has"""
+        self.queue_stdin = queue_stdin
+        _set_retry(queue_stdin, kw)
+        self.size = size
+        self.stop = False
+        self.tasks = Queue()
+        self.lock = threading.Lock()
+        self.poll_interval = kw.get('poll_interval', 1.0)
+        self.drain_deadline = None
+        self._cancelled = False
+        # One slot per message a worker may hold; freed when it is settled
+        slots = min(size, getattr(queue_stdin, 'max_unacked', size))
+        self.slots = threading.Semaphore(slots)
+        if hasattr(queue_stdin, 'share_connection'):
+            # messages are settled from other threads while the feeder is
+            # blocked reading
+            queue_stdin.share_connection()
+
+    def _get(self, block=True, timeout=None):
+        """Gets (msg, delivery tag) from queue_stdin. Workers settle on other
+        threads, clearing queue_stdin.delivery_tag as they go, so the tag is
+        taken along with the msg where the queue allows it."""
+        if hasattr(self.queue_stdin, '_get'):
+            return self.queue_stdin._get(block, timeout)
+        msg = self.queue_stdin.get(block, timeout)
+        return msg, self.queue_stdin.delivery_tag
+
+    def _next_msg(self):
+        """As Worker.next_msg, but returning (msg, delivery tag), and raising
+        _PoolStopped once a drain is done"""
+        if self.drain_deadline is None:
+            return self._get(timeout=self.poll_interval)
+        if not self._cancelled:
+            if hasattr(self.queue_stdin, 'cancel'):
+                self.queue_stdin.cancel()
+            self._cancelled = True
+        if time() > self.drain_deadline:
+            raise _PoolStopped
+        try:
+            return self._get(False)
+        except Empty:
+            raise _PoolStopped
+
+    def _feed(self):
+        while not self.stop:
+            self.slots.acquire()
+            while not self.stop:
+                try:
+                    msg, delivery_tag = self._next_msg()
+                except Empty:
+                    continue
+                except _PoolStopped:
+                    self.shutdown()
+                    return
+                except Exception, e:
+                    log.exception("WorkerPool failed to get a message: %s" % e)
+                    self.shutdown()
+                    return
+                self.dispatch(msg, delivery_tag)
+                break
+
+    def dispatch(self, msg, delivery_tag):
+        self.tasks.put((msg, delivery_tag))
+
+    def _work(self, worker):
+        while not (self.stop or worker.stop):
+            try:
+                worker.run()
+            except _PoolStopped:
+                break
+            except Exception, e:
+                log.exception("Worker #%s failed: %s" % (worker.context['worker_id'], e))
+                if worker.queue_stdin.delivery_tag is not None:
+                    try:
+                        worker.queue_stdin.task_failed()
+                    except Exception, e:
+                        log.exception("Worker #%s could not reject its msg: %s"
+                                      % (worker.context['worker_id'], e))
+        if not [w for w in self.workers if not w.stop]:
+            self.shutdown()
+
+    def settle(self, delivery_tag, failed=False):
+        self.lock.acquire()
+        try:
+            if failed:
+                self.queue_stdin.task_failed(delivery_tag)
+            else:
+                self.queue_stdin.task_done(delivery_tag)
+        finally:
+            self.lock.release()
+            self.slots.release()
+
+    def reply(self, data, delivery_tag, serializer=None, error=None):
+        if not hasattr(self.queue_stdin, 'reply'):
+            return False
+        self.lock.acquire()
+        try:
+            return self.queue_stdin.reply(data, delivery_tag, serializer, error)
+        finally:
+            self.lock.release()
+
+    def start(self):
+        self.feeder = threading.Thread(target=self._feed)
+        # don't hold up the interpreter if the broker stops responding
+        self.feeder.setDaemon(True)
+        self.feeder.start()
+        for worker in self.workers:
+            thread = threading.Thread(target=self._work, args=(worker,))
+            thread.start()
+            self.threads.append(thread)
+
+    def drain(self, deadline=30.0):
+        """Stop consuming, let the workers finish the messages already delivered
+        within deadline seconds, then shut down."""
+        self.drain_deadline = time() + deadline
+
+    def shutdown(self):
+        """Stop handing out messages; each worker exits once it is idle"""
+        self.stop = True
+        for worker in self.workers:
+            self.tasks.put(None)
+        self.slots.release()
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+        # it notices the pool has stopped within poll_interval
+        self.feeder.join()
+
+    def run(self):
+        self.start()
+        self.join()
+
+# Set up in each ProcessWorkerPool process by _init_process_worker
+_process_worker = None
+# where a process notes (delivery tag, pid) as it starts on a task; sent
+# straight down a pipe, not through a Queue's feeder thread, so the note is
+# out even if the task then kills the process
+_process_started = None
+
+def _init_process_worker(worker_class, context, started, started_lock):
+    global _process_worker, _process_started
+    _process_worker = worker_class(None, None, **context)
+    _process_started = (started, started_lock)
+
+def _process_starttask(msg, delivery_tag):
+    started, started_lock = _process_started
+    started_lock.acquire()
+    try:
+        started.send((delivery_tag, os.getpid()))
+    finally:
+        started_lock.release()
+    try:
+        return _process_worker.starttask(msg)
+    except Exception, e:
+        return WorkerResponse(FAIL, exception=e)
+
+class _Task(object):
+    """A msg handed to the process pool, until its result is in"""
+    def __init__(self, msg, result):
+        self.msg = msg
+        self.result = result
+        self.dispatched = time()
+        # the process running it and since when, once it has started
+        self.pid = None
+        self.started = None
+
+class ProcessWorkerPool(WorkerPool):
+    """Runs .starttask() of a CPU-bound worker in a pool of 'size' processes,
+    while the consumer stays in this process. Results are passed back to the
+    worker's .endtask() here, which acks as usual.
+
+    worker_class must be importable by the child processes (ie defined at
+    module level), and the extra keyword parameters, which become the worker's
+    context in every process, must be picklable, as must messages and the
+    WorkerResponses from .starttask(); a response that can't be sent back
+    reaches .endtask() as a FAIL. 'metrics' and 'timeout_queue' stay in this
+    process, where 'task' times run from dispatch to result.
+
+    With 'task_timeout' set, a task still running that long after its process
+    started on it is given up on: the process is killed (the pool starts a
+    new one in its place) and the worker's .task_timed_out() is called with
+    the msg, as Worker does. Tasks waiting for a free process are not timed.
+
+    >>> inbox = qf.Consumer("images", prefetch_count=8)
+    >>> ProcessWorkerPool(ThumbnailWorker, inbox, size=8).run()
+    """
+    def __init__(self, worker_class, queue_stdin, queue_stdout=None, size=None, **kw):
+        if size is None:
+            size = multiprocessing.cpu_count()
+        # results are acked from the process pool's result thread
+        self._init_pool(queue_stdin, size, kw)
+        # runs .endtask() here in the parent
+        self.worker = worker_class(_PooledQueue(self), queue_stdout, **kw)
+        self.workers = [self.worker]
+        context = kw.copy()
+        context.pop('metrics', None)
+        context.pop('timeout_queue', None)
+        self.started, started = multiprocessing.Pipe(False)
+        self.processes = multiprocessing.Pool(size, _init_process_worker,
+                                              (worker_class, context, started,
+                                               multiprocessing.Lock()))
+        self.task_timeout = kw.get('task_timeout', None)
+        # delivery tag -> _Task, for every task dispatched and not yet finished
+        self.results = {}
+        self.results_lock = threading.Lock()
+        # results come back on the pool's result thread and failures on the
+        # watcher's; the worker in this process handles one at a time
+        self.endtask_lock = threading.Lock()
+        # set once a task is given up on, whose result the pool then never gets
+        self.abandoned = False
+
+    def _take_result(self, delivery_tag):
+        self.results_lock.acquire()
+        try:
+            return self.results.pop(delivery_tag, None)
+        finally:
+            self.results_lock.release()
+
+    def _finish(self, delivery_tag, response):
+        # Called in the pool's result thread, one result at a time
+        task = self._take_result(delivery_tag)
+        if task is None:
+            log.warning("Dropping the late result of a task already given up on")
+            return
+        self._endtask(delivery_tag, task, response)
+
+    def _endtask(self, delivery_tag, task, response):
+        self.endtask_lock.acquire()
+        try:
+            self.worker._observe('task', task.dispatched)
+            queue = self.worker.queue_stdin
+            queue.delivery_tag = delivery_tag
+            try:
+                self.worker.run_endtask(task.msg, response)
+            except Exception, e:
+                log.exception("endtask failed: %s" % e)
+                if queue.delivery_tag is not None:
+                    queue.task_failed()
+        finally:
+            self.endtask_lock.release()
+        if self.worker.stop:
+            self.shutdown()
+
+    def dispatch(self, msg, delivery_tag):
+        callback = lambda response: self._finish(delivery_tag, response)
+        self.results_lock.acquire()
+        try:
+            result = self.processes.apply_async(_process_starttask, (msg, delivery_tag),
+                                                callback=callback)
+            self.results[delivery_tag] = _Task(msg, result)
+        finally:
+            self.results_lock.release()
+
+    def _note_started(self, timeout):
+        """Record which process has started on which task, waiting up to
+        timeout seconds for the first note"""
+        notes = []
+        if self.started.poll(timeout):
+            while self.started.poll():
+                notes.append(self.started.recv())
+        now = time()
+        self.results_lock.acquire()
+        try:
+            for delivery_tag, pid in notes:
+                task = self.results.get(delivery_tag)
+                if task is not None and task.pid is None:
+                    task.pid, task.started = pid, now
+        finally:
+            self.results_lock.release()
+
+    def _lost_results(self):
+        """The tasks which failed without calling back (eg a response that
+        couldn't be sent back), and those which have run past 'task_timeout'"""
+        now = time()
+        failed, hung = [], []
+        self.results_lock.acquire()
+        try:
+            for delivery_tag, task in self.results.items():
+                if task.result.ready() and not task.result.successful():
+                    failed.append((delivery_tag, task))
+                elif self.task_timeout and task.started is not None \
+                        and now - task.started > self.task_timeout:
+                    hung.append((delivery_tag, task))
+                else:
+                    continue
+                del self.results[delivery_tag]
+        finally:
+            self.results_lock.release()
+        return failed, hung
+
+    def _watch(self):
+        while not self.stop or self.results:
+            self._note_started(0.5)
+            failed, hung = self._lost_results()
+            for delivery_tag, task in failed:
+                try:
+                    task.result.get(0)
+                except Exception, e:
+                    log.error("Task for msg %s failed in its process: %s" % (delivery_tag, e))
+                    self._endtask(delivery_tag, task, WorkerResponse(FAIL, exception=e))
+            for delivery_tag, task in hung:
+                self.abandoned = True
+                log.error("Killing process %s, still on msg %s after %ss"
+                          % (task.pid, delivery_tag, self.task_timeout))
+                try:
+                    os.kill(task.pid, signal.SIGTERM)
+                except OSError:
+                    pass
+                self.endtask_lock.acquire()
+                try:
+                    self.worker.queue_stdin.delivery_tag = delivery_tag
+                    try:
+                        self.worker.task_timed_out(task.msg)
+                    except Exception, e:
+                        log.exception("Could not give up on msg %s: %s" % (delivery_tag, e))
+                finally:
+                    self.endtask_lock.release()
+
+    def start(self):
+        self.feeder = threading.Thread(target=self._feed)
+        self.feeder.setDaemon(True)
+        self.feeder.start()
+        self.watcher = threading.Thread(target=self._watch)
+        self.watcher.setDaemon(True)
+        self.watcher.start()
+
+    def shutdown(self):
+        """Stop handing out messages; tasks already running are finished"""
+        self.stop = True
+        self.slots.release()
+
+    def join(self):
+        while not self.stop:
+            sleep(0.5)
+        self.feeder.join()
+        # every task has either called back or been given up on
+        self.watcher.join()
+        if self.abandoned:
+            # the pool would wait forever for the killed tasks' results
+            self.processes.terminate()
+        else:
+            self.processes.close()
+        self.processes.join()
+
 class WorkerFactory(object):
     def get(config):
         pass
 
+class HostLimits(object):
+    """Caps the number of concurrent requests to each host, across all the
+    HTTPWorkers sharing this instance."""
+    def __init__(self, per_host=2):
+        self.per_host = per_host
+        self.lock = threading.Lock()
+        self.semaphores = {}
+
+    def acquire(self, host):
+        self.lock.acquire()
+        try:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.Semaphore(self.per_host)
+            semaphore = self.semaphores[host]
+        finally:
+            self.lock.release()
+        semaphore.acquire()
+
+    def release(self, host):
+        self.semaphores[host].release()
+
+class ResponseCache(object):
+    """On-disk LRU cache of HTTP response bodies for HTTPWorker, keyed by URL.
+
+    Responses carrying an ETag or Last-Modified header are kept in 'directory'.
+    Later requests for the same URL are made conditional, and on a 304 the body
+    is served from disk. Once the cache holds more than max_bytes, the least
+    recently used entries are evicted. Share one instance between workers (eg
+    those of a WorkerPool) rather than pointing several at the same directory.
+    """
+    def __init__(self, directory, max_bytes=104857600, chunk_size=65536):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if not os.path.isdir(directory):
+            makedirs(directory)
+        self.index_path = os.path.join(directory, 'index.json')
+        # url -> {'file', 'etag', 'last_modified', 'size', 'used'}
+        self.index = {}
+        if os.path.exists(self.index_path):
+            f = open(self.index_path)
+            try:
+                self.index = simplejson.load(f)
+            except ValueError:
+                log.warning("Ignoring unreadable cache index %s" % self.index_path)
+            f.close()
+
+    def size(self):
+        self.lock.acquire()
+        try:
+            return self._size()
+        finally:
+            self.lock.release()
+
+    def _size(self):
+        # called with self.lock held
+        return sum([entry['size'] for entry in self.index.values()])
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            return {'hits':self.hits, 'misses':self.misses, 'evictions':self.evictions,
+                    'entries':len(self.index), 'bytes':self._size()}
+        finally:
+            self.lock.release()
+
+    def validators(self, url):
+        """Conditional request headers for url, if it is cached"""
+        headers = {}
+        self.lock.acquire()
+        try:
+            entry = self.index.get(url)
+            if entry:
+                if entry['etag']:
+                    headers['If-None-Match'] = entry['etag']
+                if entry['last_modified']:
+                    headers['If-Modified-Since'] = entry['last_modified']
+        finally:
+            self.lock.release()
+        return headers
+
+    def _copy(self, src, dest):
+        while True:
+            chunk = src.read(self.chunk_size)
+            if not chunk:
+                break
+            dest.write(chunk)
+
+    def load(self, url, fd):
+        """Copy the cached body of url into fd. False if it is not cached."""
+        self.lock.acquire()
+        try:
+            entry = self.index.get(url)
+            if not entry:
+                return False
+            try:
+                cached = open(os.path.join(self.directory, entry['file']), 'rb')
+            except IOError:
+                del self.index[url]
+                return False
+            entry['used'] = time()
+            self.hits += 1
+        finally:
+            self.lock.release()
+        try:
+            self._copy(cached, fd)
+        finally:
+            cached.close()
+        fd.seek(0)
+        return True
+
+    def store(self, url, fd, resp):
+        """Cache the body in fd (left rewound) if resp has validators"""
+        self.lock.acquire()
+        try:
+            self.misses += 1
+        finally:
+            self.lock.release()
+        etag = resp.getheader('etag')
+        last_modified = resp.getheader('last-modified')
+        if not (etag or last_modified) or 'no-store' in (resp.getheader('cache-control') or ''):
+            return
+        name = sha1(url).hexdigest()
+        (handle, tmp_name) = mkstemp(dir=self.directory)
+        cached = fdopen(handle, 'wb')
+        try:
+            self._copy(fd, cached)
+            size = cached.tell()
+        finally:
+            cached.close()
+            fd.seek(0)
+        if size > self.max_bytes:
+            remove(tmp_name)
+            return
+        self.lock.acquire()
+        try:
+            rename(tmp_name, os.path.join(self.directory, name))
+            self.index[url] = {'file':name, 'etag':etag, 'last_modified':last_modified,
+                               'size':size, 'used':time()}
+            self._evict()
+            self._save()
+        finally:
+            self.lock.release()
+
+    def _evict(self):
+        total = self._size()
+        by_age = sorted(self.index.items(), key=lambda item: item[1]['used'])
+        while total > self.max_bytes and by_age:
+            url, entry = by_age.pop(0)
+            try:
+                remove(os.path.join(self.directory, entry['file']))
+            except OSError:
+                pass
+            del self.index[url]
+            total -= entry['size']
+            self.evictions += 1
+
+    def _save(self):
+        tmp_name = self.index_path + '.tmp'
+        f = open(tmp_name, 'w')
+        simplejson.dump(self.index, f)
+        f.close()
+        rename(tmp_name, self.index_path)
+
 class HTTPWorker(Worker):
     """Gets a local copy of the resource at the URL in the JSON msg ('url') and simply
     prints the first "line".
@@ -154,31 +979,162 @@ class HTTPWorker(Worker):
     
     Requires configuration parameters:
         http_template = template for the URL to GET
+
+    Responses are streamed into the temp/ramfile in 'chunk_size' pieces (default
+    64KB). A ramfile spills over to disk once it passes 'spill_threshold' bytes
+    (default 1MB), so large downloads do not have to fit in memory. Connections
+    are kept alive and reused for later requests to the same host; socket
+    operations on them time out after 'http_timeout' seconds (default 60), and
+    they are all closed when a fetch overruns 'task_timeout'. The HTTP status
+    and headers are passed on in response.context['http_status'] and ['headers'].
+
+    Pass 'cache' (a ResponseCache) or 'cache_dir' (and optionally 'cache_size' in
+    bytes) to make repeat requests conditional and serve 304s from disk; such
+    responses have response.context['cached'] set.
+
+    To keep several fetches in flight from one consumer, use HTTPWorker.concurrent(),
+    which runs a pool of these workers with a cap on requests per host.
+        """
+    setup = False
+
+    def concurrent(cls, queue_stdin, queue_stdout=None, concurrency=8, per_host=2, **kw):
+        """A WorkerPool of 'concurrency' workers of this class sharing queue_stdin,
+        so that many fetches are in flight at once, each acked on its own when it
+        completes. At most per_host requests go to any one host at a time. A
+        'cache_dir' is turned into one ResponseCache shared by the workers.
+
+        >>> inbox = qf.Consumer("urls", prefetch_count=16)
+        >>> HTTPWorker.concurrent(inbox, concurrency=16, per_host=4).run()
         """
+        kw['host_limits'] = HostLimits(per_host)
+        if kw.get('cache_dir', None) and kw.get('cache', None) is None:
+            kw['cache'] = ResponseCache(kw['cache_dir'], kw.get('cache_size', 104857600))
+        return WorkerPool(cls, queue_stdin, queue_stdout, size=concurrency, **kw)
+    concurrent = classmethod(concurrent)
+
     def _get_tempfile(self):
-        return mkstemp()
+        (handle, name) = mkstemp()
+        return (fdopen(handle, 'w+b'), name)
     
     def _get_ramfile(self):
-        return (StringIO(), None)
+        return (SpooledTemporaryFile(max_size=self.spill_threshold), None)
     
     def httpsetup(self):
         self.http_template = self.context.get('http_template', None)
-        self.h = httplib2.Http()
         self.method = self.context.get('method', 'GET')
         self.data_method = self.context.get('method', 'GETURL')
+        self.chunk_size = self.context.get('chunk_size', 65536)
+        self.spill_threshold = self.context.get('spill_threshold', 1048576)
+        self.max_redirects = self.context.get('max_redirects', 5)
+        self.http_timeout = self.context.get('http_timeout', 60)
+        self.host_limits = self.context.get('host_limits', None)
+        self.cache = self.context.get('cache', None)
+        if self.cache is None and self.context.get('cache_dir', None):
+            self.cache = ResponseCache(self.context['cache_dir'],
+                                       self.context.get('cache_size', 104857600))
+        # (scheme, host:port) -> kept-alive httplib connection
+        self.connections = {}
         if self.context.get('tempfile', False):
             self.tempfile = self._get_tempfile
         else:
             self.tempfile = self._get_ramfile
             
         self.setup = True
+
+    def _connection(self, scheme, netloc):
+        key = (scheme, netloc)
+        if key not in self.connections:
+            if scheme == 'https':
+                self.connections[key] = httplib.HTTPSConnection(netloc, timeout=self.http_timeout)
+            else:
+                self.connections[key] = httplib.HTTPConnection(netloc, timeout=self.http_timeout)
+        return self.connections[key]
+
+    def _request(self, url, headers):
+        """Send the request over a kept-alive connection, reconnecting once if
+        the server has closed it in the meantime."""
+        scheme, netloc, path, query, _ = urlsplit(url)
+        if query:
+            path = "%s?%s" % (path, query)
+        for attempt in (0, 1):
+            conn = self._connection(scheme, netloc)
+            try:
+                conn.request(self.method, path or '/', headers=headers)
+                return conn, conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if self.connections.get((scheme, netloc)) is not conn:
+                    # dropped by .task_abandoned(): this fetch has timed out
+                    raise
+                del self.connections[(scheme, netloc)]
+                if attempt:
+                    raise
+
+    def fetch(self, url, fd, headers=None):
+        """Streams the resource at url into the file fd, following redirects.
+        Returns the final (httplib response, url)."""
+        for redirect in xrange(self.max_redirects + 1):
+            host = urlsplit(url)[1]
+            if self.host_limits is not None:
+                self.host_limits.acquire(host)
+            try:
+                conn, resp = self._request(url, headers or {})
+                if resp.status in (301, 302, 303, 307) and resp.getheader('location'):
+                    resp.read()
+                    url = urljoin(url, resp.getheader('location'))
+                    continue
+                while True:
+                    chunk = resp.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    fd.write(chunk)
+                if resp.will_close:
+                    conn.close()
+            finally:
+                if self.host_limits is not None:
+                    self.host_limits.release(host)
+            fd.seek(0)
+            return resp, url
+        raise Exception("More than %s redirects" % self.max_redirects)
+
+    def task_abandoned(self):
+        """A fetch timed out: close every kept-alive connection, which also
+        breaks the hung fetch out of its read (freeing its host_limits slot),
+        and start afresh, so the next fetch can't share a connection with it."""
+        connections, self.connections = self.connections, {}
+        for conn in connections.values():
+            try:
+                if conn.sock is not None:
+                    # close() alone would not wake a thread blocked reading it
+                    conn.sock.shutdown(socket.SHUT_RDWR)
+                conn.close()
+            except Exception:
+                pass
+
+    def cached_fetch(self, url, fd, headers=None):
+        """As .fetch(), but through the response cache if there is one.
+        Returns (http status, headers, final url, served from cache?)"""
+        headers = dict(headers or {})
+        if self.cache is not None:
+            headers.update(self.cache.validators(url))
+        resp, final_url = self.fetch(url, fd, headers)
+        if self.cache is not None:
+            if resp.status == 304:
+                if self.cache.load(url, fd):
+                    return 200, dict(resp.getheaders()), final_url, True
+                # evicted in the meantime, so ask again unconditionally
+                for header in ('If-None-Match', 'If-Modified-Since'):
+                    headers.pop(header, None)
+                resp, final_url = self.fetch(url, fd, headers)
+            if resp.status == 200:
+                self.cache.store(url, fd, resp)
+        return resp.status, dict(resp.getheaders()), final_url, False
     
     def starttask(self, msg):
         """This will very simply GET the url supplied and pass the temp/ramfile to endtask"""
         try:
             if not self.setup:
                 self.httpsetup()
-            (fd, name) = self.tempfile()
             jmsg = self.parse_json_msg(msg)
             # Prepare HTTP request
             headers = {}
@@ -193,9 +1149,16 @@ class HTTPWorker(Worker):
                return WorkerResponse(FAIL)
             if not url:
                 raise Exception("url not supplied")
-            fd.write(h.request(jmsg['url'], "GET", headers=headers))
-            fd.seek(0)
-            return WorkerResponse(COMPLETE, fd=fd, tempfile=name, jmsg=jmsg, url=url)
+            (fd, name) = self.tempfile()
+            try:
+                status, resp_headers, url, cached = self.cached_fetch(url, fd, headers)
+            except:
+                fd.close()
+                if name:
+                    remove(name)
+                raise
+            return WorkerResponse(COMPLETE, fd=fd, tempfile=name, jmsg=jmsg, url=url,
+                                  http_status=status, headers=resp_headers, cached=cached)
         except Exception, e:
             return WorkerResponse(FAIL, exception = e)
 
@@ -204,7 +1167,7 @@ class HTTPWorker(Worker):
         the reponse.context['fd'] (file-handle) and deletes/removes the file."""
         try:
             first_bit = response.context['fd'].read(100)
-            if self.queue_stdout:
+            if self.queue_stdout is not None:
                 self.queue_stdout.put(first_bit)
             else:
                 print "From url: %s, first 100 chars: \n %s" % (response.context['url'], first_bit)
@@ -12,6 +12,6 @@ from the PyWorker class
       maintainer="Ben O'Steen",
       maintainer_email="bosteen@gmail.com",
       packages=find_packages(),
-      install_requires=['amqplib', 'simplejson', 'httplib2'],
+      install_requires=['amqplib', 'simplejson'],
       )
 
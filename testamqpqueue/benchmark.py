@@ -0,0 +1,647 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Benchmarks the Producer, Consumer, Subscriber and Worker hot paths against an
+in-process stand-in for the broker, so no RabbitMQ (or network) is needed and
+the numbers are repeatable from run to run.
+
+The stand-in replaces amqplib's Connection. Publishes still go through
+amqplib's method and frame encoding, and are parsed back out of the frames by
+the stand-in, which routes them (direct, fanout and topic exchanges, and the
+default exchange), honours basic.qos (global, and per consumer approximated per channel),
+channel.flow, tx and ack/reject, and delivers to consumers as amqplib would. Frame decoding on the consumer side is not included.
+
+The 'memory' benchmark runs the same kind of traffic through the in-process
+backend (QueueFactory(backend='memory')) for comparison.
+
+    python benchmark.py                  # everything, 10000 msgs of ~256 bytes
+    python benchmark.py -n 50000 -s 4096 publish latency
+"""
+
+import sys
+import os
+import socket
+import threading
+import random
+import string
+from time import time
+from struct import pack, unpack
+from collections import deque
+from Queue import Queue
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import amqplib.client_0_8 as amqp
+from amqplib.client_0_8.method_framing import MethodWriter
+from amqplib.client_0_8.serialization import AMQPReader
+
+import amqpqueue.amqpqueue
+from amqpqueue import Producer, Consumer, Subscriber, QueueFactory, MemoryBroker, serializers
+from amqpqueue.amqpqueue import COMPRESSIONS, _WaitTimeout
+from amqpqueue.memory import topic_matches
+from amqpqueue.metrics import Metrics
+from amqpqueue.worker import Worker, WorkerResponse, COMPLETE
+
+
+class _Queue(object):
+    def __init__(self, name):
+        self.name = name
+        self.messages = deque()
+        # [channel, consumer_tag], delivered to in turn
+        self.consumers = []
+
+class StandInBroker(object):
+    """Exchanges, queues and deliveries held in memory. install() puts it in
+    place of amqplib's Connection for amqpqueue."""
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.exchanges = {'':'direct'}
+        # exchange -> [(routing key, queue name)]
+        self.bindings = {}
+        self.queues = {}
+        self._original = None
+
+    def install(self):
+        self._original = amqpqueue.amqpqueue.amqp.Connection
+        amqpqueue.amqpqueue.amqp.Connection = self.connect
+
+    def uninstall(self):
+        amqpqueue.amqpqueue.amqp.Connection = self._original
+
+    def connect(self, host='localhost', userid='guest', password='guest', ssl=False, **kw):
+        return _StandInConnection(self)
+
+    def queue(self, name):
+        queue = self.queues.get(name)
+        if queue is None:
+            queue = self.queues[name] = _Queue(name)
+        return queue
+
+    def route(self, exchange, routing_key, msg):
+        """Called with self.cond held"""
+        if exchange == '':
+            names = [routing_key]
+        elif self.exchanges.get(exchange) == 'fanout':
+            names = [name for key, name in self.bindings.get(exchange, [])]
+        elif self.exchanges.get(exchange) == 'topic':
+            names = [name for key, name in self.bindings.get(exchange, [])
+                     if topic_matches(key, routing_key)]
+        else:
+            names = [name for key, name in self.bindings.get(exchange, []) if key == routing_key]
+        for name in names:
+            if name in self.queues:
+                self.queues[name].messages.append((msg, False))
+                self.dispatch(self.queues[name])
+
+    def dispatch(self, queue):
+        """Pushes queued messages to consumers with room for them. Called with
+        self.cond held."""
+        consumers = queue.consumers
+        while queue.messages and consumers:
+            for i in xrange(len(consumers)):
+                ch, consumer_tag = consumers[0]
+                consumers.append(consumers.pop(0))
+                if ch.has_room():
+                    break
+            else:
+                return
+            msg, redelivered = queue.messages.popleft()
+            ch.deliver(queue, consumer_tag, msg, redelivered)
+
+
+class _StandInTransport(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self._buffer = ''
+        # channel -> [exchange, routing key, msg, body parts, received, body size]
+        self.partial = {}
+        # readable whenever a channel of this connection has deliveries waiting
+        self.sock, self.wake = socket.socketpair()
+        self.sock.setblocking(0)
+
+    def write_frame(self, frame_type, channel, payload):
+        size = len(payload)
+        self._write(pack('>BHI%dsB' % size, frame_type, channel, size, payload, 0xce))
+
+    def _write(self, data):
+        data = self._buffer + data
+        offset = 0
+        while len(data) - offset >= 7:
+            frame_type, channel, size = unpack('>BHI', data[offset:offset + 7])
+            if len(data) - offset < size + 8:
+                break
+            self._frame(frame_type, channel, data[offset + 7:offset + 7 + size])
+            offset += size + 8
+        self._buffer = data[offset:]
+
+    def _frame(self, frame_type, channel, payload):
+        if frame_type == 1:
+            if unpack('>HH', payload[:4]) == (60, 40):
+                args = AMQPReader(payload[4:])
+                args.read_short()
+                exchange = args.read_shortstr()
+                routing_key = args.read_shortstr()
+                self.partial[channel] = [exchange, routing_key, None, [], 0, 0]
+        elif frame_type == 2:
+            partial = self.partial[channel]
+            partial[5] = unpack('>HHQ', payload[:12])[2]
+            partial[2] = amqp.Message()
+            partial[2]._load_properties(payload[12:])
+            if not partial[5]:
+                self._published(channel)
+        elif frame_type == 3:
+            partial = self.partial[channel]
+            partial[3].append(payload)
+            partial[4] += len(payload)
+            if partial[4] >= partial[5]:
+                self._published(channel)
+
+    def _published(self, channel):
+        exchange, routing_key, msg, parts, _, _ = self.partial.pop(channel)
+        msg.body = ''.join(parts)
+        self.conn.channels[channel].published(exchange, routing_key, msg)
+
+    def close(self):
+        self.sock.close()
+        self.wake.close()
+
+
+class _NoMethodReader(object):
+    def __init__(self):
+        self.queue = Queue()
+
+class _StandInConnection(object):
+    def __init__(self, broker):
+        self.broker = broker
+        self.transport = _StandInTransport(self)
+        self.frame_max = 131072
+        self.method_writer = MethodWriter(self.transport, self.frame_max)
+        # nothing is ever read off the wire; amqpqueue's _pending() looks here
+        self.method_reader = _NoMethodReader()
+        self.channels = {}
+
+    def channel(self):
+        ch = _StandInChannel(self, len(self.channels) + 1)
+        self.channels[ch.channel_id] = ch
+        return ch
+
+    def close(self):
+        for ch in self.channels.values():
+            ch.close()
+        self.transport.close()
+
+
+class _StandInChannel(object):
+    default_ticket = 0
+
+    def __init__(self, connection, channel_id):
+        self.connection = connection
+        self.broker = connection.broker
+        self.channel_id = channel_id
+        # deliveries not yet handed to a consumer callback; amqpqueue's
+        # _pending() looks here before select()ing on the socket
+        self.method_queue = deque()
+        self.callbacks = {}
+        # delivery tag -> (queue, msg)
+        self.unacked = {}
+        self.next_tag = 1
+        self.prefetch_count = 0
+        self.global_prefetch_count = 0
+        self.active = True
+        self.tx = None
+
+    def _send_method(self, method_sig, args='', content=None):
+        if not isinstance(args, str):
+            args = args.getvalue()
+        self.connection.method_writer.write_method(self.channel_id, method_sig, args, content)
+
+    basic_publish = amqp.Channel.basic_publish.im_func
+
+    def published(self, exchange, routing_key, msg):
+        self.broker.cond.acquire()
+        try:
+            if self.tx is not None:
+                self.tx.append((exchange, routing_key, msg))
+            else:
+                self.broker.route(exchange, routing_key, msg)
+        finally:
+            self.broker.cond.release()
+
+    def has_room(self):
+        return self.active and \
+               (not self.prefetch_count or len(self.unacked) < self.prefetch_count) and \
+               (not self.global_prefetch_count or len(self.unacked) < self.global_prefetch_count)
+
+    def deliver(self, queue, consumer_tag, msg, redelivered):
+        """Called with the broker's cond held"""
+        tag = self.next_tag
+        self.next_tag += 1
+        self.unacked[tag] = (queue, msg)
+        delivered = amqp.Message(msg.body, **msg.properties)
+        delivered.delivery_info = {'consumer_tag':consumer_tag,
+                                   'delivery_tag':tag,
+                                   'redelivered':redelivered,
+                                   'exchange':'',
+                                   'routing_key':queue.name}
+        if not self.method_queue:
+            self.connection.transport.wake.send('x')
+        self.method_queue.append(delivered)
+        self.broker.cond.notifyAll()
+
+    def wait(self):
+        broker = self.broker
+        # honours the deadline a consumer sets on a shared connection
+        deadlines = getattr(self.connection, '_deadlines', None)
+        deadline = getattr(deadlines, 'deadline', None)
+        broker.cond.acquire()
+        try:
+            while not self.method_queue:
+                if deadline is None:
+                    broker.cond.wait()
+                elif deadline <= time():
+                    raise _WaitTimeout
+                else:
+                    broker.cond.wait(deadline - time())
+            msg = self.method_queue.popleft()
+            if not self.method_queue:
+                try:
+                    self.connection.transport.sock.recv(4096)
+                except socket.error:
+                    pass
+        finally:
+            broker.cond.release()
+        # as amqplib does, deliveries for a cancelled consumer are dropped
+        callback = self.callbacks.get(msg.delivery_info['consumer_tag'])
+        if callback is not None:
+            callback(msg)
+
+    def _settle(self, tags, requeue):
+        broker = self.broker
+        broker.cond.acquire()
+        try:
+            queues = {}
+            # requeued messages go back to the head in their original order
+            for tag in reversed(tags):
+                queue, msg = self.unacked.pop(tag)
+                if requeue:
+                    queue.messages.appendleft((msg, True))
+                queues[queue.name] = queue
+            for queue in queues.values():
+                broker.dispatch(queue)
+            for queue in broker.queues.values():
+                if queue.name not in queues:
+                    broker.dispatch(queue)
+        finally:
+            broker.cond.release()
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        if multiple:
+            self._settle(sorted([tag for tag in self.unacked if tag <= delivery_tag]), False)
+        else:
+            self._settle([delivery_tag], False)
+
+    def basic_reject(self, delivery_tag, requeue):
+        self._settle([delivery_tag], requeue)
+
+    def basic_qos(self, prefetch_size, prefetch_count, a_global):
+        self.broker.cond.acquire()
+        try:
+            if a_global:
+                self.global_prefetch_count = prefetch_count
+            else:
+                self.prefetch_count = prefetch_count
+            for queue in self.broker.queues.values():
+                self.broker.dispatch(queue)
+        finally:
+            self.broker.cond.release()
+
+    def basic_consume(self, queue='', consumer_tag='', no_local=False, no_ack=False,
+                      exclusive=False, nowait=False, callback=None, ticket=None):
+        broker = self.broker
+        broker.cond.acquire()
+        try:
+            consumer_tag = consumer_tag or 'standin.%d.%d' % (id(self), len(self.callbacks) + 1)
+            self.callbacks[consumer_tag] = callback
+            broker.queue(queue).consumers.append([self, consumer_tag])
+            broker.dispatch(broker.queue(queue))
+        finally:
+            broker.cond.release()
+        return consumer_tag
+
+    def basic_cancel(self, consumer_tag, nowait=False):
+        broker = self.broker
+        broker.cond.acquire()
+        try:
+            for queue in broker.queues.values():
+                queue.consumers = [c for c in queue.consumers if c != [self, consumer_tag]]
+            self.callbacks.pop(consumer_tag, None)
+        finally:
+            broker.cond.release()
+
+    def flow(self, active):
+        self.broker.cond.acquire()
+        try:
+            self.active = active
+            for queue in self.broker.queues.values():
+                self.broker.dispatch(queue)
+        finally:
+            self.broker.cond.release()
+
+    def access_request(self, realm, exclusive=False, passive=False, active=False,
+                       write=False, read=False):
+        return self.default_ticket
+
+    def exchange_declare(self, exchange, type, passive=False, durable=False,
+                         auto_delete=True, internal=False, nowait=False, arguments=None,
+                         ticket=None):
+        self.broker.exchanges.setdefault(exchange, type)
+
+    def queue_declare(self, queue='', passive=False, durable=False, exclusive=False,
+                      auto_delete=True, nowait=False, arguments=None, ticket=None):
+        broker = self.broker
+        broker.cond.acquire()
+        try:
+            declared = broker.queue(queue)
+            return queue, len(declared.messages), len(declared.consumers)
+        finally:
+            broker.cond.release()
+
+    def queue_bind(self, queue, exchange, routing_key='', nowait=False, arguments=None,
+                   ticket=None):
+        bindings = self.broker.bindings.setdefault(exchange, [])
+        if (routing_key, queue) not in bindings:
+            bindings.append((routing_key, queue))
+
+    def queue_delete(self, queue='', if_unused=False, if_empty=False, nowait=False,
+                     ticket=None):
+        broker = self.broker
+        broker.cond.acquire()
+        try:
+            broker.queues.pop(queue, None)
+            for exchange, bindings in broker.bindings.items():
+                broker.bindings[exchange] = [b for b in bindings if b[1] != queue]
+        finally:
+            broker.cond.release()
+
+    def tx_select(self):
+        self.tx = []
+
+    def tx_commit(self):
+        self.broker.cond.acquire()
+        try:
+            for exchange, routing_key, msg in self.tx:
+                self.broker.route(exchange, routing_key, msg)
+            self.tx = []
+        finally:
+            self.broker.cond.release()
+
+    def tx_rollback(self):
+        self.tx = []
+
+    def close(self):
+        broker = self.broker
+        broker.cond.acquire()
+        try:
+            for consumer_tag in self.callbacks.keys():
+                self.basic_cancel(consumer_tag)
+            self.callbacks = {}
+            self._settle(sorted(self.unacked), True)
+            self.method_queue.clear()
+        finally:
+            broker.cond.release()
+
+
+def make_payload(size, seed=0):
+    """A dict of roughly 'size' bytes, the same every run"""
+    rnd = random.Random(seed)
+    letters = string.ascii_letters + string.digits
+    return {'id':seed,
+            'type':'create',
+            'path':'/data/incoming/%08d.xml' % seed,
+            'text':''.join([rnd.choice(letters) for i in xrange(size)])}
+
+def report(name, n, elapsed, note=''):
+    print "%-30s %10d/s %9.2fus  %s" % (name, n / elapsed, elapsed * 1e6 / n, note)
+
+def preload(queue_name, n, payload):
+    p = Producer(queue_name)
+    p.put_many([payload] * n)
+    p.close()
+
+def cleanup(*queues):
+    for queue in queues:
+        queue.delete()
+        queue.close()
+
+
+def bench_publish(n, payload):
+    for name, kw in [('publish', {}),
+                     ('publish (transactional)', {'transactional':True}),
+                     ('publish (deflate)', {'compress_threshold':0}),
+                     ('publish (metrics)', {'metrics':Metrics()})]:
+        p = Producer('bench_publish', **kw)
+        start = time()
+        for i in xrange(n):
+            p.put(payload)
+        elapsed = time() - start
+        nbytes = len(p._message(payload).body) * n
+        report(name, n, elapsed, '%.1f MB/s' % (nbytes / elapsed / 1048576))
+        cleanup(p)
+
+    p = Producer('bench_publish')
+    batch = [payload] * 100
+    start = time()
+    for i in xrange(n / 100):
+        p.put_many(batch)
+    report('publish (put_many of 100)', n / 100 * 100, time() - start)
+    cleanup(p)
+
+def bench_consume(n, payload):
+    for prefetch in (1, 100):
+        preload('bench_consume', n, payload)
+        c = Consumer('bench_consume', prefetch_count=prefetch)
+        start = time()
+        for i in xrange(n):
+            c.get()
+            c.task_done()
+        report('get+ack (prefetch %d)' % prefetch, n, time() - start)
+        cleanup(c)
+
+    preload('bench_consume', n, payload)
+    c = Consumer('bench_consume', prefetch_count=100)
+    start = time()
+    for i in xrange(n / 100):
+        for j in xrange(100):
+            c.get()
+        c.task_done(upto=c.delivery_tag)
+    report('get+cumulative ack of 100', n / 100 * 100, time() - start)
+    cleanup(c)
+
+def bench_latency(n, payload):
+    p = Producer('bench_latency')
+    c = Consumer('bench_latency')
+    latencies = []
+    got = threading.Event()
+    def consume():
+        for i in xrange(n):
+            msg = c.get()
+            latencies.append(time() - msg['sent'])
+            c.task_done()
+            got.set()
+    consumer = threading.Thread(target=consume)
+    consumer.start()
+    start = time()
+    for i in xrange(n):
+        got.clear()
+        payload['sent'] = time()
+        p.put(payload)
+        got.wait()
+    elapsed = time() - start
+    consumer.join()
+    del payload['sent']
+    latencies.sort()
+    percentile = lambda f: latencies[min(len(latencies) - 1, int(f * len(latencies)))] * 1e6
+    report('end-to-end, one in flight', n, elapsed,
+           'p50 %.0fus p90 %.0fus p99 %.0fus max %.0fus' % \
+           (percentile(0.5), percentile(0.9), percentile(0.99), latencies[-1] * 1e6))
+    cleanup(c, p)
+
+def bench_subscribers(n, payload, subscribers=3):
+    p = Producer('bench_fanout')
+    subs = [Subscriber('bench_fanout_%d' % i, binding='bench_fanout', prefetch_count=100)
+            for i in xrange(subscribers)]
+    start = time()
+    p.put_many([payload] * n)
+    for s in subs:
+        for i in xrange(n):
+            s.get()
+            s.task_done()
+    report('fanout to %d subscribers' % subscribers, n * subscribers, time() - start,
+           'per delivery')
+    cleanup(p, *subs)
+
+def bench_serializers(n, payload):
+    for name in ('raw', 'json', 'pickle'):
+        serializer = serializers.get(name)
+        data = payload
+        if name == 'raw':
+            data = payload['text']
+        body = serializer.dumps(data)
+        start = time()
+        for i in xrange(n):
+            serializer.dumps(data)
+        report('%s dumps' % name, n, time() - start, '%d bytes' % len(body))
+        start = time()
+        for i in xrange(n):
+            serializer.loads(body)
+        report('%s loads' % name, n, time() - start)
+    for name in ('deflate', 'bzip2'):
+        compress, decompress = COMPRESSIONS[name]
+        body = serializers.get('pickle').dumps(payload)
+        packed = compress(body, 6)
+        start = time()
+        for i in xrange(n):
+            compress(body, 6)
+        report('%s compress' % name, n, time() - start,
+               '%d -> %d bytes' % (len(body), len(packed)))
+        start = time()
+        for i in xrange(n):
+            decompress(packed)
+        report('%s decompress' % name, n, time() - start)
+
+class _CountingWorker(Worker):
+    def starttask(self, msg):
+        return WorkerResponse(COMPLETE)
+
+    def endtask(self, msg, response):
+        Worker.endtask(self, msg, response)
+        self.context['done'] += 1
+        if self.context['done'] == self.context['total']:
+            self.stop = True
+
+def bench_worker(n, payload):
+    preload('bench_worker', n, payload)
+    c = Consumer('bench_worker')
+    start = time()
+    for i in xrange(n):
+        c.get()
+        c.task_done()
+    bare = time() - start
+    cleanup(c)
+
+    preload('bench_worker', n, payload)
+    c = Consumer('bench_worker')
+    worker = _CountingWorker(c, done=0, total=n)
+    start = time()
+    worker.run()
+    elapsed = time() - start
+    report('Worker.run', n, elapsed, '%.2fus over a bare get/ack loop' % ((elapsed - bare) * 1e6 / n))
+    cleanup(c)
+
+def bench_memory(n, payload):
+    qf = QueueFactory(backend='memory', broker=MemoryBroker())
+    p = qf.Producer('bench_memory')
+    start = time()
+    for i in xrange(n):
+        p.put(payload)
+    report('memory publish', n, time() - start)
+    c = qf.Consumer('bench_memory')
+    start = time()
+    for i in xrange(n):
+        c.get()
+        c.task_done()
+    report('memory get+ack', n, time() - start)
+
+    latencies = []
+    got = threading.Event()
+    def consume():
+        for i in xrange(n):
+            msg = c.get()
+            latencies.append(time() - msg['sent'])
+            c.task_done()
+            got.set()
+    consumer = threading.Thread(target=consume)
+    consumer.start()
+    start = time()
+    for i in xrange(n):
+        got.clear()
+        payload['sent'] = time()
+        p.put(payload)
+        got.wait()
+    elapsed = time() - start
+    consumer.join()
+    del payload['sent']
+    latencies.sort()
+    report('memory end-to-end, one in flight', n, elapsed,
+           'p50 %.0fus p99 %.0fus' % (latencies[n / 2] * 1e6, latencies[min(n - 1, n * 99 / 100)] * 1e6))
+    cleanup(c, p)
+
+BENCHMARKS = [('publish', bench_publish),
+              ('consume', bench_consume),
+              ('latency', bench_latency),
+              ('subscribers', bench_subscribers),
+              ('serializers', bench_serializers),
+              ('worker', bench_worker),
+              ('memory', bench_memory)]
+
+def main():
+    parser = OptionParser(usage="%prog [options] [benchmark ...]\n\nbenchmarks: " + \
+                                ", ".join([name for name, _ in BENCHMARKS]))
+    parser.add_option('-n', '--messages', type='int', default=10000,
+                      help='messages per benchmark (default 10000)')
+    parser.add_option('-s', '--size', type='int', default=256,
+                      help='approximate payload size in bytes (default 256)')
+    options, names = parser.parse_args()
+    broker = StandInBroker()
+    broker.install()
+    try:
+        for name, benchmark in BENCHMARKS:
+            if names and name not in names:
+                continue
+            benchmark(options.messages, make_payload(options.size))
+    finally:
+        broker.uninstall()
+
+if __name__ == '__main__':
+    main()
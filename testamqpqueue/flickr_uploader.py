@@ -19,18 +19,18 @@ class FlickrUploader(JSONWorker):
             print "At %s%%" % progress
             
     def endtask(self, msg, response):
-        if ( msg.get('path','').endswith("jpg") or msg.get('path','').endswith("png") ) and msg.get('type', '') == 'create':
-            filename = msg.get('path')
-            f = self.context.get('flickrapi', None)
-            if f:
-                f.upload(filename=filename,
-                         title=filename,
-                         tags="magicupload",
-                         is_public=1,
-                         format="rest",
-                         content_type=1)
-            else:
-                print "Failed to get flickr api"
+        # only newly created images are routed here
+        filename = msg.get('path')
+        f = self.context.get('flickrapi', None)
+        if f:
+            f.upload(filename=filename,
+                     title=filename,
+                     tags="magicupload",
+                     is_public=1,
+                     format="rest",
+                     content_type=1)
+        else:
+            print "Failed to get flickr api"
         
         self.queue_stdin.task_done()
 
@@ -40,9 +40,9 @@ flickr = flickrapi.FlickrAPI(api_key, api_secret)
 if not token: raw_input("Press ENTER after you authorized this program")
 flickr.get_token_part_two((token, frob))
 
-qf = QueueFactory()
+qf = QueueFactory(exchange_name='inotify_events', exchange_type='topic')
 
-inbox = qf.Consumer('inotify')
+inbox = qf.Subscriber('flickr_q', ['create.jpg', 'create.png'])
 
 worker = FlickrUploader(inbox, None, flickrapi=flickr)
 
@@ -1,17 +1,15 @@
 from pyinotify import *
 import os
-import simplejson
 from amqpqueue import QueueFactory
+from amqpqueue.coalesce import Coalescer, event_routing_key
 
 class Log(ProcessEvent):
     def my_init(self, queue):
         self._queue = queue
     
     def _msg(self, event_type, event):
-        msg = {'type':event_type, 'path':os.path.join(event.path, event.name)}
-        # Why use a library for python <-> json? 
-        # Makes life easier in the long run
-        return simplejson.dumps(msg)
+        # The queue uses the 'json' serializer, so plain dicts can be put
+        return {'type':event_type, 'path':os.path.join(event.path, event.name)}
     
     # Pass on CRUD type events to the queue
     def process_IN_CREATE(self, event):
@@ -30,22 +28,28 @@ class Log(ProcessEvent):
         pass
 
 
-qf = QueueFactory('localhost:5672')
-queue = qf.Producer('inotify')
+# Events are routed as '<type>.<extension>' (eg 'create.txt'), so workers
+# subscribe to just the ones they handle; on a topic exchange the producer
+# has no queue of its own to fill up
+qf = QueueFactory('localhost:5672', exchange_name='inotify_events', exchange_type='topic')
+producer = qf.Producer('inotify', serializer='json')
+# Merge the bursts of events a single file write or copy generates
+queue = Coalescer(producer, window=0.5, routing_key=event_routing_key)
 
 # Create inotify hook manager
 wm = WatchManager()
 
 # It is important to pass the queue!
-notifier = Notifier(wm, default_proc_fun=Log(queue=queue))
+notifier = Notifier(wm, default_proc_fun=Log(queue=queue), timeout=100)
 
 wm.add_watch('/media/disk/dropbox', ALL_EVENTS)
 try:
-    notifier.loop()
+    # publish the coalesced events that are due after each pass
+    notifier.loop(callback=lambda n: queue.poll() and False)
     # Attempt to clean up after myself
 except:
     pass
 finally:
-    queue.delete()
-    queue.close()
+    queue.flush()
+    producer.close()
 
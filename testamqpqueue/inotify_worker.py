@@ -6,8 +6,9 @@ class MyWorker(Worker):
         print "message: %s" % (msg)
         self.queue_stdin.task_done()
 
-qf = QueueFactory()
+qf = QueueFactory(exchange_name='inotify_events', exchange_type='topic')
 
-worker = MyWorker(qf.Subscriber('logger', 'inotify'))
+# every event
+worker = MyWorker(qf.Subscriber('logger', '#'))
 
 worker.run()
@@ -1,35 +1,45 @@
 import solr
 
 from amqpqueue import QueueFactory
-from pyworker import JSONWorker
+from amqpqueue.worker import BatchWorker, WorkerResponse, COMPLETE
 
-class SolrUploader(JSONWorker):
-    def endtask(self, msg, response):
-        if msg.get('path','').endswith("txt"):
-            filename = msg.get('path')
+BATCH_SIZE = 200
+
+class SolrUploader(BatchWorker):
+    """Indexes text files as they are created, one solr commit per batch"""
+    def starttask_batch(self, msgs):
+        s = self.context.get('solr','')
+        if not s:
+            return WorkerResponse(COMPLETE)
+        docs = []
+        deletions = []
+        for msg in msgs:
+            msg = self.parse_json_msg(msg)
+            filename = msg.get('path','')
             if msg.get('type', '') == 'create':
-                s = self.context.get('solr','')
-                if s:
-                    f = open(filename, 'r')
-                    blurb = f.read()
-                    f.close()
-                    # Encoding? who needs encoding... *cough*
-                    # ... plz ignore encoding errors then...
-                    s.add(id=filename, name=blurb)
-                    s.commit()
+                f = open(filename, 'r')
+                blurb = f.read()
+                f.close()
+                # Encoding? who needs encoding... *cough*
+                # ... plz ignore encoding errors then...
+                docs.append({'id':filename, 'name':blurb})
             elif msg.get('type', '') == 'delete':
-                s = self.context.get('solr','')
-                if s:
-                    s.delete(id=filename)
-                    s.commit()
-        self.queue_stdin.task_done()
+                deletions.append(filename)
+        if docs:
+            s.add_many(docs)
+        for filename in deletions:
+            s.delete(id=filename)
+        if docs or deletions:
+            s.commit()
+        return WorkerResponse(COMPLETE)
 
-qf = QueueFactory()
+qf = QueueFactory(exchange_name='inotify_events', exchange_type='topic')
 
-inbox = qf.Subscriber('indexer_q', 'inotify')
+# only text files are routed to the indexer
+inbox = qf.Subscriber('indexer_q', ['create.txt', 'delete.txt'], prefetch_count=BATCH_SIZE)
 
 solr = solr.SolrConnection("http://localhost:8983/solr")
 
-worker = SolrUploader(inbox, None, solr=solr)
+worker = SolrUploader(inbox, None, solr=solr, batch_size=BATCH_SIZE, batch_time=2.0)
 
 worker.run()
@@ -0,0 +1,102 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""put_many and PublishBatch, against the benchmark's stand-in broker"""
+
+import unittest
+
+from benchmark import StandInBroker
+from amqpqueue import Producer, Consumer, Error
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.broker = StandInBroker()
+        self.broker.install()
+
+    def tearDown(self):
+        self.broker.uninstall()
+
+    def count_writes(self, qp):
+        writes = []
+        write = qp.conn.transport._write
+        def counting_write(data):
+            writes.append(len(data))
+            write(data)
+        qp.conn.transport._write = counting_write
+        return writes
+
+    def received(self, n):
+        qc = Consumer('batch', prefetch_count=n)
+        messages = []
+        for i in xrange(n):
+            messages.append(qc.get(timeout=1.0))
+            qc.task_done()
+        return messages
+
+    def test_put_many_is_one_write(self):
+        qp = Producer('batch')
+        writes = self.count_writes(qp)
+        # bigger than frame_max, so split over several body frames
+        big = 'x' * (qp.conn.frame_max * 2 + 10)
+        self.assertEqual(qp.put_many(['a', big, {'b':1}]), 3)
+        self.assertEqual(len(writes), 1)
+        self.assertEqual(self.received(3), ['a', big, {'b':1}])
+
+    def test_flushed_every_max_bytes(self):
+        qp = Producer('batch')
+        writes = self.count_writes(qp)
+        batch = qp.batch(max_bytes=200)
+        batch.begin()
+        for i in xrange(10):
+            qp.put('m%d' % i)
+        self.assertTrue(len(writes) > 1)
+        # what has been flushed has been delivered, without waiting for the commit
+        self.assertTrue(len(self.broker.queue('batch').messages) > 0)
+        batch.commit()
+        self.assertEqual(self.received(10), ['m%d' % i for i in xrange(10)])
+
+    def test_nothing_shows_up_before_a_transactional_commit(self):
+        qp = Producer('batch')
+        batch = qp.batch(transactional=True, max_bytes=1)
+        batch.begin()
+        qp.put('a')
+        qp.put('b')
+        self.assertEqual(len(self.broker.queue('batch').messages), 0)
+        batch.commit()
+        self.assertEqual(self.received(2), ['a', 'b'])
+
+    def test_transactional_abort_takes_back_flushed_messages(self):
+        qp = Producer('batch')
+        batch = qp.batch(transactional=True, max_bytes=1)
+        batch.begin()
+        qp.put('a')
+        batch.abort()
+        qp.put('b')
+        self.assertEqual(self.received(1), ['b'])
+        self.assertEqual(len(self.broker.queue('batch').messages), 0)
+
+    def test_transactional_producer_always_commits(self):
+        qp = Producer('batch', transactional=True)
+        batch = qp.batch(transactional=False)
+        batch.begin()
+        qp.put('a')
+        batch.commit()
+        self.assertEqual(self.received(1), ['a'])
+
+    def test_puts_after_the_batch_are_written_directly(self):
+        qp = Producer('batch')
+        qp.put_many(['a'])
+        self.assertFalse('_send_method' in qp.ch.__dict__)
+        qp.put('b')
+        self.assertEqual(self.received(2), ['a', 'b'])
+
+    def test_one_batch_at_a_time(self):
+        qp = Producer('batch')
+        batch = qp.batch()
+        batch.begin()
+        self.assertRaises(Error, qp.batch().begin)
+        batch.commit()
+
+
+if __name__ == '__main__':
+    unittest.main()
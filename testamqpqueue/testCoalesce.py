@@ -0,0 +1,102 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""merge_events and Coalescer, publishing through the memory backend"""
+
+import sys
+import os
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from amqpqueue import QueueFactory, MemoryBroker
+from amqpqueue.coalesce import Coalescer, merge_events, event_routing_key
+
+def event(event_type, path='/a.txt'):
+    return {'type':event_type, 'path':path}
+
+class MergeEventsTest(unittest.TestCase):
+    def test_repeat_is_dropped(self):
+        self.assertEqual(merge_events(event('update'), event('update')), event('update'))
+
+    def test_create_then_update_is_create(self):
+        self.assertEqual(merge_events(event('create'), event('update')), event('create'))
+
+    def test_update_then_delete_is_delete(self):
+        self.assertEqual(merge_events(event('update'), event('delete')), event('delete'))
+
+    def test_create_then_delete_cancels_out(self):
+        self.assertEqual(merge_events(event('create'), event('delete')), None)
+
+    def test_delete_then_create_is_update(self):
+        self.assertEqual(merge_events(event('delete'), event('create')), event('update'))
+
+    def test_unmergeable(self):
+        self.assertEqual(merge_events(event('delete'), event('update')), False)
+
+
+class CoalescerTest(unittest.TestCase):
+    def setUp(self):
+        qf = QueueFactory(backend='memory', broker=MemoryBroker(), serializer='json')
+        self.qp = qf.Producer('events')
+        self.qc = qf.Consumer('events')
+
+    def received(self):
+        events = []
+        while len(self.qc):
+            events.append(self.qc.get(False))
+            self.qc.task_done()
+        return events
+
+    def test_bursts_are_merged_per_path(self):
+        events = Coalescer(self.qp, window=60)
+        events.put(event('create'))
+        events.put(event('update'))
+        events.put(event('update'))
+        events.put(event('update', '/b.txt'))
+        events.put(event('create', '/c.txt'))
+        events.put(event('delete', '/c.txt'))
+        self.assertEqual(len(events), 2)
+        self.assertEqual(events.flush(), 2)
+        self.assertEqual(self.received(), [event('create'), event('update', '/b.txt')])
+        self.assertEqual((events.received, events.published), (6, 2))
+
+    def test_unmergeable_events_are_kept_in_order(self):
+        events = Coalescer(self.qp, window=60)
+        events.put(event('delete'))
+        events.put(event('update'))
+        events.flush()
+        self.assertEqual(self.received(), [event('delete'), event('update')])
+
+    def test_events_wait_for_the_window(self):
+        events = Coalescer(self.qp, window=0.2)
+        events.put(event('create'))
+        self.assertEqual(events.poll(), 0)
+        time.sleep(0.3)
+        self.assertEqual(events.poll(), 1)
+        self.assertEqual(self.received(), [event('create')])
+
+    def test_max_delay_bounds_a_busy_key(self):
+        events = Coalescer(self.qp, window=0.2, max_delay=0.3)
+        started = time.time()
+        while time.time() - started < 0.4:
+            events.put(event('update'))
+            time.sleep(0.05)
+        self.assertEqual(events.poll(), 1)
+
+    def test_routing_key(self):
+        qf = QueueFactory(backend='memory', broker=MemoryBroker(), serializer='json',
+                          exchange_name='events', exchange_type='topic')
+        qp = qf.Producer('events')
+        txt = qf.Subscriber('txt', '*.txt')
+        events = Coalescer(qp, window=60, routing_key=event_routing_key)
+        events.put(event('create', '/a.TXT'))
+        events.put(event('create', '/b.jpg'))
+        events.flush()
+        self.assertEqual(txt.get(False), event('create', '/a.TXT'))
+        self.assertEqual(len(txt), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
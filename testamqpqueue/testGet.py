@@ -0,0 +1,120 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Timed and non-blocking Consumer.get, cancel() and Worker.drain, against
+the benchmark's stand-in broker"""
+
+import time
+import threading
+import unittest
+from Queue import Empty
+
+from benchmark import StandInBroker
+from amqpqueue import QueueFactory, Producer, Consumer
+from amqpqueue.worker import Worker
+
+class DrainingWorker(Worker):
+    """Calls .drain(drain_deadline) on itself during its first task"""
+    def starttask(self, msg):
+        if not self.context['seen']:
+            self.drain(self.context['drain_deadline'])
+        self.context['seen'].append(msg)
+        return Worker.starttask(self, msg)
+
+class GetTest(unittest.TestCase):
+    def setUp(self):
+        self.broker = StandInBroker()
+        self.broker.install()
+
+    def tearDown(self):
+        self.broker.uninstall()
+
+    def assertEmptyWithin(self, get, low, high):
+        started = time.time()
+        self.assertRaises(Empty, get)
+        self.assertTrue(low <= time.time() - started < high)
+
+    def test_timeout(self):
+        qc = Consumer('jobs')
+        self.assertEmptyWithin(lambda: qc.get(timeout=0.2), 0.2, 0.5)
+
+    def test_nonblocking(self):
+        qc = Consumer('jobs')
+        self.assertEmptyWithin(lambda: qc.get(False), 0, 0.1)
+        self.assertEmptyWithin(qc.get_nowait, 0, 0.1)
+        Producer('jobs').put('a')
+        self.assertEqual(qc.get(False), 'a')
+
+    def test_msg_arriving_while_waiting(self):
+        qp, qc = Producer('jobs'), Consumer('jobs')
+        threading.Timer(0.1, qp.put, ('a',)).start()
+        self.assertEqual(qc.get(timeout=2.0), 'a')
+
+    def test_timeout_on_a_pooled_connection_busy_with_another_queue(self):
+        qf = QueueFactory(pool_size=1)
+        idle, busy, qp = qf.Consumer('idle'), qf.Consumer('busy'), qf.Producer('busy')
+        self.assertTrue(idle.conn is busy.conn)
+        def feed():
+            for i in xrange(10):
+                qp.put(i)
+                time.sleep(0.05)
+        feeder = threading.Thread(target=feed)
+        feeder.start()
+        self.assertEmptyWithin(lambda: idle.get(timeout=0.2), 0.2, 0.5)
+        feeder.join()
+        got = []
+        for i in xrange(10):
+            got.append(busy.get(timeout=1.0))
+            busy.task_done()
+        self.assertEqual(got, range(10))
+
+    def test_prefetched_msgs_can_be_got_after_cancel(self):
+        qp = Producer('jobs')
+        qc = Consumer('jobs', prefetch_count=2)
+        for i in xrange(3):
+            qp.put(i)
+        qc.cancel()
+        self.assertEqual([qc.get(False), qc.get(False)], [0, 1])
+        qc.task_done(upto=qc.delivery_tag)
+        self.assertRaises(Empty, qc.get, False)
+        self.assertEqual(len(qc), 1)
+
+
+class DrainTest(unittest.TestCase):
+    def setUp(self):
+        self.broker = StandInBroker()
+        self.broker.install()
+        self.qp = Producer('jobs')
+        for i in xrange(5):
+            self.qp.put(i)
+        self.qc = Consumer('jobs', prefetch_count=3)
+        self.seen = []
+
+    def tearDown(self):
+        self.broker.uninstall()
+
+    def run_worker(self, drain_deadline):
+        worker = DrainingWorker(self.qc, seen=self.seen, drain_deadline=drain_deadline,
+                                poll_interval=0.05)
+        thread = threading.Thread(target=worker.run)
+        thread.start()
+        thread.join(5.0)
+        self.assertFalse(thread.isAlive())
+
+    def test_delivered_msgs_are_finished(self):
+        self.run_worker(30.0)
+        # the ack of the first msg let one more in before the consumer was
+        # cancelled, on the worker's next get
+        self.assertEqual(self.seen, [0, 1, 2, 3])
+        self.assertEqual(self.qc.ch.unacked, {})
+        self.assertEqual(len(self.qp), 1)
+
+    def test_deadline(self):
+        self.run_worker(0)
+        self.assertEqual(self.seen, [0])
+        self.qc.close()
+        self.assertEqual(len(self.qp), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
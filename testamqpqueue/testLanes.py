@@ -0,0 +1,73 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""pick_lane and MultiConsumer, against the benchmark's stand-in broker"""
+
+import unittest
+
+from benchmark import StandInBroker
+from amqpqueue import Producer, MultiConsumer, Lane
+from amqpqueue.amqpqueue import pick_lane
+
+class PickLaneTest(unittest.TestCase):
+    def test_priority_takes_the_first_lane(self):
+        lanes = [Lane('urgent'), Lane('bulk')]
+        self.assertEqual([pick_lane(lanes).queue_name for i in xrange(3)], ['urgent'] * 3)
+
+    def test_weighted_interleaves_by_weight(self):
+        lanes = [Lane('a', weight=3), Lane('b', weight=1)]
+        picked = [pick_lane(lanes, weighted=True).queue_name for i in xrange(8)]
+        self.assertEqual(picked, ['a', 'a', 'b', 'a'] * 2)
+
+    def test_weighted_only_considers_the_lanes_given(self):
+        a, b = Lane('a', weight=3), Lane('b', weight=1)
+        self.assertTrue(pick_lane([b], weighted=True) is b)
+        self.assertTrue(pick_lane([a, b], weighted=True) is a)
+
+
+class MultiConsumerTest(unittest.TestCase):
+    def setUp(self):
+        self.broker = StandInBroker()
+        self.broker.install()
+
+    def tearDown(self):
+        self.broker.uninstall()
+
+    def test_priority(self):
+        bulk, urgent = Producer('bulk'), Producer('urgent')
+        qc = MultiConsumer([Lane('urgent', prefetch_count=5), Lane('bulk', prefetch_count=5)])
+        bulk.put('b0')
+        urgent.put('u0')
+        self.assertEqual([qc.get(), qc.get()], ['u0', 'b0'])
+
+    def test_cumulative_ack_spares_buffered_messages(self):
+        bulk, urgent = Producer('bulk'), Producer('urgent')
+        qc = MultiConsumer([Lane('urgent', prefetch_count=5), Lane('bulk', prefetch_count=5)])
+        for i in xrange(3):
+            bulk.put('b%d' % i)
+        qc._poll()
+        urgent.put('u0')
+        # got after the bulk msgs were delivered, so it has the highest tag
+        self.assertEqual(qc.get(), 'u0')
+        qc.task_done(upto=qc.delivery_tag)
+        self.assertEqual(sorted(qc.ch.unacked), [1, 2, 3])
+        self.assertEqual([qc.get() for i in xrange(3)], ['b0', 'b1', 'b2'])
+        qc.task_done(upto=max(qc.unacked))
+        self.assertEqual(qc.ch.unacked, {})
+        self.assertEqual(qc.unacked, [])
+
+    def test_shared_lanes_are_not_shared_state(self):
+        lanes = [Lane('urgent'), Lane('bulk', prefetch_count=5)]
+        first, second = MultiConsumer(lanes), MultiConsumer(lanes)
+        self.assertTrue(first.lanes[0] is not second.lanes[0])
+        self.assertEqual(lanes[0].consumer_tag, None)
+        first.cancel()
+        # the second consumer is still consuming from both lanes
+        self.assertEqual([len(self.broker.queue(name).consumers) for name in ('urgent', 'bulk')],
+                         [1, 1])
+        Producer('bulk').put('b0')
+        self.assertEqual(second.get(), 'b0')
+
+
+if __name__ == '__main__':
+    unittest.main()
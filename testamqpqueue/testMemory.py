@@ -0,0 +1,98 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""The memory backend: acking, requeueing, fanout and batches"""
+
+import sys
+import os
+import time
+import threading
+import unittest
+from Queue import Empty
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from amqpqueue import QueueFactory, MemoryBroker, Error
+
+class MemoryTest(unittest.TestCase):
+    def setUp(self):
+        self.qf = QueueFactory(backend='memory', broker=MemoryBroker())
+        self.qp = self.qf.Producer('jobs')
+
+    def test_ack(self):
+        qc = self.qf.Consumer('jobs')
+        self.qp.put({'a':1})
+        self.assertEqual(len(qc), 1)
+        self.assertEqual(qc.get(False), {'a':1})
+        self.assertEqual(len(qc), 0)
+        self.assertRaises(Error, qc.get, False)
+        qc.task_done()
+        self.assertEqual((qc.unacked, qc.delivery_tag), ([], None))
+        self.assertRaises(Empty, qc.get, False)
+
+    def test_failed_msg_goes_back_to_the_front(self):
+        qc = self.qf.Consumer('jobs')
+        self.qp.put('a')
+        self.qp.put('b')
+        self.assertEqual(qc.get(False), 'a')
+        qc.task_failed()
+        self.assertEqual(qc.get(False), 'a')
+        qc.task_done()
+        self.assertEqual(qc.get(False), 'b')
+        qc.task_done()
+
+    def test_close_returns_unacked_msgs_in_order(self):
+        qc = self.qf.Consumer('jobs', prefetch_count=2)
+        for msg in 'abc':
+            self.qp.put(msg)
+        self.assertEqual([qc.get(False), qc.get(False)], ['a', 'b'])
+        qc.close()
+        self.assertEqual(self.qp.consumers(), 0)
+        other = self.qf.Consumer('jobs', prefetch_count=3)
+        self.assertEqual([other.get(False) for i in xrange(3)], ['a', 'b', 'c'])
+
+    def test_ack_by_tag_and_upto(self):
+        qc = self.qf.Consumer('jobs', prefetch_count=3)
+        for msg in 'abc':
+            self.qp.put(msg)
+        tags = []
+        for i in xrange(3):
+            qc.get(False)
+            tags.append(qc.delivery_tag)
+        qc.task_done(tags[1])
+        self.assertEqual(qc.unacked, [tags[0], tags[2]])
+        qc.task_done(upto=tags[2])
+        self.assertEqual(qc.unacked, [])
+
+    def test_get_waits_for_a_put(self):
+        qc = self.qf.Consumer('jobs')
+        threading.Timer(0.1, self.qp.put, ('a',)).start()
+        self.assertEqual(qc.get(timeout=2.0), 'a')
+        qc.task_done()
+        started = time.time()
+        self.assertRaises(Empty, qc.get, True, 0.1)
+        self.assertTrue(time.time() - started >= 0.1)
+
+    def test_fanout(self):
+        qf = QueueFactory(backend='memory', broker=MemoryBroker(), exchange_name='news',
+                          exchange_type='fanout')
+        first, second = qf.Subscriber('first', ''), qf.Subscriber('second', '')
+        qf.Producer('news').put('hello')
+        self.assertEqual((first.get(False), second.get(False)), ('hello', 'hello'))
+
+    def test_batch_shows_up_on_commit(self):
+        qc = self.qf.Consumer('jobs')
+        batch = self.qp.batch()
+        batch.begin()
+        self.qp.put('a')
+        self.assertEqual(len(qc), 0)
+        batch.commit()
+        self.assertEqual(qc.get(False), 'a')
+
+    def test_queues_on_separate_brokers_are_separate(self):
+        QueueFactory(backend='memory', broker=MemoryBroker()).Producer('jobs').put('a')
+        self.assertEqual(len(self.qf.Consumer('jobs')), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
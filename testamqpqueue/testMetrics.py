@@ -0,0 +1,56 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Histogram percentiles and Metrics snapshots"""
+
+import sys
+import os
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from amqpqueue.metrics import Histogram, Metrics
+
+class PercentileTest(unittest.TestCase):
+    def setUp(self):
+        self.histogram = Histogram(buckets=(0.1, 1.0, 10.0))
+
+    def test_empty(self):
+        self.assertEqual(self.histogram.percentile(0.5), 0.0)
+
+    def test_upper_bound_of_the_bucket(self):
+        for i in xrange(9):
+            self.histogram.observe(0.05)
+        self.histogram.observe(0.5)
+        self.assertEqual(self.histogram.percentile(0.5), 0.1)
+        self.assertEqual(self.histogram.percentile(0.9), 0.1)
+        self.assertEqual(self.histogram.percentile(0.99), 0.5)
+
+    def test_never_more_than_the_largest_observation(self):
+        self.histogram.observe(0.05)
+        self.assertEqual(self.histogram.percentile(0.5), 0.05)
+
+    def test_overflow_bucket_is_the_max(self):
+        self.histogram.observe(0.05)
+        self.histogram.observe(42.0)
+        self.assertEqual(self.histogram.percentile(1.0), 42.0)
+
+    def test_boundary_goes_in_the_lower_bucket(self):
+        self.histogram.observe(1.0)
+        self.histogram.observe(5.0)
+        self.assertEqual(self.histogram.percentile(0.5), 1.0)
+
+
+class MetricsTest(unittest.TestCase):
+    def test_snapshot_by_name_and_label(self):
+        metrics = Metrics()
+        metrics.observe('publish', 0.01, 'jobs', 100)
+        metrics.observe('publish', 0.03, 'jobs', 50)
+        snapshot = metrics.snapshot()[('publish', 'jobs')]
+        self.assertEqual((snapshot['count'], snapshot['bytes']), (2, 150))
+        self.assertAlmostEqual(snapshot['mean'], 0.02)
+        self.assertEqual(snapshot['max'], 0.03)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Pipeline stages fused within a process, on the memory backend"""
+
+import sys
+import os
+import time
+import logging
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from amqpqueue import QueueFactory, MemoryBroker, Error
+from amqpqueue.pipeline import Pipeline
+from amqpqueue.worker import Worker, BatchWorker, WorkerResponse, COMPLETE, FAIL
+
+# failed msgs are logged with their tracebacks
+logging.getLogger('amqpqueue').addHandler(logging.NullHandler())
+
+class Evens(Worker):
+    """Passes even numbers on, acking and dropping odd ones"""
+    def endtask(self, msg, response):
+        if msg % 2:
+            self.queue_stdin.task_done()
+        else:
+            Worker.endtask(self, msg, response)
+
+class Double(Worker):
+    """Fails each msg listed in 'fail' the first time, raises on those listed
+    in 'raise' the first time"""
+    def starttask(self, msg):
+        tried = self.context['tried']
+        tried.append(msg)
+        if msg in self.context.get('raise', ()) and tried.count(msg) == 1:
+            raise ValueError(msg)
+        if msg in self.context.get('fail', ()) and tried.count(msg) == 1:
+            return WorkerResponse(FAIL)
+        return WorkerResponse(COMPLETE)
+
+    def endtask(self, msg, response):
+        if response.status == COMPLETE:
+            self.queue_stdout.put(msg * 2)
+            self.queue_stdin.task_done()
+        else:
+            self.queue_stdin.task_failed()
+
+class Collect(Worker):
+    def starttask(self, msg):
+        self.context['seen'].append(msg)
+        return WorkerResponse(COMPLETE)
+
+class Batched(BatchWorker):
+    pass
+
+class PipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.qf = QueueFactory(backend='memory', broker=MemoryBroker())
+        self.tried, self.seen = [], []
+
+    def pipeline(self, **kw):
+        pipe = Pipeline(self.qf, output='out')
+        pipe.stage(Evens, 'in', size=2, poll_interval=0.05)
+        pipe.stage(Double, 'double', tried=self.tried, **kw)
+        pipe.stage(Collect, 'collect', process='other', seen=self.seen, poll_interval=0.05)
+        return pipe
+
+    def run_pipeline(self, pipe, n, timeout=5.0):
+        """Run both processes' stages here until 'collect' has seen n msgs"""
+        self.qf.Producer('in').put_many(range(10))
+        pipe.start()
+        pipe.start('other')
+        deadline = time.time() + timeout
+        while len(self.seen) < n and time.time() < deadline:
+            time.sleep(0.01)
+        pipe.drain(1.0)
+        pipe.join()
+
+    def test_segments(self):
+        pipe = self.pipeline()
+        names = lambda segments: [[stage.queue for stage in segment] for segment in segments]
+        self.assertEqual(names(pipe.segments()), [['in', 'double']])
+        self.assertEqual(names(pipe.segments('other')), [['collect']])
+
+    def test_fused_stages_skip_their_queue(self):
+        # the queue a fused stage would read from never sees a msg
+        double = self.qf.Consumer('double')
+        out = self.qf.Consumer('out', prefetch_count=5)
+        self.run_pipeline(self.pipeline(), 5)
+        self.assertEqual(sorted(self.tried), [0, 2, 4, 6, 8])
+        self.assertEqual(sorted(self.seen), [0, 4, 8, 12, 16])
+        self.assertEqual(len(double), 0)
+        self.assertEqual(sorted([out.get(False) for i in xrange(5)]), [0, 4, 8, 12, 16])
+        self.assertEqual(len(self.qf.Producer('in')), 0)
+
+    def test_failure_in_a_fused_stage_rejects_the_delivery(self):
+        self.run_pipeline(self.pipeline(fail=[4]), 5)
+        self.assertEqual(self.tried.count(4), 2)
+        self.assertEqual(sorted(self.seen), [0, 4, 8, 12, 16])
+        self.assertEqual(len(self.qf.Producer('in')), 0)
+
+    def test_exception_in_a_fused_stage_rejects_the_delivery(self):
+        self.run_pipeline(self.pipeline(**{'raise':[6]}), 5)
+        self.assertEqual(self.tried.count(6), 2)
+        self.assertEqual(sorted(self.seen), [0, 4, 8, 12, 16])
+
+    def test_no_batch_workers(self):
+        self.assertRaises(Error, Pipeline(self.qf).stage, Batched, 'in')
+
+
+if __name__ == '__main__':
+    unittest.main()
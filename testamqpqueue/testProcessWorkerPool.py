@@ -0,0 +1,90 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""ProcessWorkerPool on the memory backend: results, responses that can't be
+sent back, and tasks that overrun task_timeout"""
+
+import sys
+import os
+import time
+import logging
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from amqpqueue import QueueFactory, MemoryBroker
+from amqpqueue.worker import Worker, ProcessWorkerPool, WorkerResponse, COMPLETE, FAIL
+
+# lost and killed tasks are logged as errors
+logging.getLogger('amqpqueue').addHandler(logging.NullHandler())
+
+class PidWorker(Worker):
+    """Runs in the pool's processes; 'hang' never finishes, 'die' takes its
+    process down and 'lock' answers with something that can't be pickled"""
+    def starttask(self, msg):
+        if msg == 'hang':
+            time.sleep(60)
+        elif msg == 'die':
+            os._exit(1)
+        elif msg == 'lock':
+            return WorkerResponse(COMPLETE, lock=threading.Lock())
+        return WorkerResponse(COMPLETE, pid=os.getpid())
+
+    def endtask(self, msg, response):
+        # runs in the test's process
+        self.context['done'].append((msg, response.status, response.context.get('pid')))
+        self.queue_stdin.task_done()
+
+class ProcessWorkerPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.qf = QueueFactory(backend='memory', broker=MemoryBroker())
+        self.qp = self.qf.Producer('jobs')
+        self.done = []
+
+    def run_pool(self, msgs, n, timeout=10.0, **kw):
+        """Run a pool on msgs until n of them are done (or timed out)"""
+        for msg in msgs:
+            self.qp.put(msg)
+        qc = self.qf.Consumer('jobs', prefetch_count=4)
+        pool = ProcessWorkerPool(PidWorker, qc, size=2, done=self.done, poll_interval=0.05,
+                                 **kw)
+        pool.start()
+        deadline = time.time() + timeout
+        while len(self.done) < n and time.time() < deadline:
+            time.sleep(0.01)
+        started = time.time()
+        pool.drain(1.0)
+        pool.join()
+        self.assertTrue(time.time() - started < 5.0)
+        self.assertEqual(qc.unacked, [])
+        return pool
+
+    def test_results_reach_endtask_in_this_process(self):
+        self.run_pool(range(6), 6)
+        self.assertEqual(sorted([msg for msg, status, pid in self.done]), range(6))
+        self.assertEqual(set([status for msg, status, pid in self.done]), set([COMPLETE]))
+        pids = set([pid for msg, status, pid in self.done])
+        self.assertTrue(os.getpid() not in pids)
+
+    def test_response_that_cannot_be_sent_back_is_a_fail(self):
+        self.run_pool(['lock', 'ok'], 2)
+        self.assertEqual(sorted([(msg, status) for msg, status, pid in self.done]),
+                         [('lock', FAIL), ('ok', COMPLETE)])
+
+    def test_hung_tasks_are_given_up_on(self):
+        timeouts = self.qf.Producer('timeouts')
+        pool = self.run_pool(['hang', 'die'] + range(4), 4, task_timeout=0.5,
+                             timeout_queue=timeouts)
+        self.assertEqual(sorted([msg for msg, status, pid in self.done]), range(4))
+        self.assertTrue(pool.abandoned)
+        consumer = self.qf.Consumer('timeouts', prefetch_count=2)
+        deadline = time.time() + 5.0
+        while len(consumer) < 2 and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(sorted([consumer.get(False), consumer.get(False)]), ['die', 'hang'])
+        self.assertEqual(len(self.qp), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
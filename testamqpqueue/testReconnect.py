@@ -0,0 +1,112 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Reconnecting after a dropped connection, and DeliveryLost, against the
+benchmark's stand-in broker"""
+
+import socket
+import logging
+import unittest
+
+from benchmark import StandInBroker
+import amqpqueue.amqpqueue
+from amqpqueue import Producer, Consumer, ConnectionLost, DeliveryLost
+
+# every drop is logged as a warning
+logging.getLogger('amqpqueue').addHandler(logging.NullHandler())
+
+def drop(queue, *methods):
+    """Make the named methods of queue's current channel fail as they would
+    once the broker has gone away"""
+    def dropped(*args, **kw):
+        raise socket.error('Connection reset by peer')
+    for method in methods:
+        setattr(queue.ch, method, dropped)
+
+class ReconnectTest(unittest.TestCase):
+    def setUp(self):
+        self.broker = StandInBroker()
+        self.broker.install()
+
+    def tearDown(self):
+        self.broker.uninstall()
+
+    def test_put_is_sent_again_on_a_new_connection(self):
+        qp = Producer('jobs', reconnect=True, reconnect_delay=0.001)
+        conn = qp.conn
+        drop(qp, 'basic_publish')
+        qp.put('a')
+        self.assertTrue(qp.conn is not conn)
+        qc = Consumer('jobs')
+        self.assertEqual(qc.get(timeout=1.0), 'a')
+        qc.task_done()
+        self.assertEqual(len(qc), 0)
+
+    def test_get_carries_on_after_a_drop(self):
+        qc = Consumer('jobs', reconnect=True, reconnect_delay=0.001)
+        Producer('jobs').put('a')
+        drop(qc, 'wait')
+        self.assertEqual(qc.get(), 'a')
+        qc.task_done()
+        self.assertEqual(len(qc), 0)
+
+    def test_ack_after_a_drop_is_delivery_lost(self):
+        qp = Producer('jobs')
+        qc = Consumer('jobs', reconnect=True, reconnect_delay=0.001)
+        qp.put('a')
+        self.assertEqual(qc.get(timeout=1.0), 'a')
+        first = qc.delivery_tag
+        drop(qc, 'basic_ack')
+        self.assertRaises(DeliveryLost, qc.task_done)
+        # redelivered on the new channel, under a tag of its own
+        self.assertEqual(qc.get(timeout=1.0), 'a')
+        self.assertNotEqual(qc.delivery_tag, first)
+        qc.task_done()
+        self.assertEqual(len(qc), 0)
+
+    def test_deliveries_got_before_a_drop_are_lost(self):
+        qp = Producer('jobs')
+        qc = Consumer('jobs', reconnect=True, reconnect_delay=0.001,
+                      prefetch_count=2)
+        qp.put('a')
+        qp.put('b')
+        self.assertEqual(qc.get(timeout=1.0), 'a')
+        first = qc.delivery_tag
+        drop(qc, 'basic_ack')
+        self.assertRaises(DeliveryLost, qc.task_done, first)
+        self.assertEqual(qc.lost, [])
+        self.assertEqual(sorted([qc.get(timeout=1.0), qc.get(timeout=1.0)]), ['a', 'b'])
+        qc.task_done(upto=qc.delivery_tag)
+        self.assertEqual(len(qc), 0)
+
+    def test_lost_tags_raise_when_settled_later(self):
+        qp = Producer('jobs')
+        qc = Consumer('jobs', reconnect=True, reconnect_delay=0.001,
+                      prefetch_count=2)
+        qp.put('a')
+        self.assertEqual(qc.get(timeout=1.0), 'a')
+        first = qc.delivery_tag
+        drop(qc, 'wait')
+        qp.put('b')
+        # the drop happens while getting the next message
+        self.assertTrue(qc.get(timeout=1.0) in ('a', 'b'))
+        self.assertEqual(qc.lost, [first])
+        self.assertRaises(DeliveryLost, qc.task_done, first)
+        self.assertEqual(qc.lost, [])
+
+    def test_out_of_attempts(self):
+        qc = Consumer('jobs', reconnect=True, reconnect_attempts=2, reconnect_delay=0.001)
+        def refused(*args, **kw):
+            raise socket.error('Connection refused')
+        amqpqueue.amqpqueue.amqp.Connection = refused
+        drop(qc, 'wait')
+        self.assertRaises(ConnectionLost, qc.get)
+
+    def test_no_reconnect(self):
+        qc = Consumer('jobs')
+        drop(qc, 'wait')
+        self.assertRaises(socket.error, qc.get)
+
+
+if __name__ == '__main__':
+    unittest.main()
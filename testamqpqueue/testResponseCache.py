@@ -0,0 +1,84 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""ResponseCache storing, validators and LRU eviction"""
+
+import sys
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from amqpqueue.worker import ResponseCache
+
+class Response(object):
+    """Just the getheader() of an httplib response"""
+    def __init__(self, **headers):
+        self.headers = dict([(key.replace('_', '-'), value) for key, value in headers.items()])
+
+    def getheader(self, name):
+        return self.headers.get(name)
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = ResponseCache(self.directory, max_bytes=10)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def store(self, url, body, **headers):
+        self.cache.store(url, StringIO(body), Response(**headers))
+
+    def load(self, url):
+        fd = StringIO()
+        if not self.cache.load(url, fd):
+            return None
+        return fd.read()
+
+    def test_stored_with_validators(self):
+        self.store('http://a/', '12345', etag='"a"', last_modified='yesterday')
+        self.assertEqual(self.cache.validators('http://a/'),
+                         {'If-None-Match':'"a"', 'If-Modified-Since':'yesterday'})
+        self.assertEqual(self.load('http://a/'), '12345')
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_not_stored_without_validators_or_with_no_store(self):
+        self.store('http://a/', '12345')
+        self.store('http://b/', '12345', etag='"b"', cache_control='no-store')
+        self.assertEqual(self.cache.validators('http://a/'), {})
+        self.assertEqual(self.load('http://b/'), None)
+        self.assertEqual(self.cache.stats()['misses'], 2)
+
+    def test_too_big_for_the_cache(self):
+        self.store('http://a/', '12345678901', etag='"a"')
+        self.assertEqual(self.load('http://a/'), None)
+        self.assertEqual(self.cache.size(), 0)
+
+    def test_least_recently_used_is_evicted(self):
+        self.store('http://a/', '1234', etag='"a"')
+        time.sleep(0.01)
+        self.store('http://b/', '1234', etag='"b"')
+        time.sleep(0.01)
+        # a is now more recently used than b
+        self.load('http://a/')
+        self.store('http://c/', '1234', etag='"c"')
+        self.assertEqual(self.load('http://b/'), None)
+        self.assertEqual(self.load('http://a/'), '1234')
+        self.assertEqual(self.load('http://c/'), '1234')
+        stats = self.cache.stats()
+        self.assertEqual((stats['entries'], stats['bytes'], stats['evictions']), (2, 8, 1))
+        self.assertEqual(len(os.listdir(self.directory)), 3)
+
+    def test_index_survives_a_restart(self):
+        self.store('http://a/', '1234', etag='"a"')
+        self.cache = ResponseCache(self.directory, max_bytes=10)
+        self.assertEqual(self.load('http://a/'), '1234')
+
+
+if __name__ == '__main__':
+    unittest.main()
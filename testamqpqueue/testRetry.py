@@ -0,0 +1,50 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""RetryPolicy delays, and retries through the memory backend"""
+
+import sys
+import os
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from amqpqueue import QueueFactory, MemoryBroker, RetryPolicy
+
+class DelayForTest(unittest.TestCase):
+    def test_backoff(self):
+        retry = RetryPolicy(delay=1.0, backoff=2.0, max_delay=300.0)
+        self.assertEqual([retry.delay_for(n) for n in (1, 2, 3, 4)], [1.0, 2.0, 4.0, 8.0])
+
+    def test_capped_by_max_delay(self):
+        retry = RetryPolicy(delay=1.0, backoff=10.0, max_delay=30.0)
+        self.assertEqual([retry.delay_for(n) for n in (1, 2, 3)], [1.0, 10.0, 30.0])
+
+    def test_constant_without_backoff(self):
+        retry = RetryPolicy(delay=0.5, backoff=1.0)
+        self.assertEqual([retry.delay_for(n) for n in (1, 5)], [0.5, 0.5])
+
+    def test_dead_letter_queue(self):
+        self.assertEqual(RetryPolicy().dead_letter_queue_for('jobs'), 'jobs.dead')
+        self.assertEqual(RetryPolicy(dead_letter_queue='failed').dead_letter_queue_for('jobs'),
+                         'failed')
+
+
+class MemoryRetryTest(unittest.TestCase):
+    def test_held_back_then_dead_lettered(self):
+        qf = QueueFactory(backend='memory', broker=MemoryBroker())
+        qf.Producer('jobs').put('job')
+        qc = qf.Consumer('jobs', retry=RetryPolicy(max_attempts=2, delay=0.1))
+        self.assertEqual(qc.get(False), 'job')
+        qc.task_failed()
+        self.assertEqual(len(qc), 0)
+        self.assertEqual(qc.get(timeout=1.0), 'job')
+        qc.task_failed()
+        time.sleep(0.2)
+        self.assertEqual(len(qc), 0)
+        self.assertEqual(qf.Consumer('jobs.dead').get(False), 'job')
+
+
+if __name__ == '__main__':
+    unittest.main()
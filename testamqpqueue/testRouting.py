@@ -0,0 +1,126 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Topic and headers exchange matching, and routing through the memory backend
+and the benchmark's stand-in broker"""
+
+import sys
+import os
+import unittest
+from Queue import Empty
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from benchmark import StandInBroker
+from amqpqueue import QueueFactory, MemoryBroker
+from amqpqueue.memory import topic_matches, headers_match
+
+class TopicMatchesTest(unittest.TestCase):
+    def test_words(self):
+        self.assertTrue(topic_matches('create.txt', 'create.txt'))
+        self.assertFalse(topic_matches('create.txt', 'create.jpg'))
+        self.assertFalse(topic_matches('create', 'create.txt'))
+
+    def test_star_is_one_word(self):
+        self.assertTrue(topic_matches('*.txt', 'create.txt'))
+        self.assertFalse(topic_matches('*.txt', 'a.b.txt'))
+        self.assertFalse(topic_matches('a.*', 'a'))
+
+    def test_hash_is_any_number_of_words(self):
+        self.assertTrue(topic_matches('#', 'a.b.c'))
+        self.assertTrue(topic_matches('a.#', 'a'))
+        self.assertTrue(topic_matches('#.txt', 'a.b.txt'))
+        self.assertTrue(topic_matches('a.#.c', 'a.b.b.c'))
+        self.assertFalse(topic_matches('a.#.c', 'a.b.d'))
+
+
+class HeadersMatchTest(unittest.TestCase):
+    def test_all_by_default(self):
+        self.assertTrue(headers_match({'a':1, 'b':2}, {'a':1, 'b':2, 'c':3}))
+        self.assertFalse(headers_match({'a':1, 'b':2}, {'b':2}))
+
+    def test_any(self):
+        self.assertTrue(headers_match({'x-match':'any', 'a':1, 'b':2}, {'b':2}))
+        self.assertFalse(headers_match({'x-match':'any', 'a':1}, {'a':2}))
+
+    def test_no_headers(self):
+        self.assertFalse(headers_match({'a':1}, None))
+        self.assertTrue(headers_match({}, None))
+
+
+class MemoryRoutingTest(unittest.TestCase):
+    def factory(self, exchange_type):
+        return QueueFactory(backend='memory', broker=MemoryBroker(),
+                            exchange_name='events', exchange_type=exchange_type)
+
+    def test_topic(self):
+        qf = self.factory('topic')
+        qp = qf.Producer('events')
+        txt = qf.Subscriber('txt', ['create.txt', 'delete.txt'])
+        everything = qf.Subscriber('everything', '#')
+        qp.put(1, routing_key='create.txt')
+        qp.put(2, routing_key='create.jpg')
+        qp.put(3, routing_key='delete.txt')
+        self.assertEqual((len(txt), len(everything)), (2, 3))
+        self.assertEqual(txt.get(False), 1)
+        txt.task_done()
+        self.assertEqual(txt.get(False), 3)
+
+    def test_headers(self):
+        qf = self.factory('headers')
+        qp = qf.Producer('events')
+        txt = qf.Subscriber('txt', None, binding_arguments={'ext':'txt'})
+        qp.put(1, headers={'ext':'txt'})
+        qp.put(2, headers={'ext':'jpg'})
+        qp.put(3)
+        self.assertEqual(len(txt), 1)
+        self.assertEqual(txt.get(False), 1)
+
+    def test_producer_has_no_queue_of_its_own_on_topic_exchanges(self):
+        qf = self.factory('topic')
+        qp = qf.Producer('events')
+        qp.put(1, routing_key='create.txt')
+        self.assertEqual(len(qp), 0)
+        own = qf.Producer('own', own_queue=True)
+        own.put(2, routing_key='create.txt')
+        self.assertEqual(len(own), 1)
+
+
+class AmqpRoutingTest(unittest.TestCase):
+    def setUp(self):
+        self.broker = StandInBroker()
+        self.broker.install()
+        self.qf = QueueFactory(exchange_name='events', exchange_type='topic')
+
+    def tearDown(self):
+        self.broker.uninstall()
+
+    def test_topic(self):
+        qp = self.qf.Producer('events')
+        txt = self.qf.Subscriber('txt', '*.txt')
+        qp.put(1, routing_key='create.txt')
+        qp.put(2, routing_key='create.jpg')
+        self.assertEqual(txt.get(timeout=1.0), 1)
+        txt.task_done()
+        self.assertRaises(Empty, txt.get, timeout=0.1)
+
+    def test_producer_has_no_queue_of_its_own_on_topic_exchanges(self):
+        self.qf.Producer('events').put(1, routing_key='create.txt')
+        self.assertFalse('events' in self.broker.queues)
+
+    def test_own_queue_is_passed_on_by_the_factory(self):
+        qp = self.qf.Producer('own', own_queue=True)
+        self.assertTrue(('#', 'own') in self.broker.bindings['events'])
+        qp.put(1, routing_key='create.txt')
+        self.assertEqual(self.qf.Consumer('own').get(timeout=1.0), 1)
+
+    def test_rpc_client_has_no_queue_of_its_own(self):
+        rpc = self.qf.RpcClient('lookup')
+        try:
+            self.assertFalse('lookup' in self.broker.queues)
+        finally:
+            rpc.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""RpcClient round trips through a WorkerPool, on the memory backend and
+against the benchmark's stand-in broker"""
+
+import time
+import unittest
+
+from benchmark import StandInBroker
+from amqpqueue import QueueFactory, MemoryBroker, Error, RemoteError
+from amqpqueue.worker import Worker, WorkerPool
+
+class Doubler(Worker):
+    def endtask(self, msg, response):
+        if msg == 'bad':
+            self.context['replied'].append(self.reply(None, error='bad input'))
+        else:
+            self.context['replied'].append(self.reply(msg * 2))
+        self.queue_stdin.task_done()
+
+class RpcTests(object):
+    """Run against self.qf, set up by the backend's TestCase"""
+    def start_pool(self):
+        self.replied = []
+        self.pool = WorkerPool(Doubler, self.qf.Consumer('lookup', prefetch_count=4), size=4,
+                               replied=self.replied, poll_interval=0.05)
+        self.pool.start()
+
+    def stop_pool(self):
+        self.pool.drain(1.0)
+        self.pool.join()
+
+    def test_round_trip(self):
+        rpc = self.qf.RpcClient('lookup', poll_interval=0.05)
+        self.start_pool()
+        try:
+            futures = [rpc.call(i) for i in xrange(50)]
+            self.assertEqual([future.result(5.0) for future in futures],
+                             [i * 2 for i in xrange(50)])
+            self.assertEqual(rpc.outstanding(), 0)
+        finally:
+            self.stop_pool()
+            rpc.close()
+
+    def test_remote_error(self):
+        rpc = self.qf.RpcClient('lookup', poll_interval=0.05)
+        self.start_pool()
+        try:
+            future = rpc.call('bad')
+            self.assertRaises(RemoteError, future.result, 5.0)
+            self.assertEqual(rpc.call(2).result(5.0), 4)
+        finally:
+            self.stop_pool()
+            rpc.close()
+
+    def test_plain_put_gets_no_reply(self):
+        rpc = self.qf.RpcClient('lookup', poll_interval=0.05)
+        self.start_pool()
+        try:
+            self.qf.Producer('lookup').put(3)
+            self.assertEqual(rpc.call(2).result(5.0), 4)
+            deadline = time.time() + 5.0
+            while len(self.replied) < 2 and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(sorted(self.replied), [False, True])
+        finally:
+            self.stop_pool()
+            rpc.close()
+
+    def test_timeout(self):
+        rpc = self.qf.RpcClient('lookup', poll_interval=0.05)
+        try:
+            future = rpc.call(2, timeout=0.1)
+            self.assertRaises(Error, future.result, 5.0)
+            self.assertEqual(rpc.outstanding(), 0)
+        finally:
+            rpc.close()
+
+    def test_close_fails_outstanding_calls(self):
+        rpc = self.qf.RpcClient('lookup', poll_interval=0.05)
+        future = rpc.call(2)
+        rpc.close()
+        self.assertRaises(Error, future.result, 1.0)
+
+class MemoryRpcTest(RpcTests, unittest.TestCase):
+    def setUp(self):
+        self.qf = QueueFactory(backend='memory', broker=MemoryBroker(), serializer='json')
+
+class AmqpRpcTest(RpcTests, unittest.TestCase):
+    def setUp(self):
+        self.broker = StandInBroker()
+        self.broker.install()
+        self.qf = QueueFactory(serializer='json')
+
+    def tearDown(self):
+        self.broker.uninstall()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""_share_connection's locked writes and reader handoff, on a fake connection
+whose socket carries one byte (the channel id) per method, and QueueFactory's
+ConnectionPool against the benchmark's stand-in broker"""
+
+import sys
+import os
+import time
+import socket
+import threading
+import unittest
+from Queue import Queue
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from benchmark import StandInBroker
+from amqpqueue import QueueFactory
+from amqpqueue.amqpqueue import _share_connection, _WaitTimeout
+
+DELIVER = (60, 60)
+
+class Transport(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.written = []
+
+    def _write(self, data):
+        self.written.append(data)
+
+class MethodReader(object):
+    def __init__(self, sock):
+        self.sock = sock
+        # what _buffered() looks at
+        self.queue = Queue()
+        self.reads = 0
+
+    def read_method(self):
+        data = self.sock.recv(1)
+        if not data:
+            raise IOError('Socket closed')
+        channel = ord(data)
+        self.reads += 1
+        return channel, DELIVER, 'args', None
+
+class Channel(object):
+    def __init__(self):
+        self.method_queue = []
+
+class Connection(object):
+    def __init__(self):
+        self.sock, self.broker = socket.socketpair()
+        self.transport = Transport(self.sock)
+        self.method_reader = MethodReader(self.sock)
+        self.channels = {1:Channel(), 2:Channel()}
+
+    def send(self, channel_id):
+        self.broker.send(chr(channel_id))
+
+    def close(self):
+        self.sock.close()
+        self.broker.close()
+
+class Waiter(threading.Thread):
+    def __init__(self, conn, channel_id, allowed_methods=None):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.conn = conn
+        self.channel_id = channel_id
+        self.allowed_methods = allowed_methods
+        self.result = None
+
+    def run(self):
+        try:
+            self.result = self.conn._wait_method(self.channel_id, self.allowed_methods)
+        except IOError:
+            pass
+
+class ShareConnectionTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = Connection()
+        _share_connection(self.conn)
+
+    def tearDown(self):
+        self.conn._deadlines.deadline = None
+        self.conn.close()
+
+    def test_writes_still_reach_the_transport(self):
+        _share_connection(self.conn)
+        self.conn.transport._write('frame')
+        self.assertEqual(self.conn.transport.written, ['frame'])
+
+    def test_method_for_another_channel_is_handed_over(self):
+        first = Waiter(self.conn, 1)
+        first.start()
+        time.sleep(0.1)
+        # channel 2's thread finds the reader busy and waits to be woken
+        second = Waiter(self.conn, 2)
+        second.start()
+        time.sleep(0.1)
+        self.conn.send(2)
+        second.join(2.0)
+        self.assertEqual(second.result, (DELIVER, 'args', None))
+        self.assertTrue(first.isAlive())
+        self.conn.send(1)
+        first.join(2.0)
+        self.assertEqual(first.result, (DELIVER, 'args', None))
+        self.assertEqual(self.conn.method_reader.reads, 2)
+
+    def test_queued_method_is_taken_without_reading(self):
+        self.conn.send(2)
+        self.conn.send(1)
+        self.assertEqual(self.conn._wait_method(1, None), (DELIVER, 'args', None))
+        self.assertEqual(len(self.conn.channels[2].method_queue), 1)
+        self.assertEqual(self.conn._wait_method(2, None), (DELIVER, 'args', None))
+        self.assertEqual(self.conn.method_reader.reads, 2)
+
+    def test_traffic_for_other_channels_does_not_hold_up_a_deadline(self):
+        def other():
+            for i in xrange(10):
+                self.conn.send(2)
+                time.sleep(0.05)
+        sender = threading.Thread(target=other)
+        sender.start()
+        self.conn._deadlines.deadline = time.time() + 0.2
+        started = time.time()
+        self.assertRaises(_WaitTimeout, self.conn._wait_method, 1, None)
+        self.assertTrue(time.time() - started < 0.4)
+        sender.join()
+        self.assertTrue(self.conn.channels[2].method_queue)
+
+    def test_deadline_while_another_thread_reads(self):
+        # waits for a method which never comes, so it keeps the read lock
+        reader = Waiter(self.conn, 2, [(1, 1)])
+        reader.start()
+        time.sleep(0.1)
+        self.conn._deadlines.deadline = time.time() + 0.2
+        started = time.time()
+        self.assertRaises(_WaitTimeout, self.conn._wait_method, 1, None)
+        self.assertTrue(time.time() - started < 0.4)
+        self.conn._deadlines.deadline = time.time() + 2.0
+        self.conn.send(1)
+        self.assertEqual(self.conn._wait_method(1, None), (DELIVER, 'args', None))
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.broker = StandInBroker()
+        self.broker.install()
+
+    def tearDown(self):
+        self.broker.uninstall()
+
+    def test_queues_share_the_pooled_connections(self):
+        qf = QueueFactory(pool_size=2)
+        qp = qf.Producer('pooled')
+        qc = qf.Consumer('pooled')
+        other = qf.Consumer('other')
+        self.assertEqual(len(qf.pool), 2)
+        self.assertTrue(other.conn in (qp.conn, qc.conn))
+        self.assertTrue(qp.conn._shared)
+        qp.put('a')
+        self.assertEqual(qc.get(timeout=1.0), 'a')
+        qc.task_done()
+        qf.close()
+        self.assertEqual(len(qf.pool), 0)
+
+    def test_released_channels_make_room_on_their_connection(self):
+        qf = QueueFactory(pool_size=1)
+        first = qf.Consumer('pooled')
+        conn = first.conn
+        first.close()
+        self.assertEqual(qf.pool.users[conn], 0)
+        second = qf.Consumer('pooled')
+        self.assertTrue(second.conn is conn)
+        self.assertEqual(qf.pool.users[conn], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
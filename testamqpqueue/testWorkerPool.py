@@ -0,0 +1,133 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""WorkerPool threads sharing one consumer, on the memory backend and against
+the benchmark's stand-in broker"""
+
+import time
+import logging
+import threading
+import unittest
+
+from benchmark import StandInBroker
+from amqpqueue import QueueFactory, MemoryBroker, DeliveryLost
+from amqpqueue.worker import Worker, WorkerPool, WorkerResponse, COMPLETE, FAIL
+
+# failed tasks are logged with their tracebacks
+logging.getLogger('amqpqueue').addHandler(logging.NullHandler())
+
+class RecordingWorker(Worker):
+    """Notes which worker took each msg. 'fail' fails the first time round."""
+    def starttask(self, msg):
+        seen, lock = self.context['seen'], self.context['lock']
+        lock.acquire()
+        try:
+            seen.append((self.context['worker_id'], msg))
+            failing = msg == 'fail' and [m for w, m in seen].count('fail') == 1
+        finally:
+            lock.release()
+        time.sleep(self.context.get('delay', 0))
+        if failing:
+            return WorkerResponse(FAIL)
+        return WorkerResponse(COMPLETE)
+
+class WorkerPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.qf = QueueFactory(backend='memory', broker=MemoryBroker())
+        self.seen = []
+
+    def pool(self, qc, size, **kw):
+        return WorkerPool(RecordingWorker, qc, size=size, seen=self.seen, lock=threading.Lock(),
+                          poll_interval=0.05, **kw)
+
+    def run_until(self, pool, n, timeout=5.0):
+        """Run pool until it has taken n msgs, then drain it"""
+        pool.start()
+        deadline = time.time() + timeout
+        while len(self.seen) < n and time.time() < deadline:
+            time.sleep(0.01)
+        pool.drain(1.0)
+        pool.join()
+
+    def test_workers_share_the_msgs(self):
+        qp = self.qf.Producer('jobs')
+        for i in xrange(8):
+            qp.put(i)
+        qc = self.qf.Consumer('jobs', prefetch_count=4)
+        self.run_until(self.pool(qc, 4, delay=0.05), 8)
+        self.assertEqual(sorted([msg for worker_id, msg in self.seen]), range(8))
+        self.assertTrue(len(set([worker_id for worker_id, msg in self.seen])) > 1)
+        self.assertEqual((len(qp), qc.unacked), (0, []))
+
+    def test_no_more_msgs_in_hand_than_the_consumer_allows(self):
+        qp = self.qf.Producer('jobs')
+        for i in xrange(6):
+            qp.put(i)
+        qc = self.qf.Consumer('jobs', prefetch_count=2)
+        # the consumer refuses a third get before an ack, which would stop the pool
+        self.run_until(self.pool(qc, 4, delay=0.05), 6)
+        self.assertEqual((len(qp), qc.unacked), (0, []))
+
+    def test_failed_msg_is_returned_and_done_again(self):
+        qp = self.qf.Producer('jobs')
+        qp.put('fail')
+        qp.put('ok')
+        qc = self.qf.Consumer('jobs')
+        self.run_until(self.pool(qc, 1), 3)
+        self.assertEqual([msg for worker_id, msg in self.seen], ['fail', 'fail', 'ok'])
+        self.assertEqual((len(qp), qc.unacked), (0, []))
+
+    def test_delivery_lost_does_not_stop_the_worker(self):
+        qp = self.qf.Producer('jobs')
+        for i in xrange(3):
+            qp.put(i)
+        qc = self.qf.Consumer('jobs')
+        task_done = qc.task_done
+        def lost_once(delivery_tag=None, upto=None):
+            qc.task_done = task_done
+            task_done(delivery_tag)
+            raise DeliveryLost('Message %s will be redelivered.' % delivery_tag)
+        qc.task_done = lost_once
+        self.run_until(self.pool(qc, 1), 3)
+        self.assertEqual([msg for worker_id, msg in self.seen], [0, 1, 2])
+        self.assertEqual((len(qp), qc.unacked), (0, []))
+
+    def test_drain_leaves_the_rest_in_the_queue(self):
+        qp = self.qf.Producer('jobs')
+        for i in xrange(5):
+            qp.put(i)
+        qc = self.qf.Consumer('jobs', prefetch_count=2)
+        self.run_until(self.pool(qc, 2, delay=0.1), 1)
+        self.assertEqual(len(self.seen), 2)
+        self.assertEqual((len(qp), qc.unacked), (3, []))
+
+
+class AmqpWorkerPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.broker = StandInBroker()
+        self.broker.install()
+
+    def tearDown(self):
+        self.broker.uninstall()
+
+    def test_acked_from_the_worker_threads(self):
+        seen = []
+        qp = QueueFactory().Producer('jobs')
+        for i in xrange(6):
+            qp.put(i)
+        qc = QueueFactory().Consumer('jobs', prefetch_count=3)
+        pool = WorkerPool(RecordingWorker, qc, size=3, seen=seen, lock=threading.Lock(),
+                          poll_interval=0.05, delay=0.02)
+        pool.start()
+        deadline = time.time() + 5.0
+        while len(seen) < 6 and time.time() < deadline:
+            time.sleep(0.01)
+        pool.drain(1.0)
+        pool.join()
+        self.assertEqual(sorted([msg for worker_id, msg in seen]), range(6))
+        self.assertEqual(qc.ch.unacked, {})
+        self.assertEqual(len(self.broker.queue('jobs').messages), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()